@@ -1,5 +1,15 @@
+import bisect
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, csc_matrix
 
 
 class Repo():
@@ -9,6 +19,10 @@ class Repo():
     Functions for mapping between ID and index are also given.
     """
 
+    # the version of the compiled rating files, see compile_ratings(); older
+    # copies are rebuilt
+    compiled_format = 2
+
     def __init__(self):
         self.util_mat = None  # the user-item utility(rating) matrix
         self.user_rating_means = []  # users' rating means
@@ -16,6 +30,332 @@ class Repo():
         self.item_id_map = {}  # map item_id to item_idx
         self.user_ids = []  # map user_idx to user_id
         self.item_ids = []  # map item_idx to item_id
+        # a CSC copy of util_mat for fast column access, see set_keep_csc()
+        self.util_mat_csc = None
+        self.keep_csc = True
+        # the binary rated matrix and its transpose, see rated_matrices()
+        self.rated_mats = None
+        self.rating_times = None  # Time of each rating in util_mat.data
+        self.rating_folds = None  # Fold of each rating in util_mat.data
+        self.user_rating_counts = []  # users' numbers of ratings
+        # the directory of compiled rating files, see set_cache_dir()
+        self.cache_dir = None
+        # bumped whenever the predictions may change, see model_changed()
+        self.model_version = 0
+        self.topk_cache = None  # top-k results cache, see set_topk_cache()
+        self.profiler = Profiler()  # disabled unless set by set_profiler()
+        # compact ID tables and float32 ratings, see set_compact()
+        self.compact = False
+        # the path, size and mtime of the rating file, see source_stamp()
+        self.ratings_source = None
+
+    def set_keep_csc(self, keep_csc):
+        """
+        Set whether load_ratings() builds and keeps a CSC copy of util_mat.
+        The copy doubles the memory of the ratings, but makes
+        users_who_rated() a view instead of a scan of the whole matrix.
+        """
+        self.keep_csc = keep_csc
+
+    def set_compact(self, compact=True):
+        """
+        Set whether the ID mappings are kept as CompactIds tables instead of
+        dicts and lists, and the ratings as float32 instead of float64. The
+        current mappings and ratings are converted. Lookups through
+        get_user_idx(), get_user_idxs(), user_id_map etc. work the same in
+        both modes.
+
+        >>> recsys = Repo()
+        >>> recsys.set_compact()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> recsys.util_mat.dtype, recsys.util_mat.indices.dtype
+        (dtype('float32'), dtype('int32'))
+        >>> recsys.get_user_idx('U8'), recsys.get_item_id(18)
+        (7, 'I3')
+        >>> recsys.get_item_idxs(['I3', 'I99', 'I4'])
+        array([18, -1,  0])
+        >>> full = Repo()
+        >>> full.load_ratings("testcase_ratings.csv")
+        >>> (recsys.util_mat != full.util_mat).nnz
+        0
+        >>> full.set_compact()
+        >>> full.user_ids[:3], full.user_id_map['U2']
+        (['U1', 'U2', 'U3'], 1)
+        """
+        self.compact = compact
+        self.user_ids, self.user_id_map = self.new_id_tables(self.user_ids)
+        self.item_ids, self.item_id_map = self.new_id_tables(self.item_ids)
+        if self.util_mat is not None:
+            self.util_mat = self.util_mat.astype(self.rating_dtype())
+            self.util_mat_changed()
+
+    def rating_dtype(self):
+        return np.float32 if self.compact else float
+
+    def new_id_tables(self, ids=()):
+        """
+        Return an index -> ID table and an ID -> index map of the given IDs,
+        compact or not according to set_compact().
+        """
+        if self.compact:
+            table = ids if isinstance(ids, CompactIds) else CompactIds(ids)
+            return table, CompactIdMap(table)
+        ids = list(ids)
+        return ids, {id_: i for i, id_ in enumerate(ids)}
+
+    def reset_ids(self):
+        """
+        Empty the ID mappings.
+        """
+        self.user_ids, self.user_id_map = self.new_id_tables()
+        self.item_ids, self.item_id_map = self.new_id_tables()
+
+    def set_profiler(self, profiler):
+        """
+        Record the phase timers and the counters of this system in the given
+        Profiler. The same profiler can be shared by several systems.
+
+        >>> recsys = Repo()
+        >>> recsys.set_profiler(Profiler(enabled=True))
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> sorted(recsys.profiler.report()["phases"])
+        ['load_ratings', 'ratings_loaded']
+        """
+        self.profiler = profiler
+
+    def set_topk_cache(self, max_entries=10000, max_bytes=None):
+        """
+        Cache the results of predict_top_k_recomm() (and of its batch
+        version) in a TopKCache of at most max_entries users and max_bytes
+        estimated bytes. None disables the cache (max_entries=None) or the
+        bound (max_bytes=None).
+        """
+        self.topk_cache = TopKCache(max_entries, max_bytes) \
+            if max_entries is not None else None
+
+    def model_changed(self):
+        """
+        Called whenever the predictions of any user may have changed: the
+        ratings or the model were (re)loaded, trained or updated. The cached
+        top-k results are dropped.
+        """
+        self.model_version += 1
+        if self.topk_cache is not None:
+            self.topk_cache.clear()
+
+    def cached_top_k_recomm(self, user_idxs, k, max_candidates, compute):
+        """
+        Return the top k recommendations of each user in user_idxs, from the
+        top-k cache where possible. The missing users are computed together
+        by compute(missing_user_idxs), and cached.
+
+        >>> recsys = Repo()
+        >>> recsys.set_topk_cache(max_entries=2)
+        >>> computed = []
+        >>> def compute(users):
+        ...     computed.extend(users)
+        ...     return [[(10 * u + i, 5. - i) for i in range(3)]
+        ...             for u in users]
+        >>> recsys.cached_top_k_recomm([1, 2], 3, None, compute)
+        [[(10, 5.0), (11, 4.0), (12, 3.0)], [(20, 5.0), (21, 4.0), (22, 3.0)]]
+        >>> recsys.cached_top_k_recomm([2, 1], 2, None, compute)[0]
+        [(20, 5.0), (21, 4.0)]
+        >>> computed
+        [1, 2]
+        >>> recsys.topk_cache.hits, recsys.topk_cache.misses
+        (2, 2)
+        """
+
+        user_idxs = np.asarray(user_idxs, dtype=int)
+        if self.topk_cache is None:
+            return compute(user_idxs)
+
+        results = []
+        missing = []
+        for i, user_idx in enumerate(user_idxs):
+            key = (self.model_version, int(user_idx), max_candidates)
+            results.append(self.topk_cache.get(key, k))
+            if results[-1] is None:
+                missing.append(i)
+        if len(missing) > 0:
+            computed = compute(user_idxs[missing])
+            for i, recommendations in zip(missing, computed):
+                key = (self.model_version, int(user_idxs[i]), max_candidates)
+                self.topk_cache.put(key, k, recommendations)
+                results[i] = recommendations
+        return results
+
+    def format_top_k(self, user_idxs, k):
+        """
+        Return the top k recommendations of the users in user_idxs as text,
+        one line per recommendation, in the format
+        <User_ID>,<Rank>,<Item_ID>,<Score>
+        """
+        lines = []
+        recommendations = self.predict_top_k_recomm_batch(
+                user_idxs, k, use_cache=False)
+        for user_idx, recommendation in zip(user_idxs, recommendations):
+            user_id = self.user_ids[user_idx]
+            for rank, (item_idx, score) in enumerate(recommendation):
+                lines.append("{},{},{},{:.4f}\n".format(
+                    user_id, rank + 1, self.item_ids[item_idx], score))
+        return "".join(lines)
+
+    def export_top_k(self, filename, k, user_idxs=None, workers=1,
+                     block_size=1000, resume=False):
+        """
+        Write the top k recommendations of the users in user_idxs (all users
+        if None) to filename, in the format of format_top_k(). The users are
+        handled in blocks of block_size, in a pool of workers processes if
+        workers > 1, and every block is written as soon as it is done, in
+        the order of user_idxs.
+
+        After every block, the number of finished blocks and the length of
+        the file are saved in filename + ".progress". If resume is True and
+        that file exists, the output is cut back to the last finished block,
+        and the export continues from the next one.
+        Return the number of users written by this call.
+
+        >>> import contextlib, io, tempfile
+        >>> from RecSysBaseLine import RecSysBaseLine
+        >>> recsys = RecSysBaseLine()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> path = tempfile.mkdtemp()
+        >>> filename = os.path.join(path, "top_k.csv")
+        >>> with contextlib.redirect_stdout(io.StringIO()):
+        ...     num_users = recsys.export_top_k(
+        ...             filename, 2, [0, 1, 7], block_size=2)
+        >>> num_users
+        3
+        >>> with open(filename) as f:
+        ...     print(f.read(), end='')
+        U1,1,I18,4.0000
+        U1,2,I2,4.0000
+        U2,1,I2,5.0000
+        U2,2,I10,3.8338
+        U8,1,I15,3.5165
+        U8,2,I14,3.0000
+        >>> with open(filename, 'a') as f:
+        ...     _ = f.write("U8,1,I15,3.5")  # a block cut off by a crash
+        >>> with open(filename + ".progress") as f:
+        ...     progress = json.load(f)
+        >>> progress["blocks_done"], progress["offset"] = 1, 64
+        >>> with open(filename + ".progress", 'w') as f:
+        ...     json.dump(progress, f)
+        >>> with contextlib.redirect_stdout(io.StringIO()):
+        ...     num_users = recsys.export_top_k(
+        ...             filename, 2, [0, 1, 7], block_size=2, resume=True)
+        >>> num_users
+        1
+        >>> with open(filename) as f:
+        ...     len(f.readlines())
+        6
+        >>> shutil.rmtree(path)
+        """
+        user_idxs = np.arange(len(self.user_ids)) if user_idxs is None \
+            else np.asarray(user_idxs, dtype=int)
+        blocks = [user_idxs[begin:begin + block_size]
+                  for begin in range(0, len(user_idxs), block_size)]
+        progress_file = filename + ".progress"
+        progress = {"k": k, "block_size": block_size,
+                    "num_users": len(user_idxs), "blocks_done": 0,
+                    "offset": 0}
+        if resume and os.path.exists(progress_file):
+            with open(progress_file) as f:
+                saved = json.load(f)
+            assert all(saved[name] == progress[name]
+                       for name in ["k", "block_size", "num_users"]), \
+                "Bad progress file. progress_file = [{}]".format(
+                        progress_file)
+            progress = saved
+        todo = blocks[progress["blocks_done"]:]
+
+        pool = None
+        if workers > 1 and len(todo) > 1:
+            pool = ProcessPoolExecutor(
+                    max_workers=workers, initializer=init_export_worker,
+                    initargs=(self, k))
+            results = pool.map(run_export_worker, todo)
+        else:
+            results = (self.format_top_k(users, k) for users in todo)
+
+        num_users = 0
+        start_time = time.time()
+        mode = 'r+' if progress["blocks_done"] > 0 else 'w'
+        try:
+            with open(filename, mode) as f:
+                f.seek(progress["offset"])
+                f.truncate()
+                for users, text in zip(todo, results):
+                    f.write(text)
+                    f.flush()
+                    progress["blocks_done"] += 1
+                    progress["offset"] = f.tell()
+                    with open(progress_file + ".tmp", 'w') as pf:
+                        json.dump(progress, pf)
+                    os.replace(progress_file + ".tmp", progress_file)
+
+                    num_users += len(users)
+                    elapsed = time.time() - start_time
+                    print("Exported {}/{} users, {:.1f} users/s".format(
+                        min(progress["blocks_done"] * block_size,
+                            len(user_idxs)),
+                        len(user_idxs),
+                        num_users / elapsed if elapsed > 0 else 0.),
+                        end='\r', flush=True)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        if num_users > 0:
+            print()
+        return num_users
+
+    def set_cache_dir(self, cache_dir):
+        """
+        Set the directory where load_ratings() keeps compiled (binary) copies
+        of the rating files. None disables the cache.
+        """
+        self.cache_dir = cache_dir
+
+    def users_who_rated(self, item_idx, return_ratings=False):
+        """
+        Return the indices of the users who have rated the item, in ascending
+        order. If return_ratings is True, return their ratings as well.
+        With the CSC copy, both arrays are views into it.
+
+        >>> recsys = Repo()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> recsys.users_who_rated(recsys.get_item_idx("I2"))
+        array([2, 3, 6, 7], dtype=int32)
+        >>> recsys.users_who_rated(1, return_ratings=True)[1]
+        array([2., 5.])
+        """
+        if self.util_mat_csc is not None:
+            mat = self.util_mat_csc
+            begin, end = mat.indptr[item_idx], mat.indptr[item_idx + 1]
+            users, ratings = mat.indices[begin:end], mat.data[begin:end]
+        else:
+            column = self.util_mat[:, item_idx].tocoo()
+            order = np.argsort(column.row)
+            users, ratings = column.row[order], column.data[order]
+        return (users, ratings) if return_ratings else users
+
+    def items_rated_by(self, user_idx, return_ratings=False):
+        """
+        Return the indices of the items the user has rated, in ascending
+        order. If return_ratings is True, return the ratings as well.
+        Both arrays are views into util_mat.
+
+        >>> recsys = Repo()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> recsys.items_rated_by(recsys.get_user_idx("U4"))
+        array([ 3,  6,  7, 10, 12, 13, 16, 17, 18], dtype=int32)
+        """
+        mat = self.util_mat
+        begin, end = mat.indptr[user_idx], mat.indptr[user_idx + 1]
+        if return_ratings:
+            return mat.indices[begin:end], mat.data[begin:end]
+        return mat.indices[begin:end]
 
     def get_user_idx(self, user_id):
         """
@@ -35,6 +375,31 @@ class Repo():
         """
         return self.item_id_map[item_id]
 
+    def get_user_idxs(self, user_ids):
+        """
+        Return the indices of the given user IDs in an array, -1 for unknown
+        IDs. In compact mode, all IDs are looked up by one binary search.
+
+        >>> recsys = Repo()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> recsys.get_user_idxs(['U8', 'U0'])
+        array([ 7, -1])
+        """
+        return self.lookup_ids(user_ids, self.user_id_map, self.user_ids)
+
+    def get_item_idxs(self, item_ids):
+        """
+        Return the indices of the given item IDs in an array, -1 for unknown
+        IDs, see get_user_idxs().
+        """
+        return self.lookup_ids(item_ids, self.item_id_map, self.item_ids)
+
+    @staticmethod
+    def lookup_ids(ids, id_map, id_list):
+        if isinstance(id_list, CompactIds):
+            return id_list.lookup(ids)
+        return np.array([id_map.get(id_, -1) for id_ in ids], dtype=int)
+
     def get_user_id(self, user_idx):
         """
         >>> recsys = Repo()
@@ -79,6 +444,61 @@ class Repo():
         else:
             return self.user_rating_means[user_idx]
 
+    def candidate_items(self, user_idxs, max_candidates=None):
+        """
+        Return the candidate items of the given users in a sparse matrix with
+        one row per user, whose entries are the co-occurrence counts.
+        The candidate items of a user are all the items rated by the users who
+        have rated at least one item in common with the user, excluding the
+        items the user has already rated. The count of a candidate is the
+        number of such (co-rated item, user) paths leading to it.
+        The neighborhood is computed by two sparse matrix products, with
+        the binary matrices of rated_matrices().
+
+        If max_candidates is given, only the max_candidates items with the
+        highest counts are kept for each user (ties by the item index).
+
+        >>> recsys = Repo()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> candidates = recsys.candidate_items([recsys.get_user_idx("U1")])
+        >>> [recsys.get_item_id(i) for i in candidates.indices]
+        ['I1', 'I5', 'I6', 'I15', 'I18', 'I2', 'I14', 'I3', 'I20']
+        >>> candidates.data
+        array([27., 32., 25., 23.,  9., 19., 14., 14.,  5.])
+        >>> candidates = recsys.candidate_items([0, 7], max_candidates=2)
+        >>> candidates.indptr
+        array([0, 2, 4], dtype=int32)
+        >>> [recsys.get_item_id(i) for i in candidates.indices]
+        ['I1', 'I5', 'I8', 'I5']
+        """
+
+        user_idxs = np.asarray(user_idxs, dtype=int)
+        rated, rated_t = self.rated_matrices()
+        user_rated = rated[user_idxs]
+
+        # user -> co-rating users -> their items
+        co_users = user_rated @ rated_t
+        counts = (co_users @ rated).tocsr()
+
+        # exclude the items the users have already rated
+        counts = counts - counts.multiply(user_rated)
+        counts.eliminate_zeros()
+        counts.sort_indices()
+
+        if max_candidates is not None:
+            rows = np.repeat(np.arange(counts.shape[0]),
+                             np.diff(counts.indptr))
+            order = np.lexsort((counts.indices, -counts.data, rows))
+            ranks = np.arange(len(rows)) - counts.indptr[rows]
+            keep = np.sort(order[ranks < max_candidates])
+            counts = csr_matrix(
+                    (counts.data[keep], counts.indices[keep],
+                     np.concatenate(([0], np.cumsum(np.minimum(
+                         np.diff(counts.indptr), max_candidates))))),
+                    shape=counts.shape)
+
+        return counts
+
     def load_ratings(
             self,
             ratings_file,
@@ -86,13 +506,19 @@ class Repo():
             user_id_map={},
             item_id_map={},
             user_ids=[],
-            item_ids=[]
+            item_ids=[],
+            chunk_size=None,
+            parse_time_fold=False,
+            cache_dir=None
             ):
         """
         Load ratings from the given file.
         The expected format of the file is one rating per line,
         in the format <User_ID>,<Item_ID>,<Rating>,<Time>[,<Fold>]
-        Each line from the given file will be split (at ",") into tokens.
+        The file is read in chunks of about chunk_size bytes (by default
+        16 MiB, or 1 MiB in compact mode, see parse_ratings()). Each chunk is
+        split (at ",") into columns of tokens with array operations, and its
+        IDs are factorized in bulk.
 
         If the mappings between ID and index are not given, user_ids and
         item_ids will be assigned to respective indexes in the order they are
@@ -100,11 +526,21 @@ class Repo():
 
         All ratings from the given file will be stored in a sparse matrix
         (util_mat), where row indices will be the same as user indices and
-        column indices will be the same to item indices.
+        column indices will be the same to item indices. Ratings are parsed
+        as rating_dtype(): float64, or float32 in compact mode.
 
         Finally, the average rating for every user will be computed and stored
         in a list (user_rating_means).
 
+        If parse_time_fold is True, the Time (and Fold, if present) columns
+        are stored in rating_times (and rating_folds), aligned with
+        util_mat.data.
+
+        If cache_dir (or the directory given to set_cache_dir()) is set, the
+        file is compiled into binary arrays in that directory the first time
+        it is loaded, and later loads read the arrays memory-mapped instead of
+        parsing the file. See compile_ratings().
+
         >>> recsys = Repo()
         >>> recsys.load_ratings("testcase_ratings.csv")
         >>> result = np.array(recsys.util_mat.todense(), dtype=int)
@@ -121,12 +557,11 @@ class Repo():
          [2, 0, 0, 4, 4, 0, 0, 1, 0, 0, 0, 2, 0, 0, 0, 5, 3, 0, 2, 0]]
         >>> [("%.2f" %mean) for mean in recsys.user_rating_means]
         ['1.91', '2.70', '2.18', '2.33', '2.40', '2.78', '3.25', '2.88']
+        >>> recsys = Repo()
+        >>> recsys.load_ratings("testcase_ratings.csv", chunk_size=64)
+        >>> recsys.get_user_idx('U8'), recsys.get_item_idx('I3')
+        (7, 18)
         """
-        user_idx = 0  # user index starts from 0
-        item_idx = 0  # item index starts from 0
-        users = []
-        items = []
-        ratings = []
 
         if use_exist_mapping:
             self.user_id_map = user_id_map
@@ -134,45 +569,1138 @@ class Repo():
             self.user_ids = user_ids
             self.item_ids = item_ids
 
-        with open(ratings_file, 'r') as f:
-            for line in f:
-                # split each line (at ",") into tokens
-                splits = line.split(",")
-                user_id, item_id, rating = splits[0:3]
-
-                if not use_exist_mapping:
-                    # if the user_id is seen for the first time, assign an
-                    # index (index starts from 0) and store into user_id_map
-                    if (user_id not in self.user_id_map):
-                        self.user_id_map[user_id] = user_idx
-                        user_idx = user_idx + 1
-                        self.user_ids.append(user_id)
-                    # if the item_id is seen for the first time, assign an
-                    # index (index starts from 0) and store into item_id_map
-                    if (item_id not in self.item_id_map):
-                        self.item_id_map[item_id] = item_idx
-                        item_idx = item_idx + 1
-                        self.item_ids.append(item_id)
-
-                users.append(self.user_id_map[user_id])
-                items.append(self.item_id_map[item_id])
-                ratings.append(float(rating))
+        cache_dir = cache_dir if cache_dir is not None else self.cache_dir
+        self.ratings_source = self.source_stamp(ratings_file)
+        with self.profiler.phase("load_ratings"):
+            if cache_dir is not None:
+                path = self.compile_ratings(ratings_file, cache_dir,
+                                            chunk_size)
+                self.load_compiled(path, use_exist_mapping, parse_time_fold)
+            else:
+                self.parse_ratings(ratings_file, use_exist_mapping,
+                                   chunk_size, parse_time_fold)
+        with self.profiler.phase("ratings_loaded"):
+            self.ratings_loaded()
+        self.model_changed()
 
-        # generate user-item utility matrix (using sparse matrix)
+    def load_ratings_matrix(
+            self,
+            util_mat,
+            use_exist_mapping=False,
+            user_id_map={},
+            item_id_map={},
+            user_ids=[],
+            item_ids=[]
+            ):
+        """
+        Load ratings from a sparse user-item matrix that is already in memory,
+        instead of a file. The rows and columns of util_mat must follow the
+        given mappings (or the current ones, if use_exist_mapping is False).
+        The users' rating means are computed from util_mat.
+
+        >>> recsys = Repo()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> other = Repo()
+        >>> other.load_ratings_matrix(
+        ...     recsys.util_mat[:, :10], True, recsys.user_id_map,
+        ...     recsys.item_id_map, recsys.user_ids, recsys.item_ids)
+        >>> other.util_mat.shape, other.util_mat.nnz
+        ((8, 20), 42)
+        >>> "%.2f" %other.get_avg_rating(user_id="U1")
+        '2.00'
+        """
+
+        if use_exist_mapping:
+            self.user_id_map = user_id_map
+            self.item_id_map = item_id_map
+            self.user_ids = user_ids
+            self.item_ids = item_ids
+
+        self.ratings_source = None
+        with self.profiler.phase("load_ratings"):
+            coo = util_mat.tocoo()
+            self.set_ratings(coo.row, coo.col, coo.data)
+            self.user_rating_counts = np.bincount(coo.row)
+            self.user_rating_means = np.bincount(coo.row, weights=coo.data)\
+                / self.user_rating_counts
+        with self.profiler.phase("ratings_loaded"):
+            self.ratings_loaded()
+        self.model_changed()
+
+    def util_mat_changed(self):
+        """
+        Called whenever util_mat is replaced: the CSC copy is rebuilt, and
+        the matrices derived from util_mat are dropped.
+        """
+        self.util_mat_csc = self.util_mat.tocsc() if self.keep_csc else None
+        self.rated_mats = None
+
+    def rated_matrices(self):
+        """
+        Return the binary matrix of the rated entries of util_mat and its
+        transpose, both in CSR form. They are built on the first call and
+        kept until util_mat changes, so candidate_items() does not copy the
+        whole matrix on every call.
+        """
+        if self.rated_mats is None:
+            rated = self.util_mat.tocsr(copy=True)
+            rated.eliminate_zeros()
+            rated.data = np.ones(rated.nnz)
+            self.rated_mats = (rated, rated.T.tocsr())
+        return self.rated_mats
+
+    def ratings_loaded(self):
+        """
+        Called after load_ratings() or load_ratings_matrix() has loaded the
+        ratings. Subclasses build their models here.
+        """
+        pass
+
+    def add_ratings(self, rows):
+        """
+        Add new ratings to the loaded ones without reloading.
+        rows: iterable of (user_id, item_id, rating), optionally followed by
+              the time and the fold, as the lines of the rating file
+        The ratings are merged by merge_ratings(), and then ratings_added()
+        is called with the touched users and items.
+
+        >>> recsys = Repo()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> recsys.add_ratings([("U1", "I4", 5), ("U9", "I21", 4),
+        ...                     ("U1", "I3", 1), ("U9", "I21", 3)])
+        >>> recsys.util_mat.shape, recsys.util_mat.nnz
+        ((9, 21), 82)
+        >>> recsys.util_mat[0, recsys.get_item_idx("I4")]
+        5.0
+        >>> recsys.get_avg_rating(user_id="U9")
+        3.0
+        >>> other = Repo()
+        >>> other.load_ratings_matrix(
+        ...     recsys.util_mat, True, recsys.user_id_map, recsys.item_id_map,
+        ...     recsys.user_ids, recsys.item_ids)
+        >>> np.allclose(recsys.user_rating_means, other.user_rating_means)
+        True
+        >>> (recsys.util_mat_csc != other.util_mat_csc).nnz
+        0
+        """
+
+        with self.profiler.phase("add_ratings"):
+            users, items = self.merge_ratings(rows)
+            if len(users) > 0:
+                self.ratings_added(users, items)
+                self.model_changed()
+
+    def merge_ratings(self, rows):
+        """
+        Merge the ratings in rows (see add_ratings()) into util_mat, and
+        return the indices of the touched users and items.
+        New users and items are appended to the ID mappings. A rating of a
+        (user, item) pair that is already rated replaces the old one (the
+        last one wins within rows too), and zero ratings are ignored. The new
+        entries are inserted into the sorted CSR arrays of util_mat, and the
+        rating means of the touched users are updated incrementally.
+        """
+
+        rows = [row for row in rows if float(row[2]) != 0]
+        if len(rows) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        users = self.factorize_ids(np.array([str(row[0]) for row in rows]),
+                                   self.user_id_map, self.user_ids, False)
+        items = self.factorize_ids(np.array([str(row[1]) for row in rows]),
+                                   self.item_id_map, self.item_ids, False)
+        ratings = np.array([float(row[2]) for row in rows])
+        num_users, num_items = len(self.user_ids), len(self.item_ids)
+
+        # sort the new ratings by (user, item) and keep the last of each pair
+        keys = users.astype(np.int64) * num_items + items
+        order = np.argsort(keys, kind='stable')
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = keys[order][1:] != keys[order][:-1]
+        order = order[last]
+        keys, users, items, ratings = \
+            keys[order], users[order], items[order], ratings[order]
+
+        # find the new ratings among the old ones, by the same keys
+        mat = self.util_mat.tocsr()
+        old_num_users = mat.shape[0]
+        old_keys = np.repeat(np.arange(old_num_users, dtype=np.int64),
+                             np.diff(mat.indptr)) * num_items + mat.indices
+        pos = np.searchsorted(old_keys, keys)
+        exists = np.zeros(len(keys), dtype=bool)
+        inside = pos < len(old_keys)
+        exists[inside] = old_keys[pos[inside]] == keys[inside]
+        old_ratings = np.zeros(len(keys))
+        old_ratings[exists] = mat.data[pos[exists]]
+
+        # replace the existing ratings, and insert the others in place
+        def merge(old_values, new_values):
+            values = np.array(old_values)
+            values[pos[exists]] = new_values[exists]
+            return np.insert(values, pos[~exists], new_values[~exists])
+
+        data = merge(mat.data.astype(float), ratings)
+        indices = np.insert(mat.indices, pos[~exists], items[~exists])
+        indptr = np.concatenate((
+            mat.indptr,
+            np.full(num_users - old_num_users, mat.indptr[-1])))
+        indptr[1:] += np.cumsum(
+                np.bincount(users[~exists], minlength=num_users))
+        index_dtype = np.int32 if len(data) < 2**31 else np.int64
+        if self.rating_times is not None:
+            self.rating_times = merge(self.rating_times, np.array(
+                [int(row[3]) if len(row) > 3 else 0 for row in rows],
+                dtype=np.int64)[order])
+        if self.rating_folds is not None:
+            self.rating_folds = merge(self.rating_folds, np.array(
+                [int(row[4]) if len(row) > 4 else 0 for row in rows],
+                dtype=np.int32)[order])
         self.util_mat = csr_matrix(
-                (ratings, (users, items)),
-                dtype=float,
-                shape=(len(self.user_ids), len(self.item_ids)))
+                (data.astype(self.rating_dtype()), indices.astype(index_dtype),
+                 indptr.astype(index_dtype)),
+                shape=(num_users, num_items))
+        self.util_mat_changed()
+
+        # update the counts and the means of the touched users
+        counts = np.zeros(num_users, dtype=np.int64)
+        counts[:len(self.user_rating_counts)] = self.user_rating_counts
+        means = np.zeros(num_users)
+        means[:len(self.user_rating_means)] = self.user_rating_means
+        touched = np.unique(users)
+        sums = means[touched] * counts[touched] + np.bincount(
+                users, weights=ratings - old_ratings,
+                minlength=num_users)[touched]
+        counts += np.bincount(users[~exists], minlength=num_users)
+        means[touched] = sums / counts[touched]
+        self.user_rating_counts = counts
+        self.user_rating_means = means
+
+        return touched, np.unique(items)
+
+    def ratings_added(self, users, items):
+        """
+        Called after add_ratings() with the indices of the users and the
+        items whose ratings changed. Subclasses update their models here.
+        """
+        pass
+
+    def parse_ratings(self, ratings_file, use_exist_mapping=False,
+                      chunk_size=None, parse_time_fold=False):
+        """
+        Parse the rating file into util_mat and the users' rating means, see
+        load_ratings().
+        The temporary arrays of a chunk take several times its size, and
+        bound the peak memory of the parse. In compact mode, whose bulk ID
+        lookups cost little per chunk, the chunks are smaller by default.
+
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile("w", suffix=".csv") as f:
+        ...     _ = f.write("U1,I1,2.7\\nU1,I2,4.1\\n")
+        ...     f.flush()
+        ...     recsys = Repo()
+        ...     recsys.parse_ratings(f.name)
+        >>> recsys.util_mat.data.tolist(), recsys.get_avg_rating(0)
+        ([2.7, 4.1], 3.4)
+        """
 
-        # compute the average rating of each user
+        if chunk_size is None:
+            chunk_size = 2**20 if self.compact else 2**24
+        users = []
+        items = []
+        ratings = []
+        times = []
+        folds = []
+        with open(ratings_file, 'rb') as f:
+            while True:
+                # read about chunk_size bytes, up to the end of a line
+                chunk = f.read(chunk_size)
+                if len(chunk) == 0:
+                    break
+                chunk += f.readline()
+                columns = self.split_chunk(
+                        chunk, 5 if parse_time_fold else 3)
+                if len(columns) == 0:
+                    continue
+                users.append(self.factorize_ids(
+                        columns[0], self.user_id_map, self.user_ids,
+                        use_exist_mapping))
+                items.append(self.factorize_ids(
+                        columns[1], self.item_id_map, self.item_ids,
+                        use_exist_mapping))
+                ratings.append(columns[2].astype(self.rating_dtype()))
+                if parse_time_fold and len(columns) > 3:
+                    times.append(columns[3].astype(np.int64))
+                if parse_time_fold and len(columns) > 4:
+                    folds.append(columns[4].astype(np.int32))
+
+        users = np.concatenate(users) if users else np.zeros(0, np.int32)
+        items = np.concatenate(items) if items else np.zeros(0, np.int32)
+        ratings = np.concatenate(ratings) if ratings \
+            else np.zeros(0, self.rating_dtype())
+        times = np.concatenate(times) if times else None
+        folds = np.concatenate(folds) if folds else None
+
+        # compute the average rating of each user, before util_mat and its
+        # CSC copy are built, to keep the temporaries out of the peak
+        self.user_rating_counts = np.bincount(users)
         self.user_rating_means = np.bincount(users, weights=ratings)\
-            / np.bincount(users)
+            / self.user_rating_counts
+
+        # generate user-item utility matrix (using sparse matrix)
+        self.set_ratings(users, items, ratings, times, folds)
+
+    def compile_ratings(self, ratings_file, cache_dir, chunk_size=None):
+        """
+        Return the directory of the compiled copy of ratings_file in
+        cache_dir, compiling it first if needed.
+
+        A compiled copy stores the CSR arrays of util_mat (in the file's own
+        ID order), the users' rating means and counts, the ID tables and the
+        Time/Fold columns as .npy files, and is keyed by the absolute path of
+        the file. It is reused if the size and mtime of the file are
+        unchanged, or if only the mtime changed but the SHA-256 of the
+        content is the same. Otherwise, or if it was compiled in an older
+        format (see compiled_format), it is rebuilt.
+
+        >>> import tempfile
+        >>> cache_dir = tempfile.mkdtemp()
+        >>> recsys = Repo()
+        >>> recsys.load_ratings("testcase_ratings.csv", cache_dir=cache_dir)
+        >>> cached = Repo()
+        >>> cached.load_ratings("testcase_ratings.csv", cache_dir=cache_dir)
+        >>> cached.util_mat.data.flags.writeable  # read-only memory map
+        False
+        >>> cached.util_mat_csc.indices.flags.writeable
+        False
+        >>> (cached.util_mat != recsys.util_mat).nnz, cached.item_ids[:3]
+        (0, ['I4', 'I7', 'I8'])
+        >>> np.allclose(cached.user_rating_means, recsys.user_rating_means)
+        True
+        >>> shutil.rmtree(cache_dir)
+        """
+
+        stamp = self.source_stamp(ratings_file)
+        source = stamp["source"]
+        path = os.path.join(
+                cache_dir, hashlib.sha1(source.encode()).hexdigest()[:16])
+
+        meta_file = os.path.join(path, "meta.json")
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            if meta.get("format") == self.compiled_format and \
+                    meta["source"] == source and \
+                    meta["size"] == stamp["size"]:
+                if meta["mtime_ns"] == stamp["mtime_ns"]:
+                    return path
+                if meta["sha256"] == self.file_sha256(source):
+                    meta["mtime_ns"] = stamp["mtime_ns"]
+                    with open(meta_file, "w") as f:
+                        json.dump(meta, f)
+                    return path
+
+        # parse the file with its own ID mappings, then write the arrays into
+        # a temporary directory which replaces the old copy when complete
+        repo = Repo()
+        repo.set_keep_csc(False)
+        repo.load_ratings(source, chunk_size=chunk_size, parse_time_fold=True)
+        tmp_path = "{}.tmp{}".format(path, os.getpid())
+        repo.save_compiled(tmp_path, dict(
+            stamp, format=self.compiled_format,
+            sha256=self.file_sha256(source)))
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        return path
+
+    @staticmethod
+    def source_stamp(filename):
+        """
+        Return the absolute path, the size and the mtime of a file, which
+        tell whether the file has changed since.
+        """
+        stat = os.stat(filename)
+        return {"source": os.path.abspath(filename), "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns}
+
+    @staticmethod
+    def saved_model_changes(path, params, ratings_file=None):
+        """
+        Compare the model saved in the directory path with the wanted one.
+        Return the names of the entries of the dict params that are not None
+        and differ from the saved meta.json, plus "ratings_file" if
+        ratings_file is given and differs from (or has changed since) the
+        file the model was trained on.
+
+        >>> import shutil, tempfile
+        >>> from RecSysBaseLine import RecSysBaseLine
+        >>> recsys = RecSysBaseLine()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> path = tempfile.mkdtemp()
+        >>> recsys.save_model(path)
+        >>> Repo.saved_model_changes(
+        ...     path, {"model": "BLRS"}, "testcase_ratings.csv")
+        []
+        >>> Repo.saved_model_changes(
+        ...     path, {"model": "ARS", "rank": None}, "testcase_ratings_1.csv")
+        ['model', 'ratings_file']
+        >>> shutil.rmtree(path)
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        changes = [name for name, value in params.items()
+                   if value is not None and meta.get(name) != value]
+        if ratings_file is not None and \
+                meta.get("ratings_source") != Repo.source_stamp(ratings_file):
+            changes.append("ratings_file")
+        return changes
+
+    def load_or_train(self, model_path, ratings_file, params={}):
+        """
+        Load the model saved in the directory model_path if there is one and
+        saved_model_changes() finds no change in params or ratings_file.
+        Otherwise train the model from ratings_file, and save it into
+        model_path if that is given. Return True if the saved model was
+        loaded. Raise ValueError if the saved model is not params["model"],
+        or if it cannot be used and there is no ratings_file to train from.
+
+        >>> import shutil, tempfile
+        >>> from RecSysBaseLine import RecSysBaseLine
+        >>> path = tempfile.mkdtemp()
+        >>> recsys = RecSysBaseLine()
+        >>> recsys.load_or_train(path, "testcase_ratings.csv",
+        ...                      {"model": "BLRS"})
+        False
+        >>> loaded = RecSysBaseLine()
+        >>> loaded.load_or_train(path, None, {"model": "BLRS"})
+        True
+        >>> loaded.util_mat.nnz == recsys.util_mat.nnz
+        True
+        >>> loaded.load_or_train(path, None, {"model": "ARS"})
+        ... # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        ValueError: the model saved in ... is not ARS
+        >>> shutil.rmtree(path)
+        """
+
+        saved = model_path is not None and \
+            os.path.exists(os.path.join(model_path, "meta.json"))
+        if saved:
+            changes = self.saved_model_changes(
+                    model_path, params, ratings_file)
+            if "model" in changes:
+                raise ValueError("the model saved in {} is not {}".format(
+                    model_path, params["model"]))
+            if changes and ratings_file is None:
+                raise ValueError(
+                    "{} changed since the model in {} was saved, and no "
+                    "rating file is given to train it again".format(
+                        ", ".join(changes), model_path))
+            if changes:
+                print("### {} changed since the model was saved, training "
+                      "it again".format(", ".join(changes)))
+                saved = False
+        elif ratings_file is None:
+            raise ValueError("a rating file or a saved model is required")
+
+        if saved:
+            self.load_model(model_path)
+        else:
+            self.load_ratings(ratings_file)
+            if model_path is not None:
+                self.save_model(model_path)
+        return saved
+
+    @staticmethod
+    def file_sha256(filename):
+        """
+        Return the SHA-256 hex digest of the content of the file.
+        """
+        digest = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def save_compiled(self, path, meta={}):
+        """
+        Save util_mat, its CSC copy, the users' rating means and counts, the
+        ID tables and the Time/Fold columns (if any) into the directory path
+        as .npy files, together with meta in meta.json.
+        """
+
+        os.makedirs(path, exist_ok=True)
+        csc = self.util_mat_csc if self.util_mat_csc is not None \
+            else self.util_mat.tocsc()
+        arrays = {
+            "indptr": self.util_mat.indptr,
+            "indices": self.util_mat.indices,
+            "data": self.util_mat.data,
+            "csc_indptr": csc.indptr,
+            "csc_indices": csc.indices,
+            "csc_data": csc.data,
+            "user_rating_means": np.asarray(self.user_rating_means),
+            "user_rating_counts": np.asarray(self.user_rating_counts),
+            "user_ids": self.user_ids.ids
+            if isinstance(self.user_ids, CompactIds)
+            else np.array(self.user_ids, dtype=str),
+            "item_ids": self.item_ids.ids
+            if isinstance(self.item_ids, CompactIds)
+            else np.array(self.item_ids, dtype=str),
+            "rating_times": self.rating_times,
+            "rating_folds": self.rating_folds,
+        }
+        for name, array in arrays.items():
+            if array is not None:
+                np.save(os.path.join(path, name + ".npy"), array)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(dict(meta, shape=list(self.util_mat.shape)), f)
+
+    def load_compiled(
+            self, path, use_exist_mapping=False, parse_time_fold=False,
+            mmap_mode="r"):
+        """
+        Load the ratings saved by save_compiled() from the directory path.
+
+        If there are no ID mappings yet, the arrays are memory-mapped and used
+        as they are, so that loading takes nearly no time and processes can
+        share the same pages. This includes the CSC copy of util_mat, which
+        is only built in memory for copies saved without it. Otherwise, the
+        saved IDs are mapped to (or added to) the current mappings, and
+        util_mat is rebuilt accordingly.
+        """
+
+        def load(name):
+            filename = os.path.join(path, name + ".npy")
+            if not os.path.exists(filename):
+                return None
+            return np.load(filename, mmap_mode=mmap_mode)
+
+        indptr, indices, data = load("indptr"), load("indices"), load("data")
+        means, counts = load("user_rating_means"), load("user_rating_counts")
+        user_ids, item_ids = load("user_ids"), load("item_ids")
+        times = load("rating_times") if parse_time_fold else None
+        folds = load("rating_folds") if parse_time_fold else None
+
+        if user_ids.dtype.kind == "S" and not self.compact:
+            user_ids = np.char.decode(user_ids, "utf-8")
+            item_ids = np.char.decode(item_ids, "utf-8")
+        if not use_exist_mapping and len(self.user_ids) == 0 and \
+                len(self.item_ids) == 0:
+            # the compact tables use the saved arrays as they are
+            self.user_ids, self.user_id_map = self.new_id_tables(
+                    user_ids if self.compact else user_ids.tolist())
+            self.item_ids, self.item_id_map = self.new_id_tables(
+                    item_ids if self.compact else item_ids.tolist())
+            if data.dtype != self.rating_dtype():
+                data = data.astype(self.rating_dtype())
+            shape = (len(self.user_ids), len(self.item_ids))
+            self.util_mat = csr_matrix(
+                    (data, indices, indptr), shape=shape, copy=False)
+            self.rated_mats = None
+            self.util_mat_csc = None
+            csc_data = load("csc_data")
+            if self.keep_csc and csc_data is not None:
+                if csc_data.dtype != self.rating_dtype():
+                    csc_data = csc_data.astype(self.rating_dtype())
+                self.util_mat_csc = csc_matrix(
+                        (csc_data, load("csc_indices"), load("csc_indptr")),
+                        shape=shape, copy=False)
+            elif self.keep_csc:
+                self.util_mat_csc = self.util_mat.tocsc()
+            self.rating_times = times
+            self.rating_folds = folds
+            self.user_rating_means = means
+            self.user_rating_counts = counts
+            return
+
+        # map the saved indices to the current ones
+        user_map = self.factorize_ids(
+                user_ids, self.user_id_map, self.user_ids, use_exist_mapping)
+        item_map = self.factorize_ids(
+                item_ids, self.item_id_map, self.item_ids, use_exist_mapping)
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        self.set_ratings(
+                user_map[rows], item_map[indices], np.asarray(data),
+                times, folds)
+
+        user_map = user_map[:len(counts)]
+        self.user_rating_counts = np.bincount(user_map, weights=counts)
+        self.user_rating_means = np.bincount(
+                user_map, weights=means * counts) / self.user_rating_counts
+
+    def set_ratings(self, users, items, ratings, times=None, folds=None):
+        """
+        Build util_mat (and its CSC copy) from parallel arrays of user
+        indices, item indices and ratings. Repeated (user, item) pairs are
+        summed, and zero ratings are dropped. times and folds, if given, are
+        reordered to align with util_mat.data (the first of the repeated pairs
+        is kept) and stored in rating_times and rating_folds.
+        """
+
+        num_users, num_items = len(self.user_ids), len(self.item_ids)
+        self.rating_times = None
+        self.rating_folds = None
+
+        if times is None and folds is None:
+            self.util_mat = csr_matrix(
+                    (ratings, (users, items)),
+                    dtype=self.rating_dtype(),
+                    shape=(num_users, num_items))
+            self.util_mat.eliminate_zeros()
+            self.util_mat.sort_indices()
+        else:
+            # sort the ratings by (user, item) and merge the repeated pairs,
+            # keeping track of where each of them comes from
+            order = np.lexsort((items, users))
+            users, items = users[order], items[order]
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = (users[1:] != users[:-1]) | (items[1:] != items[:-1])
+            starts = np.flatnonzero(first)
+            data = np.add.reduceat(ratings[order].astype(float), starts) \
+                if len(starts) else np.zeros(0)
+            keep = data != 0
+            starts = starts[keep]
+            users, items, order = users[starts], items[starts], order[starts]
+
+            index_dtype = np.int32 if len(order) < 2**31 else np.int64
+            indptr = np.zeros(num_users + 1, dtype=index_dtype)
+            np.cumsum(np.bincount(users, minlength=num_users), out=indptr[1:])
+            self.util_mat = csr_matrix(
+                    (data[keep].astype(self.rating_dtype()),
+                     items.astype(index_dtype), indptr),
+                    shape=(num_users, num_items))
+            if times is not None:
+                self.rating_times = times[order]
+            if folds is not None:
+                self.rating_folds = folds[order]
+
+        self.util_mat_changed()
+
+    @staticmethod
+    def split_chunk(chunk, max_columns=5):
+        """
+        Split a chunk of lines of comma-separated tokens (in bytes) into a
+        list of columns, each a numpy bytes array. The positions of all the
+        delimiters are found at once, and each column is gathered from the
+        chunk one character position at a time. Empty lines are skipped. If
+        the lines have different numbers of tokens, only the common columns
+        are kept. At most max_columns columns are returned.
+
+        >>> Repo.split_chunk(b"U1,I4,2.0\\r\\nU2,I10,3.0\\n\\n")
+        ... # doctest: +NORMALIZE_WHITESPACE
+        [array([b'U1', b'U2'], dtype='|S2'),
+         array([b'I4', b'I10'], dtype='|S3'),
+         array([b'2.0', b'3.0'], dtype='|S3')]
+        """
+
+        buf = np.frombuffer(chunk, dtype=np.uint8)
+        buf = buf[buf != ord("\r")]
+        if len(buf) > 0 and buf[-1] != ord("\n"):
+            buf = np.append(buf, np.uint8(ord("\n")))
+
+        # drop empty lines
+        newlines = buf == ord("\n")
+        empty = newlines.copy()
+        empty[1:] &= newlines[:-1]
+        buf = buf[~empty]
+        if len(buf) == 0:
+            return []
+
+        newlines = np.flatnonzero(buf == ord("\n"))
+        ends = np.flatnonzero((buf == ord(",")) | (buf == ord("\n")))
+        num_lines = len(newlines)
+        num_columns = len(ends) // num_lines
+        if num_columns * num_lines != len(ends) or \
+                not np.array_equal(ends[num_columns - 1::num_columns],
+                                   newlines):
+            # lines of different lengths, only keep the common columns
+            rows = [line.split(b",") for line in buf.tobytes().splitlines()]
+            num_columns = min(len(row) for row in rows)
+            return [np.array([row[i] for row in rows])
+                    for i in range(min(num_columns, max_columns))]
+
+        ends = ends.reshape(num_lines, num_columns)
+        starts = np.empty_like(ends)
+        starts[0, 0] = 0
+        starts[1:, 0] = ends[:-1, -1] + 1
+        starts[:, 1:] = ends[:, :-1] + 1
+
+        columns = []
+        for i in range(min(num_columns, max_columns)):
+            lengths = ends[:, i] - starts[:, i]
+            width = max(int(lengths.max()), 1)
+            column = np.zeros((num_lines, width), dtype=np.uint8)
+            for j in range(width):
+                column[:, j] = np.where(
+                        lengths > j,
+                        buf[np.minimum(starts[:, i] + j, len(buf) - 1)], 0)
+            columns.append(column.view("S{}".format(width)).ravel())
+        return columns
+
+    @staticmethod
+    def factorize_ids(ids, id_map, id_list, use_exist_mapping):
+        """
+        Return the indices of the given IDs (a numpy bytes or str array) as an
+        int32 array. The IDs are deduplicated by np.unique, so only the
+        distinct IDs are looked up in id_map. Unseen IDs are appended to
+        id_list and id_map in the order they are first seen, unless
+        use_exist_mapping is True, in which case every ID must be known.
+
+        >>> id_map, id_list = {'U3': 0}, ['U3']
+        >>> ids = np.array([b'U1', b'U3', b'U1', b'U2'])
+        >>> Repo.factorize_ids(ids, id_map, id_list, False)
+        array([1, 0, 1, 2], dtype=int32)
+        >>> id_list
+        ['U3', 'U1', 'U2']
+        """
+
+        # IDs of at most 8 bytes are sorted as integers, which is much faster
+        keys = ids.astype("S8").view(np.uint64) \
+            if ids.dtype.kind == "S" and ids.dtype.itemsize <= 8 else ids
+        uniques, first, inverse = np.unique(
+                keys, return_index=True, return_inverse=True)
+        if uniques.dtype == np.uint64:
+            uniques = uniques.view("S8")
+        if isinstance(id_list, CompactIds):
+            # look up all the distinct IDs at once, and append the unseen
+            # ones in the order they are first seen
+            codes = id_list.lookup(uniques).astype(np.int32)
+            unseen = np.flatnonzero(codes < 0)
+            if len(unseen) > 0:
+                if use_exist_mapping:
+                    raise KeyError(CompactIds.encode(uniques[unseen[:1]])[0]
+                                   .decode())
+                unseen = unseen[np.argsort(first[unseen], kind='stable')]
+                codes[unseen] = np.arange(
+                        len(id_list), len(id_list) + len(unseen))
+                id_list.extend(uniques[unseen])
+            return codes[inverse.ravel()]
+
+        codes = np.empty(len(uniques), dtype=np.int32)
+        # visit the distinct IDs in the order they are first seen
+        for i in np.argsort(first, kind='stable'):
+            id_ = uniques[i]
+            id_ = id_.decode() if isinstance(id_, bytes) else str(id_)
+            if not use_exist_mapping and id_ not in id_map:
+                id_map[id_] = len(id_list)
+                id_list.append(id_)
+            codes[i] = id_map[id_]
+        return codes[inverse.ravel()]
+
+
+class CompactIds():
+    """
+    A compact table of IDs, used by Repo.set_compact() in place of the lists
+    user_ids and item_ids (index -> ID). CompactIdMap gives the matching
+    view in place of the dicts user_id_map and item_id_map (ID -> index).
+
+    The IDs are kept in one numpy bytes array in index order, plus a sorted
+    copy with the index of every ID, so find() looks up one ID by a binary
+    search and lookup() finds many of them with one np.searchsorted(). This
+    takes a few tens of bytes per ID instead of the hundreds of a dict and a
+    list of Python strings.
+
+    >>> ids = CompactIds(['U3', 'U1'])
+    >>> ids.extend(['U20', 'U2'])
+    >>> ids[2], len(ids), ids[1:]
+    ('U20', 4, ['U1', 'U20', 'U2'])
+    >>> ids.lookup(['U1', 'U9', 'U2', 'U200'])
+    array([ 1, -1,  3, -1])
+    >>> ids.find('U20'), ids.find('U200'), ids.find(b'U2')
+    (2, -1, 3)
+    >>> id_map = CompactIdMap(ids)
+    >>> id_map['U3'], 'U9' in id_map, id_map.get('U9', -1)
+    (0, False, -1)
+    """
+
+    def __init__(self, ids=()):
+        self.ids = self.encode(ids)  # the IDs in index order
+        # the IDs in sorted order, and their indices
+        self.sorted_idxs = np.argsort(self.ids, kind='stable').astype(
+                np.int32 if len(self.ids) < 2**31 else np.int64)
+        self.sorted_ids = self.ids[self.sorted_idxs]
+
+    @staticmethod
+    def encode(ids):
+        """
+        Return the IDs as a numpy bytes array (UTF-8).
+        """
+        if isinstance(ids, CompactIds):
+            return ids.ids
+        ids = np.asarray(ids)
+        if len(ids) == 0:
+            return np.zeros(0, dtype="S1")
+        if ids.dtype.kind != "S":
+            ids = np.char.encode(ids.astype(str), "utf-8")
+        return ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [id_.decode() for id_ in self.ids[idx]]
+        return self.ids[idx].decode()
+
+    def __iter__(self):
+        return (id_.decode() for id_ in self.ids)
+
+    def tolist(self):
+        return list(self)
+
+    def find(self, id_):
+        """
+        Return the index of one ID, -1 if it is not in the table. This is
+        the fast path of single lookups, by bisect on the sorted IDs.
+        """
+        key = id_ if isinstance(id_, bytes) else str(id_).encode("utf-8")
+        pos = bisect.bisect_left(self.sorted_ids, key)
+        if pos < len(self.sorted_ids) and self.sorted_ids[pos] == key:
+            return int(self.sorted_idxs[pos])
+        return -1
+
+    def lookup(self, ids):
+        """
+        Return the indices of the given IDs in an array, -1 for the IDs that
+        are not in the table.
+        """
+        keys = self.encode(ids)
+        if len(keys) == 0 or len(self.ids) == 0:
+            return np.full(len(keys), -1)
+        width = self.sorted_ids.dtype.itemsize
+        if keys.dtype.itemsize > width:
+            # longer IDs cannot be in the table; cut them to the width of
+            # the table only after marking them
+            too_long = np.char.str_len(keys) > width
+            keys = keys.astype(self.sorted_ids.dtype)
+        else:
+            too_long = np.zeros(len(keys), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.sorted_ids, keys),
+                         len(self.sorted_ids) - 1)
+        found = (self.sorted_ids[pos] == keys) & ~too_long
+        return np.where(found, self.sorted_idxs[pos], -1).astype(int)
+
+    def extend(self, ids):
+        """
+        Append new IDs, which must be distinct and not in the table yet.
+        """
+        new_ids = self.encode(ids)
+        if len(new_ids) == 0:
+            return
+        new_idxs = np.arange(len(self.ids), len(self.ids) + len(new_ids))
+        self.ids = np.concatenate((self.ids, new_ids))
+        if self.sorted_ids.dtype != self.ids.dtype:
+            self.sorted_ids = self.sorted_ids.astype(self.ids.dtype)
+
+        # merge the new IDs into the sorted copy
+        order = np.argsort(new_ids, kind='stable')
+        new_ids = new_ids[order].astype(self.ids.dtype)
+        pos = np.searchsorted(self.sorted_ids, new_ids)
+        self.sorted_ids = np.insert(self.sorted_ids, pos, new_ids)
+        if len(self.ids) >= 2**31:
+            self.sorted_idxs = self.sorted_idxs.astype(np.int64)
+        self.sorted_idxs = np.insert(self.sorted_idxs, pos, new_idxs[order])
+
+    def append(self, id_):
+        self.extend([id_])
+
+
+class CompactIdMap():
+    """
+    The ID -> index view of a CompactIds, with the dict operations used on
+    user_id_map and item_id_map. New IDs are added to the CompactIds.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, id_):
+        idx = self.table.find(id_)
+        if idx < 0:
+            raise KeyError(id_)
+        return idx
+
+    def __contains__(self, id_):
+        return self.table.find(id_) >= 0
+
+    def get(self, id_, default=None):
+        idx = self.table.find(id_)
+        return idx if idx >= 0 else default
+
+
+class Profiler():
+    """
+    Opt-in instrumentation: phase timers, call counters and observed sizes,
+    reported as JSON. A disabled profiler (the default) costs one attribute
+    check per call site. With track_memory, the peak memory above the start
+    of every phase is measured by tracemalloc, which slows down allocations.
+
+    >>> profiler = Profiler(enabled=True, track_memory=True)
+    >>> with profiler.phase("outer"):
+    ...     with profiler.phase("inner"):
+    ...         block = np.ones(2**20)
+    ...     del block
+    >>> profiler.count("calls", 3)
+    >>> profiler.observe("size", 4)
+    >>> profiler.observe("size", 2)
+    >>> report = profiler.report()
+    >>> report["phases"]["outer"]["calls"], report["counters"]
+    (1, {'calls': 3})
+    >>> report["phases"]["outer"]["peak_bytes"] >= 8 * 2**20
+    True
+    >>> report["observations"]["size"]
+    {'count': 2, 'total': 6, 'min': 2, 'max': 4, 'mean': 3.0}
+    >>> off = Profiler()
+    >>> with off.phase("outer"):
+    ...     off.count("calls")
+    >>> off.report()["phases"], off.report()["counters"]
+    ({}, {})
+    """
+
+    null_phase = contextlib.nullcontext()
+
+    def __init__(self, enabled=False, track_memory=False):
+        self.enabled = enabled
+        self.track_memory = track_memory
+        self.reset()
+
+    def reset(self):
+        self.phases = {}  # name -> calls, total_sec, max_sec, peak_bytes
+        self.counters = {}  # name -> count
+        self.observations = {}  # name -> count, total, min, max
+        self.memory_stack = []  # memory peaks of the open phases
+        self.start_time = time.time()
+
+    def phase(self, name):
+        """
+        Return a context manager timing the phase name. Phases can nest.
+        """
+        if not self.enabled:
+            return self.null_phase
+        return self.timed_phase(name)
+
+    @contextlib.contextmanager
+    def timed_phase(self, name):
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            # the peak so far belongs to the enclosing phase
+            start_memory, peak = tracemalloc.get_traced_memory()
+            if self.memory_stack:
+                self.memory_stack[-1] = max(self.memory_stack[-1], peak)
+            tracemalloc.reset_peak()
+            self.memory_stack.append(start_memory)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            stats = self.phases.setdefault(
+                    name, {"calls": 0, "total_sec": 0., "max_sec": 0.})
+            stats["calls"] += 1
+            stats["total_sec"] += elapsed
+            stats["max_sec"] = max(stats["max_sec"], elapsed)
+            if self.track_memory:
+                peak = max(self.memory_stack.pop(),
+                           tracemalloc.get_traced_memory()[1])
+                stats["peak_bytes"] = max(stats.get("peak_bytes", 0),
+                                          peak - start_memory)
+                if self.memory_stack:
+                    self.memory_stack[-1] = max(self.memory_stack[-1], peak)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """
+        Record one observation of a size, such as a candidate set size.
+        """
+        if not self.enabled:
+            return
+        stats = self.observations.get(name)
+        if stats is None:
+            self.observations[name] = {
+                "count": 1, "total": value, "min": value, "max": value}
+        else:
+            stats["count"] += 1
+            stats["total"] += value
+            stats["min"] = min(stats["min"], value)
+            stats["max"] = max(stats["max"], value)
+
+    def merge(self, other):
+        """
+        Add the records of another Profiler (e.g. of a worker process).
+        """
+        for name, other_stats in other.phases.items():
+            stats = self.phases.setdefault(
+                    name, {"calls": 0, "total_sec": 0., "max_sec": 0.})
+            stats["calls"] += other_stats["calls"]
+            stats["total_sec"] += other_stats["total_sec"]
+            stats["max_sec"] = max(stats["max_sec"], other_stats["max_sec"])
+            if "peak_bytes" in other_stats:
+                stats["peak_bytes"] = max(stats.get("peak_bytes", 0),
+                                          other_stats["peak_bytes"])
+        for name, value in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        for name, other_stats in other.observations.items():
+            stats = self.observations.get(name)
+            if stats is None:
+                self.observations[name] = dict(other_stats)
+            else:
+                stats["count"] += other_stats["count"]
+                stats["total"] += other_stats["total"]
+                stats["min"] = min(stats["min"], other_stats["min"])
+                stats["max"] = max(stats["max"], other_stats["max"])
+
+    def report(self):
+        """
+        Return all the records in a JSON-serializable dict.
+        """
+        phases = {}
+        for name, stats in self.phases.items():
+            phases[name] = dict(stats)
+            phases[name]["mean_sec"] = stats["total_sec"] / stats["calls"]
+        observations = {}
+        for name, stats in self.observations.items():
+            observations[name] = dict(stats)
+            observations[name]["mean"] = stats["total"] / stats["count"]
+        return {"wall_sec": time.time() - self.start_time,
+                "phases": phases,
+                "counters": dict(self.counters),
+                "observations": observations}
+
+    def dump(self, filename):
+        """
+        Write report() to a JSON file.
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2, default=float)
+
+
+class TopKCache():
+    """
+    A bounded LRU cache of top-k recommendation lists. A key (usually
+    (model_version, user_idx, max_candidates)) maps to the top k list of
+    the largest k computed so far, so a request of a smaller k is answered
+    by a prefix of it. A list shorter than its k holds all the candidates,
+    so it answers any k. The least recently used entries are evicted when
+    there are more than max_entries entries, or more than max_bytes
+    estimated bytes (None means no bound). Counters of hits, misses,
+    evictions and invalidations are kept, see stats().
+    """
+
+    entry_bytes = 200  # estimated overhead of an entry
+    pair_bytes = 100  # estimated size of an (item_idx, rating) pair
+
+    def __init__(self, max_entries=10000, max_bytes=None):
+        assert max_entries is None or max_entries > 0, \
+            "Bad parameter. max_entries = [{}]".format(max_entries)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (k, recommendations, bytes)
+        self.user_keys = {}  # user_idx -> keys of the user's entries
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, k):
+        """
+        Return the top k list cached for key, or None.
+
+        >>> cache = TopKCache(max_entries=2)
+        >>> cache.put((0, 1, None), 3, [(5, 4.), (6, 3.), (7, 2.)])
+        >>> cache.get((0, 1, None), 2), cache.get((0, 1, None), 4)
+        ([(5, 4.0), (6, 3.0)], None)
+        >>> cache.put((0, 2, None), 5, [(8, 1.)])
+        >>> cache.get((0, 2, None), 100)
+        [(8, 1.0)]
+        >>> cache.put((0, 3, None), 1, [(9, 1.)])
+        >>> cache.get((0, 1, None), 1) is None, len(cache.entries)
+        (True, 2)
+        >>> cache.invalidate_users([2])
+        >>> cache.stats()["invalidations"], cache.stats()["evictions"]
+        (1, 1)
+        """
+        entry = self.entries.get(key)
+        if entry is None or (entry[0] < k and len(entry[1]) >= entry[0]):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1][:k]
+
+    def put(self, key, k, recommendations):
+        """
+        Cache the top k list of key, unless a longer list is cached already.
+        """
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] >= k:
+            return
+        self.remove(key)
+        recommendations = list(recommendations)
+        num_bytes = self.entry_bytes + self.pair_bytes * len(recommendations)
+        self.entries[key] = (k, recommendations, num_bytes)
+        self.user_keys.setdefault(key[1], set()).add(key)
+        self.num_bytes += num_bytes
+
+        while len(self.entries) > 1 and (
+                (self.max_entries is not None and
+                 len(self.entries) > self.max_entries) or
+                (self.max_bytes is not None and
+                 self.num_bytes > self.max_bytes)):
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.num_bytes -= entry[2]
+            self.user_keys[key[1]].discard(key)
+
+    def invalidate_users(self, user_idxs):
+        """
+        Drop the entries of the given users, whose ratings have changed.
+        """
+        for user_idx in user_idxs:
+            keys = self.user_keys.pop(int(user_idx), set())
+            for key in keys:
+                entry = self.entries.pop(key)
+                self.num_bytes -= entry[2]
+            self.invalidations += len(keys)
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self.user_keys.clear()
+        self.num_bytes = 0
+
+    def stats(self):
+        """
+        Return the size and the counters of the cache in a dict.
+        """
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "bytes": self.num_bytes,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations}
 
 
 class EvaMatrix():
     """
     A Class to store the values of all the evaluation matrics.
     Class-wise addition and division functions are provided.
+    The XX@K metrics of every evaluated user are also kept, one row per user
+    and one column per K, in user_p_at_k, user_r_at_k, user_mrr_at_k and
+    user_ndcg_at_k.
+    The XX@K metrics of the sampled-negative protocol (see
+    EvaSys.set_sampled()), if computed, are in another EvaMatrix, sampled.
     """
 
     def __init__(self, positions):
@@ -184,6 +1712,180 @@ class EvaMatrix():
         self.mrr_at_k = np.zeros(len(positions))
         self.ndcg_at_k = np.zeros(len(positions))
         self.time = 0
+        self.users = np.zeros(0, dtype=int)  # The user_idx of each row
+        self.user_p_at_k = np.zeros((0, len(positions)))
+        self.user_r_at_k = np.zeros((0, len(positions)))
+        self.user_mrr_at_k = np.zeros((0, len(positions)))
+        self.user_ndcg_at_k = np.zeros((0, len(positions)))
+        # The discount of each rank in DCG
+        self.discounts = 1. / np.log(np.arange(np.amax(positions)) + 2)
+        self.exact = True  # Whether the exact XX@K metrics are computed
+        self.sampled = None  # The EvaMatrix of the sampled XX@K metrics
+        self.num_negatives = None  # The negatives per positive, if sampled
+
+    def set_rankings(self, recommended, relevance, users=None):
+        """
+        Compute P@K, R@K, MRR@K and nDCG@K of every K in positions for a
+        batch of users.
+        recommended: (users x largest K) array of the recommended item_idx
+                     of each user in rank order, padded with -1
+        relevance: sparse matrix whose nonzero entries in the u-th row are
+                   the relevant items of the u-th row of recommended
+        users: the user_idx of each row, kept for user-level dumps
+
+        The metrics come from the cumulative hit counts along the ranks. The
+        metrics of every user are kept, and their sums are added to p_at_k,
+        r_at_k, mrr_at_k and ndcg_at_k, to be divided by avg() later.
+
+        >>> from scipy.sparse import csr_matrix
+        >>> eva = EvaMatrix([1, 3])
+        >>> recommended = np.array([[4, 2, 7], [1, 5, -1], [3, 0, 6]])
+        >>> relevance = csr_matrix(([1., 1., 1.], ([0, 0, 1], [2, 9, 1])),
+        ...                        shape=(3, 10))
+        >>> eva.set_rankings(recommended, relevance, [5, 6, 7])
+        >>> eva.user_p_at_k
+        array([[0.        , 0.33333333],
+               [1.        , 0.33333333],
+               [0.        , 0.        ]])
+        >>> eva.user_mrr_at_k[:, 1]
+        array([0.5, 1. , 0. ])
+        >>> eva.r_at_k
+        array([1. , 1.5])
+        >>> ["%.4f" %val for val in eva.user_ndcg_at_k[:, 1]]
+        ['0.2961', '0.6131', '0.0000']
+        """
+
+        recommended = np.asarray(recommended)
+        relevance = csr_matrix(relevance)
+        relevance.sum_duplicates()
+        num_users, largest_k = recommended.shape
+        positions = np.asarray(self.positions)
+        num_items = relevance.shape[1]
+        is_recommended = recommended >= 0
+
+        # Look up the hits by the sorted keys (row * num_items + item) of the
+        # relevant items
+        relevant_keys = np.repeat(
+                np.arange(num_users, dtype=np.int64),
+                np.diff(relevance.indptr)) * num_items + relevance.indices
+        keys = np.arange(num_users, dtype=np.int64)[:, None] * num_items \
+            + recommended
+        found = np.searchsorted(relevant_keys, keys)
+        found = np.minimum(found, max(len(relevant_keys) - 1, 0))
+        hits = is_recommended & (len(relevant_keys) > 0)
+        if len(relevant_keys) > 0:
+            hits &= relevant_keys[found] == keys
+
+        # Cumulative hit counts and DCG along the ranks, read at each K
+        cum_hits = np.cumsum(hits, axis=1)[:, positions - 1]
+        cum_dcg = np.cumsum(hits * self.discounts[:largest_k], axis=1)
+        cum_dcg = cum_dcg[:, positions - 1]
+        # The ideal DCG assumes a hit at every recommended rank
+        ideal = np.concatenate(([0.], np.cumsum(self.discounts)))
+        num_recommended = is_recommended.sum(axis=1)
+        idcg = ideal[np.minimum(positions[None, :], num_recommended[:, None])]
+
+        num_relevant = np.diff(relevance.indptr)[:, None]
+        first_hit = np.where(hits.any(axis=1), hits.argmax(axis=1), largest_k)
+        self.users = np.asarray(
+                users if users is not None else np.arange(num_users))
+        self.user_p_at_k = cum_hits / positions
+        self.user_r_at_k = np.divide(
+                cum_hits, num_relevant, out=np.zeros(cum_hits.shape),
+                where=num_relevant > 0)
+        self.user_mrr_at_k = np.where(
+                first_hit[:, None] < positions, 1. / (first_hit[:, None] + 1),
+                0.)
+        self.user_ndcg_at_k = np.divide(
+                cum_dcg, idcg, out=np.zeros(cum_dcg.shape), where=idcg > 0)
+
+        self.p_at_k = self.p_at_k + self.user_p_at_k.sum(axis=0)
+        self.r_at_k = self.r_at_k + self.user_r_at_k.sum(axis=0)
+        self.mrr_at_k = self.mrr_at_k + self.user_mrr_at_k.sum(axis=0)
+        self.ndcg_at_k = self.ndcg_at_k + self.user_ndcg_at_k.sum(axis=0)
+
+    def set_sampled_ranks(self, ranks, num_candidates, users=None):
+        """
+        Compute the XX@K metrics of positive items ranked against sampled
+        negatives, one row per positive.
+        ranks: the zero-based rank of each positive among its candidates,
+               i.e. the number of its negatives ranked ahead of it
+        num_candidates: the number of candidates ranked, the positive and
+                        its negatives
+        users: the user_idx of each positive
+
+        Every row is passed to set_rankings() as a recommendation list of
+        the candidates with a single relevant item at its rank, so the
+        metrics are defined as the exact ones.
+
+        >>> eva = EvaMatrix([1, 3])
+        >>> eva.set_sampled_ranks([0, 2, 5], 101)
+        >>> eva.user_r_at_k
+        array([[1., 1.],
+               [0., 1.],
+               [0., 0.]])
+        >>> eva.user_mrr_at_k[:, 1]
+        array([1.        , 0.33333333, 0.        ])
+        """
+
+        ranks = np.asarray(ranks, dtype=int)
+        largest_k = np.amax(self.positions)
+        # item 0 is the positive and item 1 stands for the negatives
+        recommended = np.ones((len(ranks), largest_k), dtype=int)
+        recommended[:, num_candidates:] = -1
+        is_hit = ranks < largest_k
+        recommended[np.flatnonzero(is_hit), ranks[is_hit]] = 0
+        relevance = csr_matrix(
+                (np.ones(len(ranks)),
+                 (np.arange(len(ranks)), np.zeros(len(ranks), dtype=int))),
+                shape=(len(ranks), 2))
+        self.set_rankings(recommended, relevance, users)
+
+    def user_metrics(self):
+        """
+        Return the per-user metrics as a dict from the metric name to an
+        array with one row per user and one column per K.
+        """
+        return {"P": self.user_p_at_k, "R": self.user_r_at_k,
+                "MRR": self.user_mrr_at_k, "NDCG": self.user_ndcg_at_k}
+
+    def user_mean(self):
+        """
+        Return the mean over the users of each XX@K metric, in a dict like
+        user_metrics().
+        """
+        return {name: values.mean(axis=0) if len(values) else values.sum(0)
+                for name, values in self.user_metrics().items()}
+
+    def user_var(self):
+        """
+        Return the variance over the users of each XX@K metric, in a dict
+        like user_metrics().
+
+        >>> eva = EvaMatrix([1])
+        >>> eva.user_p_at_k = np.array([[1.], [0.], [0.], [1.]])
+        >>> eva.user_var()["P"], eva.user_mean()["P"]
+        (array([0.25]), array([0.5]))
+        """
+        return {name: values.var(axis=0) if len(values) else values.sum(0)
+                for name, values in self.user_metrics().items()}
+
+    def dump_users(self, filename, user_ids=None):
+        """
+        Write the metrics of every user to a CSV file with one line per user
+        (and per fold, after accumulate()). The users are written by their
+        user_idx, or by their ID if the list user_ids is given.
+        """
+        metrics = self.user_metrics()
+        with open(filename, 'w') as f:
+            f.write(",".join(["user"] + [
+                "{}@{}".format(name, k) for name in metrics
+                for k in self.positions]) + "\n")
+            values = np.hstack(list(metrics.values()))
+            for user_idx, row in zip(self.users, values):
+                user = user_ids[user_idx] if user_ids is not None else user_idx
+                f.write(",".join([str(user)] + [
+                    "{:.6f}".format(val) for val in row]) + "\n")
 
     def accumulate(self, mat):
         """
@@ -214,6 +1916,19 @@ class EvaMatrix():
         self.mrr_at_k = np.add(self.mrr_at_k, mat.mrr_at_k)
         self.ndcg_at_k = np.add(self.ndcg_at_k, mat.ndcg_at_k)
         self.time += mat.time
+        self.users = np.concatenate((self.users, mat.users))
+        self.user_p_at_k = np.vstack((self.user_p_at_k, mat.user_p_at_k))
+        self.user_r_at_k = np.vstack((self.user_r_at_k, mat.user_r_at_k))
+        self.user_mrr_at_k = np.vstack(
+                (self.user_mrr_at_k, mat.user_mrr_at_k))
+        self.user_ndcg_at_k = np.vstack(
+                (self.user_ndcg_at_k, mat.user_ndcg_at_k))
+        self.exact = mat.exact
+        self.num_negatives = mat.num_negatives
+        if mat.sampled is not None:
+            if self.sampled is None:
+                self.sampled = EvaMatrix(self.positions)
+            self.sampled.accumulate(mat.sampled)
 
     def avg(self, denom1, denom2):
         """
@@ -240,10 +1955,96 @@ class EvaMatrix():
         self.mrr_at_k /= denom2
         self.ndcg_at_k /= denom2
         self.time /= 1.
+        if self.sampled is not None:
+            self.sampled.avg(denom1, denom2)
 
-    def print_data(self):
-        print("RMSE = {:.2f}\nMAE  = {:.2f}".format(self.rmse, self.mae))
+    def print_rankings(self):
         print(
             "P@K    = {}\nR@K    = {}\nMRR@K  = {}\nNDCG@K = {}".format(
                 self.p_at_k, self.r_at_k, self.mrr_at_k, self.ndcg_at_k))
+
+    def print_data(self):
+        print("RMSE = {:.2f}\nMAE  = {:.2f}".format(self.rmse, self.mae))
+        if self.exact:
+            self.print_rankings()
+        if self.sampled is not None:
+            print("Sampled, {} negatives per positive:".format(
+                self.sampled.num_negatives))
+            self.sampled.print_rankings()
         print("time = {:.2f} Sec".format(self.time))
+
+
+def add_model_arguments(parser):
+    """
+    Add the arguments that choose, load and save the recommender system to
+    the argparse parser of a command line script. They are read back by
+    Repo.load_or_train().
+    """
+    parser.add_argument('-m', dest='model', metavar='model', type=str,
+                        required=True, choices=['BLRS', 'ARS'],
+                        help='The recommender system to use ("BLRS"|"ARS")')
+    parser.add_argument('-f', dest='file', metavar='file', type=str,
+                        help='The path of the rating file. Not required if \
+                                a saved model is given by --model-path.')
+    parser.add_argument('-r', dest='rank', metavar='rank', type=int,
+                        help='The rank for U, V in matrix factorization (50 \
+                                by default). Only applied in ARS.')
+    parser.add_argument('-s', dest='solver', metavar='solver', type=str,
+                        choices=['sgd', 'als', 'minibatch'],
+                        help='The solver for matrix factorization \
+                                ("sgd"|"als"|"minibatch", "sgd" by default). \
+                                Only applied in ARS.')
+    parser.add_argument('--compact', dest='compact', action='store_true',
+                        help='Keep the ID mappings in compact sorted arrays \
+                                and the ratings as float32, to save memory.')
+    parser.add_argument('--cache-dir', dest='cache_dir', metavar='cache_dir',
+                        type=str,
+                        help='The directory to keep compiled copies of the \
+                                rating files in. Later runs load them \
+                                memory-mapped instead of parsing the files.')
+    parser.add_argument('--model-path', dest='model_path',
+                        metavar='model_path', type=str,
+                        help='The directory of a saved model. If it exists, \
+                                the model is loaded (memory-mapped) from it \
+                                instead of being trained; otherwise the model \
+                                trained from the rating file is saved into \
+                                it. A saved model of a rating file that has \
+                                changed since, or of another rank or solver, \
+                                is trained and saved again.')
+
+
+def load_or_train_from_args(rec_sys, parser, args):
+    """
+    Set up rec_sys from the arguments added by add_model_arguments(), and
+    load or train it by Repo.load_or_train(). Only the rank and the solver
+    given on the command line are compared with a saved model. An error is
+    reported by parser.error().
+    """
+    params = {"model": args.model}
+    if args.model == "ARS":
+        params.update(rank=args.rank, solver=args.solver)
+    rec_sys.set_compact(args.compact)
+    rec_sys.set_cache_dir(args.cache_dir)
+    try:
+        rec_sys.load_or_train(args.model_path, args.file, params)
+    except ValueError as error:
+        parser.error(str(error))
+
+
+# The state of an export worker process, set up by init_export_worker()
+export_worker = {}
+
+
+def init_export_worker(rec_sys, k):
+    """
+    Set up a worker process of Repo.export_top_k().
+    """
+    export_worker.update(rec_sys=rec_sys, k=k)
+
+
+def run_export_worker(user_idxs):
+    """
+    Return the top-k recommendations of a block of users as text.
+    """
+    return export_worker["rec_sys"].format_top_k(
+            user_idxs, export_worker["k"])
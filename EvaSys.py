@@ -1,7 +1,12 @@
-import math
+import contextlib
+import copy
+import io
 import random
 import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
+from scipy.sparse import csr_matrix
 from Base import Repo
 from Base import EvaMatrix
 
@@ -21,12 +26,45 @@ class EvaSys(Repo):
         self.split_rating_files = []  # Array of the split filenames
         self.total_rating_file = ""  # Filename that contains all the ratings
         self.num_fold = 0
+        self.fold_ids = None  # The fold of each rating in util_mat.data
+        # The sampled negatives per positive test rating, None to skip the
+        # sampled ranking, see set_sampled()
+        self.num_negatives = None
+        self.exact_ranking = True  # Whether to rank the whole catalog
         super().__init__()
 
+    def set_sampled(self, num_negatives=100, exact=True):
+        """
+        Also evaluate the ranking with sampled negatives: every positive test
+        rating is ranked, by predict_ratings(), against num_negatives items
+        drawn at random from the items its user has not rated. Its XX@K
+        metrics are in the sampled member of the result of evaluate(),
+        alongside the exact ones.
+        If exact is False, the exact ranking of the whole catalog by
+        predict_top_k_recomm_batch(), whose cost grows with the number of
+        items, is skipped. num_negatives = None turns the sampled ranking
+        off.
+        """
+        assert num_negatives is None or num_negatives > 0, \
+            "Bad parameter. num_negatives = [{}]".format(num_negatives)
+        assert num_negatives is not None or exact, \
+            "Bad parameter. num_negatives = [None], exact = [False]"
+        self.num_negatives = num_negatives
+        self.exact_ranking = exact
+
     def load_split_ratings(self, split_files):
         """
-        Load the pre-split files.
+        Load the pre-split files. The k-th file becomes the k-th fold.
         split_files: filenames in array form
+
+        >>> evasys = EvaSys()
+        >>> evasys.load_split_ratings(["testcase_ratings_1.csv",
+        ...                            "testcase_ratings_2.csv",
+        ...                            "testcase_ratings_3.csv"])
+        >>> np.bincount(evasys.fold_ids)
+        array([27, 27, 26])
+        >>> evasys.get_user_idx('U8'), evasys.get_item_idx('I3')
+        (7, 19)
         """
 
         assert len(split_files) > 1, \
@@ -34,59 +72,94 @@ class EvaSys(Repo):
 
         self.split_rating_files = split_files
         self.num_fold = len(self.split_rating_files)
-        self.total_rating_file = "total_rating.csv"
-
-        # Combine all splits into one rating file and then load ratings
-        with open(self.total_rating_file, 'w') as outfile:
-            for f in self.split_rating_files:
-                    with open(f) as infile:
-                        for line in infile:
-                            outfile.write(line)
-        self.load_ratings(self.total_rating_file)
+
+        # Parse every split once, sharing (and extending) the ID mappings,
+        # then combine them in memory
+        users, items, ratings, folds = [], [], [], []
+        for fold, filename in enumerate(self.split_rating_files):
+            split = Repo()
+            split.set_keep_csc(False)
+            split.set_cache_dir(self.cache_dir)
+            split.user_id_map, split.item_id_map = \
+                self.user_id_map, self.item_id_map
+            split.user_ids, split.item_ids = self.user_ids, self.item_ids
+            split.load_ratings(filename)
+            coo = split.util_mat.tocoo()
+            users.append(coo.row)
+            items.append(coo.col)
+            ratings.append(coo.data)
+            folds.append(np.full(coo.nnz, fold, dtype=np.int32))
+
+        users = np.concatenate(users)
+        ratings = np.concatenate(ratings)
+        self.set_ratings(users, np.concatenate(items), ratings,
+                         folds=np.concatenate(folds))
+        self.fold_ids = self.rating_folds
+        self.user_rating_counts = np.bincount(users)
+        self.user_rating_means = np.bincount(users, weights=ratings)\
+            / self.user_rating_counts
 
     def load_total_ratings(self, num_fold, filename):
         """
         Load the ratings file and split it into num_fold folds.
+        Every user's ratings are spread evenly over the folds, in a random
+        order.
+
         >>> evasys = EvaSys()
         >>> evasys.load_total_ratings(3, "testcase_ratings.csv")
+        >>> np.bincount(evasys.fold_ids)
+        array([27, 27, 26])
         """
 
         self.total_rating_file = filename
         self.num_fold = num_fold
         self.load_ratings(self.total_rating_file)
-
-        # generate filenames for split files
-        for fold in range(num_fold):
-            self.split_rating_files.append(
-                    "ratings_split_" + str(fold + 1) + ".csv")
+        self.split_rating_files = []
 
         # generate an array for assignment
-        # each line in the rating_file will be assigned to different files
+        # each rating in util_mat will be assigned to different folds
         # according to the split map
         q, r = divmod(self.util_mat.nnz, num_fold)
         split_map = np.concatenate(
                 (np.tile(np.arange(num_fold), q), np.arange(r)))
 
+        # shuffle each user's ratings: sort the ratings by user (which keeps
+        # the row segments of util_mat) and then by a random key
         num_users = self.util_mat.shape[0]
-        begin = 0
-        end = 0
-        for user_idx in range(num_users):
-            # locate the region for shuffling
-            end = begin + self.util_mat[user_idx].count_nonzero()
-            # shuffle each user's ratings
-            np.random.shuffle(split_map[begin:end])
-            begin = end
-
-        # write each line in the rating_file to different split file
-        # according to the assignment array
-        fw = []
-        for fold in range(num_fold):
-            fw.append(open(self.split_rating_files[fold], 'w'))
-        with open(self.total_rating_file, 'r') as fr:
-            for i, line in enumerate(fr):
-                fw[split_map[i]].write(line)
-
-    def evaluate(self, rec_sys, positions, use_all_user=True, num_user=10):
+        rows = np.repeat(np.arange(num_users), np.diff(self.util_mat.indptr))
+        shuffled = np.lexsort((np.random.random(len(rows)), rows))
+        self.fold_ids = split_map[shuffled].astype(np.int32)
+
+    def split_fold(self, k):
+        """
+        k: zero-based index
+        Return a training matrix and a test matrix, where the ratings in the
+        k-th fold are the test data, and the ratings in the other folds are
+        the training data. Both are made by masking util_mat.
+
+        >>> evasys = EvaSys()
+        >>> evasys.load_total_ratings(3, "testcase_ratings.csv")
+        >>> training, test = evasys.split_fold(0)
+        >>> training.shape, training.nnz, test.nnz
+        ((8, 20), 53, 27)
+        """
+
+        mat = self.util_mat
+        rows = np.repeat(np.arange(mat.shape[0]), np.diff(mat.indptr))
+
+        def masked(mask):
+            indptr = np.zeros(mat.shape[0] + 1, dtype=mat.indptr.dtype)
+            np.cumsum(np.bincount(rows[mask], minlength=mat.shape[0]),
+                      out=indptr[1:])
+            return csr_matrix(
+                    (mat.data[mask], mat.indices[mask], indptr),
+                    shape=mat.shape)
+
+        is_test = self.fold_ids == k
+        return masked(~is_test), masked(is_test)
+
+    def evaluate(self, rec_sys, positions, use_all_user=True, num_user=10,
+                 export_files=False, workers=1):
         """
         Evaluate the given recommander system rec_sys in the k-fold manner.
         Return the measurement matrics including RMSE, MAE, P@M, R@M, MRR@M,
@@ -94,6 +167,59 @@ class EvaSys(Repo):
         positions is an array specifying the Ms.
         use_all_user is a boolean to control if we evaluate on all users. If
         false, choose num_user users randomly to evaluate.
+        If export_files is True, the training and test data of every fold are
+        also written to files (see generate_train_test_files()).
+        If workers > 1, the folds are evaluated in a pool of that many
+        processes, which read the ratings from shared memory. Every fold
+        seeds the random generators on its own, so the results are the same
+        as evaluating the folds one by one.
+        The folds are trained on a copy of rec_sys (one per worker process if
+        workers > 1), which keeps the profiler of rec_sys, so rec_sys itself
+        is left as it was.
+        The phases of every fold (train, predict_ratings, recommend, rank)
+        are timed by the profiler of this EvaSys (see set_profiler()).
+        The ranking with sampled negatives is evaluated as well if it is set
+        by set_sampled().
+
+        >>> evasys = EvaSys()
+        >>> evasys.load_split_ratings(["testcase_ratings_1.csv",
+        ...                            "testcase_ratings_2.csv",
+        ...                            "testcase_ratings_3.csv"])
+        >>> from RecSysAdv import RecSysAdv
+        >>> rec_sys = RecSysAdv()
+        >>> rec_sys.set_rank(2)
+        >>> import contextlib, io
+        >>> with contextlib.redirect_stdout(io.StringIO()):
+        ...     np.random.seed(0)
+        ...     serial = evasys.evaluate(rec_sys, [1, 2])
+        ...     np.random.seed(0)
+        ...     parallel = evasys.evaluate(rec_sys, [1, 2], workers=2)
+        >>> serial.rmse == parallel.rmse
+        True
+        >>> rec_sys.util_mat is None
+        True
+        >>> (serial.p_at_k == parallel.p_at_k).all()
+        True
+        >>> from Base import Profiler
+        >>> evasys.set_profiler(Profiler(enabled=True))
+        >>> rec_sys.set_profiler(evasys.profiler)
+        >>> with contextlib.redirect_stdout(io.StringIO()):
+        ...     _ = evasys.evaluate(rec_sys, [1, 2], workers=2)
+        >>> phases = evasys.profiler.report()["phases"]
+        >>> phases["evaluate_core"]["calls"], phases["build_model"]["calls"]
+        (3, 3)
+        >>> evasys.set_sampled(5)
+        >>> with contextlib.redirect_stdout(io.StringIO()):
+        ...     np.random.seed(0)
+        ...     both = evasys.evaluate(rec_sys, [1, 2])
+        ...     np.random.seed(0)
+        ...     parallel = evasys.evaluate(rec_sys, [1, 2], workers=2)
+        >>> (both.p_at_k == serial.p_at_k).all()
+        True
+        >>> (both.sampled.r_at_k == parallel.sampled.r_at_k).all()
+        True
+        >>> both.sampled.num_negatives, len(both.sampled.users)
+        (5, 33)
         """
 
         user_list = []
@@ -106,128 +232,358 @@ class EvaSys(Repo):
                 user_id = self.get_user_id(user_idx)
                 print("user {}: {}".format(i+1, user_id))
 
+        # The k-th fold uses the seed seed + k
+        seed = np.random.randint(2**31 - self.num_fold)
+
         result_all_model = EvaMatrix(positions)
-        for fold in range(self.num_fold):
-            print("\n=============== Fold", fold+1)
-            training_file, test_file = self.generate_train_test_files(fold)
-            result = self.evaluate_core(
-                    training_file, test_file, rec_sys, positions, user_list)
-            result_all_model.accumulate(result)
+        if workers > 1:
+            if export_files:
+                for fold in range(self.num_fold):
+                    self.generate_train_test_files(fold)
+            results = self.evaluate_parallel(
+                    rec_sys, positions, user_list, seed, workers)
+            for fold, (result, output, profiler) in enumerate(results):
+                print("\n=============== Fold", fold+1)
+                print(output, end='')
+                result_all_model.accumulate(result)
+                self.profiler.merge(profiler)
+        else:
+            fold_rec_sys = copy.deepcopy(
+                    rec_sys, {id(rec_sys.profiler): rec_sys.profiler})
+            for fold in range(self.num_fold):
+                print("\n=============== Fold", fold+1)
+                if export_files:
+                    self.generate_train_test_files(fold)
+                result = self.evaluate_fold(
+                        fold, seed + fold, fold_rec_sys, positions, user_list)
+                result_all_model.accumulate(result)
         result_all_model.avg(self.num_fold, self.num_fold)
         print("\n=============== Matrics Avg and Total Time")
         result_all_model.print_data()
 
         return result_all_model
 
+    def evaluate_fold(self, k, seed, rec_sys, positions, user_list):
+        """
+        k: zero-based index
+        Seed the random generators with seed, and evaluate rec_sys with the
+        k-th fold as the test data.
+        """
+        random.seed(seed)
+        np.random.seed(seed)
+        training_mat, test_mat = self.split_fold(k)
+        with self.profiler.phase("evaluate_core"):
+            return self.evaluate_core(
+                    training_mat, test_mat, rec_sys, positions, user_list,
+                    seed)
+
+    def evaluate_parallel(self, rec_sys, positions, user_list, seed, workers):
+        """
+        Evaluate all the folds in a pool of workers processes. The rating
+        arrays are put in shared memory once, instead of being pickled to
+        every process; rec_sys and the ID mappings are sent once per process.
+        Yield (result, printed output, Profiler) of every fold, in fold
+        order. In the workers, the profiler of this EvaSys is used by rec_sys
+        as well, and its records of the fold are returned.
+        """
+        arrays = {
+            "indptr": self.util_mat.indptr,
+            "indices": self.util_mat.indices,
+            "data": self.util_mat.data,
+            "fold_ids": self.fold_ids,
+            "user_rating_means": np.asarray(self.user_rating_means),
+        }
+        blocks, specs = share_arrays(arrays)
+        try:
+            state = (specs, self.util_mat.shape, self.num_fold,
+                     self.user_id_map, self.item_id_map,
+                     self.user_ids, self.item_ids, rec_sys, self.profiler,
+                     self.num_negatives, self.exact_ranking)
+            with ProcessPoolExecutor(
+                    max_workers=min(workers, self.num_fold),
+                    initializer=init_fold_worker,
+                    initargs=(state,)) as pool:
+                tasks = [(fold, seed + fold, positions, user_list)
+                         for fold in range(self.num_fold)]
+                yield from pool.map(run_fold_worker, tasks)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    def write_ratings(self, filename, mat):
+        """
+        Write the ratings in the sparse matrix mat to a file, one rating per
+        line, in the format <User_ID>,<Item_ID>,<Rating>
+        """
+        coo = mat.tocoo()
+        with open(filename, 'w') as f:
+            for user_idx, item_idx, rating in zip(coo.row, coo.col, coo.data):
+                f.write("{},{},{}\n".format(
+                    self.user_ids[user_idx], self.item_ids[item_idx], rating))
+
     def generate_train_test_files(self, k):
         """
         k: zero-based index
-        Return a training_file and a test_file, where the k-th file in
-        self.split_rating_files is the test file, and the other files are
-        concatenating together as the training file.
+        Write the training data and the test data of the k-th fold to files,
+        and return their filenames. This is not needed by evaluate(), which
+        works in memory; it is for using the folds elsewhere.
         """
 
+        training_mat, test_mat = self.split_fold(k)
         training_file_name = 'training_file_' + str(k+1) + '.csv'
-
-        with open(training_file_name, 'w') as training_file:
-            for idx, filename in enumerate(self.split_rating_files):
-                if (idx == k):
-                    test_file_name = filename
-                else:
-                    with open(filename) as infile:
-                        for line in infile:
-                            training_file.write(line)
+        self.write_ratings(training_file_name, training_mat)
+        if len(self.split_rating_files) == self.num_fold:
+            test_file_name = self.split_rating_files[k]
+        else:
+            test_file_name = 'ratings_split_' + str(k+1) + '.csv'
+            self.write_ratings(test_file_name, test_mat)
 
         return training_file_name, test_file_name
 
-    def evaluate_core(
-            self, training_file, test_file, rec_sys, positions, user_list):
+    def sample_negatives(self, user_idxs, num_negatives, seed=None):
+        """
+        Draw num_negatives items for each of the users, uniformly and with
+        replacement from the items the user has not rated, with a generator
+        seeded by seed (or the numpy Generator seed itself). Return them in
+        a (users x num_negatives) array, with rows of -1 for the users who
+        have rated every item.
+        The draws of all users are made at once, without rejection: with
+        the rated items a_0 < a_1 < ... of a user, the j-th item the user has
+        not rated is j plus the number of i with a_i - i <= j, which is
+        found by one search over the sorted keys of all the users.
+
+        >>> evasys = EvaSys()
+        >>> evasys.load_total_ratings(3, "testcase_ratings.csv")
+        >>> users = np.arange(8)
+        >>> negatives = evasys.sample_negatives(users, 50, seed=0)
+        >>> negatives.shape
+        (8, 50)
+        >>> evasys.util_mat[users[:, None], negatives].nnz
+        0
+        >>> (negatives == evasys.sample_negatives(users, 50, seed=0)).all()
+        True
+        """
+
+        user_idxs = np.asarray(user_idxs, dtype=int)
+        rng = np.random.default_rng(seed)
+        rated = self.util_mat.tocsr()[user_idxs]
+        rated.eliminate_zeros()
+        rated.sort_indices()
+        num_users, num_items = rated.shape
+        counts = np.diff(rated.indptr)
+        rows = np.repeat(np.arange(num_users, dtype=np.int64), counts)
+        offsets = np.arange(rated.nnz) - rated.indptr[rows]
+        # a_i - i is nondecreasing in each row, so the keys are sorted
+        keys = rows * num_items + rated.indices - offsets
+
+        num_unrated = num_items - counts
+        draws = rng.integers(np.maximum(num_unrated, 1)[:, None],
+                             size=(num_users, num_negatives))
+        skips = np.searchsorted(
+                keys, np.arange(num_users, dtype=np.int64)[:, None]
+                * num_items + draws, side='right') - rated.indptr[:-1, None]
+        negatives = draws + skips
+        negatives[num_unrated == 0] = -1
+        return negatives
+
+    def evaluate_sampled(self, rec_sys, rows, user_list, scores_pred,
+                         positions, seed):
+        """
+        Rank every positive test rating against self.num_negatives sampled
+        negatives, drawn once per user. rows are the rows of user_list that
+        the positive ratings belong to, and scores_pred their predicted
+        ratings. The negatives of all users are scored in one batch, and
+        the negatives with a higher score are ranked ahead of the positive;
+        its ties with the negatives are broken at random. The draws are
+        seeded by seed. The positives of users with no unrated items are left
+        out.
+        Return an EvaMatrix of the XX@K metrics averaged over the positives.
+        """
+        num_negatives = self.num_negatives
+        rng = np.random.default_rng(seed)
+        user_rows, inverse = np.unique(rows, return_inverse=True)
+        users = user_list[user_rows]
+        with self.profiler.phase("sample_negatives"):
+            negatives = self.sample_negatives(users, num_negatives, rng)
+        has_negatives = negatives[:, 0] >= 0
+        with self.profiler.phase("score_negatives"):
+            scores = np.full(negatives.shape, np.inf)
+            scores[has_negatives] = np.reshape(rec_sys.predict_ratings(
+                    np.repeat(users[has_negatives], num_negatives),
+                    negatives[has_negatives].ravel()), (-1, num_negatives))
+
+        ranked = has_negatives[inverse]
+        scores = scores[inverse[ranked]]
+        scores_pred = scores_pred[ranked, None]
+        ties = np.count_nonzero(scores == scores_pred, axis=1)
+        ranks = np.count_nonzero(scores > scores_pred, axis=1) \
+            + rng.integers(ties + 1)
+        sampled = EvaMatrix(positions)
+        sampled.num_negatives = num_negatives
+        sampled.set_sampled_ranks(
+                ranks, num_negatives + 1, user_list[rows[ranked]])
+        sampled.avg(1, max(len(ranks), 1))
+        return sampled
+
+    def evaluate_core(self, training_mat, test_mat, rec_sys, positions,
+                      user_list, seed=None):
         start_time = time.time()
-        rec_sys.load_ratings(
-                training_file,
-                True,
-                self.user_id_map,
-                self.item_id_map,
-                self.user_ids,
-                self.item_ids)
-
-        test_data = Repo()
-        test_data.load_ratings(
-                test_file,
-                True,
-                self.user_id_map,
-                self.item_id_map,
-                self.user_ids,
-                self.item_ids)
+        with self.profiler.phase("train"):
+            rec_sys.load_ratings_matrix(
+                    training_mat,
+                    True,
+                    self.user_id_map,
+                    self.item_id_map,
+                    self.user_ids,
+                    self.item_ids)
 
         if len(user_list) == 0:
-            user_list = range(test_data.util_mat.shape[0])
+            user_list = range(test_mat.shape[0])
+        user_list = np.asarray(user_list, dtype=int)
         num_users = len(user_list)
-        num_ratings = 0
         result_all_user = EvaMatrix(positions)
 
-        # Loop all users in test_data
-        for user_cnt, user_idx in enumerate(user_list):
-            text = "Computing User {}/{} ...".format(user_cnt + 1, num_users)
-            print(text, flush=True, end='\r')
-            result = EvaMatrix(positions)
-            positive_items = {}
-
-            # Get the user's average rating (based on all the data)
-            score_avg = self.get_avg_rating(user_idx)
-
-            # Loop all items the user has rated
-            rated_items = test_data.util_mat[user_idx].nonzero()[1]
-            for item_idx in rated_items:
-                # Binarize the score
-                score_true = self.util_mat[user_idx, item_idx]
-                if score_true >= score_avg:
-                    positive_items[item_idx] = 1
-
-                # Accuamulate RMSE and MAE
-                score_pred = rec_sys.predict_rating(user_idx, item_idx)
-                score_diff = abs(score_pred - score_true)
-                result.rmse += np.power(score_diff, 2)
-                result.mae += score_diff
-                num_ratings += 1
-
-            if len(positive_items) == 0:
-                result_all_user.accumulate(result)
-                continue
-
-            # Loop top k recommanded items to the user
-            largest_k = np.amax(positions)
-            predictions = rec_sys.predict_top_k_recomm(user_idx, largest_k)
-            relevant_count = np.zeros(len(positions))
-            dcg = np.zeros(len(positions))
-            idcg = np.zeros(len(positions))
-            for item_count, (item_idx, score_pred) in enumerate(predictions):
-                # Accumulate IDCG according to k
-                for i in range(len(positions)):
-                    if item_count < positions[i]:
-                        idcg[i] += 1. / math.log(1 + item_count + 1)
-
-                # Handle a hit
-                if item_idx in positive_items:
-                    for i in range(len(positions)):
-                        if item_count < positions[i]:
-                            relevant_count[i] += 1
-                            dcg[i] += 1. / math.log(1 + item_count + 1)
-
-                            # Update MRR@K directly
-                            if result.mrr_at_k[i] == 0:
-                                result.mrr_at_k[i] = 1./(item_count + 1)
-
-            # Comppute XX@K
-            result.p_at_k = relevant_count / positions
-            result.r_at_k = relevant_count / len(positive_items)
-            result.ndcg_at_k = dcg / idcg if (idcg != 0).all() else 0
-
-            result_all_user.accumulate(result)
+        # Gather all the (user, item) pairs of the test data, in the order of
+        # user_list, and score them in one batch
+        test_mat = test_mat.tocsr()
+        test_mat.eliminate_zeros()
+        counts = np.diff(test_mat.indptr)[user_list]
+        rows = np.repeat(np.arange(num_users), counts)
+        test_users = user_list[rows]
+        offsets = np.arange(len(rows)) - np.repeat(
+                np.cumsum(counts) - counts, counts)
+        pairs = np.repeat(test_mat.indptr[user_list], counts) + offsets
+        test_items = test_mat.indices[pairs]
+        scores_true = test_mat.data[pairs]
+        with self.profiler.phase("predict_ratings"):
+            scores_pred = rec_sys.predict_ratings(test_users, test_items)
+
+        # Accuamulate RMSE and MAE
+        score_diff = np.abs(scores_pred - scores_true)
+        result_all_user.rmse = np.sum(np.power(score_diff, 2))
+        result_all_user.mae = np.sum(score_diff)
+        num_ratings = len(score_diff)
+
+        # Binarize the scores by the users' average rating (based on all the
+        # data); the positive test items are the relevant ones
+        scores_avg = np.asarray(self.user_rating_means)[test_users]
+        is_positive = scores_true >= scores_avg
+        relevance = csr_matrix(
+                (np.ones(np.count_nonzero(is_positive)),
+                 (rows[is_positive], test_items[is_positive])),
+                shape=(num_users, test_mat.shape[1]))
+
+        sampled = None
+        if self.num_negatives is not None:
+            sampled = self.evaluate_sampled(
+                    rec_sys, rows[is_positive], user_list,
+                    scores_pred[is_positive], positions, seed)
+
+        # Recommend the top k items to the users who have relevant items,
+        # and rank all users at once
+        largest_k = np.amax(positions)
+        recommended = np.full((num_users, largest_k), -1)
+        has_relevant = np.flatnonzero(np.diff(relevance.indptr))
+        result_all_user.exact = self.exact_ranking
+        if self.exact_ranking:
+            print("Recommending to {} users ...".format(len(has_relevant)),
+                  flush=True, end='\r')
+            with self.profiler.phase("recommend"):
+                predictions = rec_sys.predict_top_k_recomm_batch(
+                        user_list[has_relevant], largest_k)
+            with self.profiler.phase("rank"):
+                for row, prediction in zip(has_relevant, predictions):
+                    items = [item_idx for item_idx, score_pred in prediction]
+                    recommended[row, :len(items)] = items
+                result_all_user.set_rankings(
+                        recommended, relevance, user_list)
 
         result_all_user.avg(num_ratings, num_users)
+        # the sampled metrics are averaged over the positives already
+        result_all_user.sampled = sampled
         result_all_user.rmse = np.sqrt(result_all_user.rmse)
         result_all_user.time = time.time() - start_time
         print()
         result_all_user.print_data()
         return result_all_user
+
+
+def share_arrays(arrays):
+    """
+    Copy the numpy arrays in the dict arrays to shared memory blocks.
+    Return the blocks, and the specs to attach them with attach_arrays().
+    """
+    blocks, specs = [], {}
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        block = shared_memory.SharedMemory(
+                create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, arr.dtype, buffer=block.buf)[...] = arr
+        blocks.append(block)
+        specs[name] = (block.name, arr.shape, arr.dtype.str)
+    return blocks, specs
+
+
+def attach_arrays(specs):
+    """
+    Attach the shared memory blocks described by specs. Return the blocks,
+    which must be kept open while the arrays are in use, and the arrays.
+
+    >>> blocks, specs = share_arrays({"a": np.arange(3)})
+    >>> attached, arrays = attach_arrays(specs)
+    >>> arrays["a"]
+    array([0, 1, 2])
+    >>> for block in attached + blocks:
+    ...     block.close()
+    >>> blocks[0].unlink()
+    """
+    blocks, arrays = [], {}
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+    return blocks, arrays
+
+
+# The state of a fold worker process, set up by init_fold_worker()
+fold_worker = {}
+
+
+def init_fold_worker(state):
+    """
+    Set up an EvaSys in a worker process from the shared memory state built
+    by EvaSys.evaluate_parallel().
+    """
+    (specs, shape, num_fold, user_id_map, item_id_map, user_ids, item_ids,
+     rec_sys, profiler, num_negatives, exact_ranking) = state
+    blocks, arrays = attach_arrays(specs)
+    evasys = EvaSys()
+    evasys.util_mat = csr_matrix(
+            (arrays["data"], arrays["indices"], arrays["indptr"]),
+            shape=shape, copy=False)
+    evasys.fold_ids = arrays["fold_ids"]
+    evasys.user_rating_means = arrays["user_rating_means"]
+    evasys.num_fold = num_fold
+    evasys.user_id_map, evasys.item_id_map = user_id_map, item_id_map
+    evasys.user_ids, evasys.item_ids = user_ids, item_ids
+    evasys.set_profiler(profiler)
+    evasys.num_negatives, evasys.exact_ranking = num_negatives, exact_ranking
+    rec_sys.set_profiler(profiler)
+    fold_worker.update(blocks=blocks, evasys=evasys, rec_sys=rec_sys)
+
+
+def run_fold_worker(task):
+    """
+    Evaluate one fold in a worker process. Return the result, what the
+    evaluation printed, for the parent to print in fold order, and the
+    profiler records of the fold.
+    """
+    fold, seed, positions, user_list = task
+    profiler = fold_worker["evasys"].profiler
+    profiler.reset()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = fold_worker["evasys"].evaluate_fold(
+                fold, seed, fold_worker["rec_sys"], positions, user_list)
+    return result, output.getvalue(), profiler
@@ -0,0 +1,347 @@
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+import numpy as np
+
+
+class RecServer():
+    """
+    A recommendation service over HTTP/JSON, holding a loaded recommender
+    system (RecSysAdv or RecSysBaseLine) in memory.
+
+    The endpoints are
+        /predict?user=<User_ID>&item=<Item_ID>
+        /top_k?user=<User_ID>&k=<K>
+        /similar_items?item=<Item_ID>&n=<N>
+        /stats
+    The parameters can also be POSTed as a JSON object.
+
+    Concurrent requests to the same endpoint are coalesced into micro-batches
+    of at most max_batch_size requests, waiting at most max_wait seconds for
+    a batch to fill. Each batch is served by one vectorized call of the
+    recommender system, in a single worker thread, so that the event loop
+    keeps accepting requests while a batch is being scored.
+    """
+
+    def __init__(self, rec_sys):
+        self.rec_sys = rec_sys
+        self.max_batch_size = 256
+        self.max_wait = 0.002  # In seconds
+        self.queues = {}  # Endpoint name -> queue of pending requests
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.latencies = deque(maxlen=10000)  # Of the latest requests
+        self.num_requests = {}  # Endpoint name -> number of requests
+        self.num_batches = {}  # Endpoint name -> number of batches
+        self.num_errors = 0
+        self.start_time = time.time()
+
+    def set_batching(self, max_batch_size=256, max_wait=0.002):
+        assert max_batch_size >= 1, \
+            "Bad parameter. max_batch_size = [{}]".format(max_batch_size)
+        assert max_wait >= 0, \
+            "Bad parameter. max_wait = [{}]".format(max_wait)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+    def predict_batch(self, requests):
+        """
+        Serve a batch of (user_idx, item_idx) requests.
+        """
+        users, items = zip(*requests)
+        ratings = self.rec_sys.predict_ratings(users, items)
+        return [{"user": self.rec_sys.get_user_id(user_idx),
+                 "item": self.rec_sys.get_item_id(item_idx),
+                 "rating": float(rating)}
+                for user_idx, item_idx, rating in zip(users, items, ratings)]
+
+    def top_k_batch(self, requests):
+        """
+        Serve a batch of (user_idx, k) requests. All the users are ranked for
+        the largest k, and then cut to their own k.
+        """
+        users, ks = zip(*requests)
+        recommendations = self.rec_sys.predict_top_k_recomm_batch(
+                users, max(ks))
+        return [{"user": self.rec_sys.get_user_id(user_idx),
+                 "items": [{"item": self.rec_sys.get_item_id(int(item_idx)),
+                            "rating": float(rating)}
+                           for item_idx, rating in recommendation[:k]]}
+                for user_idx, k, recommendation
+                in zip(users, ks, recommendations)]
+
+    def similar_items_batch(self, requests):
+        """
+        Serve a batch of (item_idx, n) requests. All the items are looked up
+        for the largest n, and then cut to their own n.
+        """
+        items, ns = zip(*requests)
+        similar = self.rec_sys.similar_items_batch(items, max(ns))
+        return [{"item": self.rec_sys.get_item_id(item_idx),
+                 "items": [{"item": self.rec_sys.get_item_id(int(other)),
+                            "similarity": float(sim)}
+                           for other, sim in similar_items[:n]]}
+                for item_idx, n, similar_items in zip(items, ns, similar)]
+
+    def parse_request(self, endpoint, params):
+        """
+        Return the request of the endpoint as the tuple its batch function
+        takes. Raise KeyError for an unknown ID, and ValueError for a bad
+        parameter.
+        """
+        if endpoint == "predict":
+            return (self.rec_sys.get_user_idx(str(params["user"])),
+                    self.rec_sys.get_item_idx(str(params["item"])))
+        if endpoint == "top_k":
+            k = int(params.get("k", 10))
+            if k < 1:
+                raise ValueError("k must be positive")
+            return self.rec_sys.get_user_idx(str(params["user"])), k
+        if endpoint == "similar_items":
+            n = int(params.get("n", 10))
+            if n < 1:
+                raise ValueError("n must be positive")
+            return self.rec_sys.get_item_idx(str(params["item"])), n
+        raise ValueError("unknown endpoint")
+
+    async def submit(self, endpoint, request):
+        """
+        Queue the request to the endpoint's batcher and wait for its result.
+
+        >>> from RecSysAdv import RecSysAdv
+        >>> np.random.seed(0)
+        >>> recsys = RecSysAdv()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        ... # doctest: +ELLIPSIS
+        Building model, err = ...
+        >>> server = RecServer(recsys)
+        >>> server.set_batching(max_batch_size=3, max_wait=0.05)
+        >>> async def run():
+        ...     server.start_batchers()
+        ...     return await asyncio.gather(*[
+        ...         server.submit("predict", (0, item)) for item in range(5)])
+        >>> results = asyncio.run(run())
+        >>> [result["item"] for result in results]
+        ['I4', 'I7', 'I8', 'I9', 'I10']
+        >>> np.isclose(results[1]["rating"], recsys.predict_rating(0, 1))
+        True
+        >>> server.num_batches["predict"]
+        2
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queues[endpoint].put((request, future))
+        return await future
+
+    async def batcher(self, endpoint, batch_function):
+        """
+        Collect the queued requests of the endpoint into batches, and serve
+        each batch by batch_function in the worker thread.
+        """
+        loop = asyncio.get_running_loop()
+        queue = self.queues[endpoint]
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not queue.empty():
+                    batch.append(queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            requests = [request for request, future in batch]
+            self.num_batches[endpoint] = self.num_batches.get(endpoint, 0) + 1
+            try:
+                results = await loop.run_in_executor(
+                        self.executor, batch_function, requests)
+            except Exception as error:
+                for request, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for (request, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def start_batchers(self):
+        """
+        Create the request queues and start the batchers in the running
+        event loop.
+        """
+        batch_functions = {"predict": self.predict_batch,
+                           "top_k": self.top_k_batch,
+                           "similar_items": self.similar_items_batch}
+        self.batcher_tasks = []
+        for endpoint, batch_function in batch_functions.items():
+            self.queues[endpoint] = asyncio.Queue()
+            self.batcher_tasks.append(asyncio.ensure_future(
+                self.batcher(endpoint, batch_function)))
+
+    def stats(self):
+        """
+        Return the counters and the latency percentiles (in milliseconds, of
+        the latest requests) in a dict.
+        """
+        uptime = time.time() - self.start_time
+        num_requests = sum(self.num_requests.values())
+        num_batches = sum(self.num_batches.values())
+        stats = {
+            "uptime": uptime,
+            "requests": dict(self.num_requests),
+            "batches": dict(self.num_batches),
+            "errors": self.num_errors,
+            "throughput": num_requests / uptime if uptime > 0 else 0.,
+            "mean_batch_size":
+                num_requests / num_batches if num_batches > 0 else 0.,
+        }
+        if self.rec_sys.topk_cache is not None:
+            stats["topk_cache"] = self.rec_sys.topk_cache.stats()
+        if getattr(self.rec_sys, "similarity_cache", None) is not None:
+            stats["similarity_cache"] = self.rec_sys.similarity_cache.stats()
+        if len(self.latencies) > 0:
+            p50, p90, p99 = np.percentile(
+                    np.array(self.latencies) * 1000, [50, 90, 99])
+            stats["latency_ms"] = {"p50": p50, "p90": p90, "p99": p99,
+                                   "max": max(self.latencies) * 1000}
+        return stats
+
+    async def handle_request(self, endpoint, params):
+        """
+        Serve one request. Return the HTTP status and the JSON body.
+        """
+        if endpoint == "stats":
+            return 200, self.stats()
+        if endpoint not in self.queues:
+            return 404, {"error": "unknown endpoint " + endpoint}
+
+        start_time = time.perf_counter()
+        try:
+            request = self.parse_request(endpoint, params)
+        except KeyError as error:
+            self.num_errors += 1
+            return 404, {"error": "unknown ID or missing parameter {}"
+                         .format(error)}
+        except ValueError as error:
+            self.num_errors += 1
+            return 400, {"error": str(error)}
+        try:
+            result = await self.submit(endpoint, request)
+        except Exception as error:
+            self.num_errors += 1
+            return 500, {"error": str(error)}
+        self.latencies.append(time.perf_counter() - start_time)
+        self.num_requests[endpoint] = self.num_requests.get(endpoint, 0) + 1
+        return 200, result
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serve the HTTP/1.1 requests of a connection, keeping it alive until
+        the client closes it or asks to.
+        """
+        reasons = {200: "OK", 400: "Bad Request", 404: "Not Found",
+                   500: "Internal Server Error"}
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target = request_line.decode("latin-1").split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                url = urlsplit(target)
+                params = dict(parse_qsl(url.query))
+                length = int(headers.get("content-length", 0))
+                if length > 0:
+                    body = await reader.readexactly(length)
+                    try:
+                        params.update(json.loads(body))
+                    except (ValueError, TypeError):
+                        params = None
+
+                if params is None:
+                    status, result = 400, {"error": "bad JSON body"}
+                else:
+                    status, result = await self.handle_request(
+                            url.path.strip("/"), params)
+                body = json.dumps(result).encode()
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json"
+                             "\r\nContent-Length: {}\r\n\r\n"
+                             .format(status, reasons[status], len(body))
+                             .encode() + body)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000, socket_path=None):
+        """
+        Serve until cancelled, on the TCP address (host, port), or on the
+        Unix socket socket_path if it is given.
+
+        >>> from RecSysBaseLine import RecSysBaseLine
+        >>> recsys = RecSysBaseLine()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> server = RecServer(recsys)
+        >>> async def request(port, data):
+        ...     reader, writer = await asyncio.open_connection(
+        ...         "127.0.0.1", port)
+        ...     writer.write(data)
+        ...     head, body = (await reader.read()).split(b"\\r\\n\\r\\n")
+        ...     return head.split(b"\\r\\n")[0].decode(), json.loads(body)
+        >>> async def run():
+        ...     task = asyncio.ensure_future(server.serve(port=0))
+        ...     while not hasattr(server, "server"):
+        ...         await asyncio.sleep(0.01)
+        ...     port = server.server.sockets[0].getsockname()[1]
+        ...     responses = await asyncio.gather(
+        ...         request(port, b"GET /top_k?user=U1&k=2 HTTP/1.1\\r\\n"
+        ...                       b"Connection: close\\r\\n\\r\\n"),
+        ...         request(port, b"POST /similar_items HTTP/1.1\\r\\n"
+        ...                       b"Content-Length: 22\\r\\n"
+        ...                       b"Connection: close\\r\\n\\r\\n"
+        ...                       b'{"item": "I4", "n": 1}'),
+        ...         request(port, b"GET /predict?user=U0&item=I1 HTTP/1.1"
+        ...                       b"\\r\\nConnection: close\\r\\n\\r\\n"))
+        ...     task.cancel()
+        ...     return responses
+        >>> top_k, similar, unknown = asyncio.run(run())
+        >>> top_k
+        ('HTTP/1.1 200 OK', {'user': 'U1', 'items': \
+[{'item': 'I18', 'rating': 4.0}, {'item': 'I2', 'rating': 4.0}]})
+        >>> similar
+        ('HTTP/1.1 200 OK', {'item': 'I4', 'items': \
+[{'item': 'I11', 'similarity': 1.0}]})
+        >>> unknown[0]
+        'HTTP/1.1 404 Not Found'
+        >>> server.stats()["requests"]
+        {'top_k': 1, 'similar_items': 1}
+        """
+        self.start_batchers()
+        if socket_path is not None:
+            self.server = await asyncio.start_unix_server(
+                    self.handle_connection, path=socket_path)
+        else:
+            self.server = await asyncio.start_server(
+                    self.handle_connection, host, port)
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            for task in self.batcher_tasks:
+                task.cancel()
@@ -1,3 +1,7 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from Base import Repo
 
@@ -12,14 +16,274 @@ class RecSysAdv(Repo):
         self.U = None
         self.V = None
         self.rank = 2
+        self.solver = "sgd"  # the algorithm used in build_model()
+        self.workers = None  # number of threads used by the ALS solver
+        self.max_iterations = 15  # number of ALS iterations or epochs
+        self.batch_size = 4096  # number of ratings per mini-batch step
+        self.validation = 0.1  # fraction of ratings held out for validation
+        self.patience = 2  # epochs without improvement before stopping
+        self.refine_steps = 3  # ALS steps on the rows touched by add_ratings
+        # the approximate top-k index over V (an inverted file): the items of
+        # cluster c are index_items[index_indptr[c]:index_indptr[c+1]]
+        self.use_index = False
+        self.num_clusters = None  # None means about sqrt(number of items)
+        self.num_probes = 8  # number of clusters scored per user
+        self.index_centroids = None
+        self.index_indptr = None
+        self.index_items = None
         super().__init__()
 
     def set_rank(self, rank):
         self.rank = rank
 
-    def load_ratings(self, arg, *args, **kwargs):
-        super().load_ratings(arg, *args, **kwargs)
-        self.build_model(self.rank)
+    def set_solver(self, solver, workers=None, max_iterations=15,
+                   batch_size=4096, validation=0.1, patience=2):
+        """
+        Choose the algorithm used in build_model():
+        "sgd": stochastic gradient descent, one rating at a time.
+        "als": alternating least squares. In each half-step, the regularized
+               normal equations of every user (or item) are solved in closed
+               form, spread across a pool of workers threads (None means the
+               default of ThreadPoolExecutor). At most max_iterations
+               iterations are run.
+        "minibatch": stochastic gradient descent on shuffled mini-batches of
+               batch_size ratings. A validation fraction of the ratings is held
+               out, and training stops when the validation RMSE has not
+               improved for patience epochs, or after max_iterations epochs.
+        """
+        assert solver in ("sgd", "als", "minibatch"), \
+            "Bad parameter. solver = [{}]".format(solver)
+        assert 0 <= validation < 1, \
+            "Bad parameter. validation = [{}]".format(validation)
+        self.solver = solver
+        self.workers = workers
+        self.max_iterations = max_iterations
+        self.batch_size = batch_size
+        self.validation = validation
+        self.patience = patience
+
+    def set_refine_steps(self, refine_steps):
+        assert refine_steps >= 0, \
+            "Bad parameter. refine_steps = [{}]".format(refine_steps)
+        self.refine_steps = refine_steps
+
+    def set_index(self, use_index=True, num_clusters=None, num_probes=8):
+        """
+        Enable (or disable) the approximate top-k index. When enabled, the
+        index is built after build_model() and predict_top_k_recomm() only
+        scores the items of the num_probes clusters closest to the user (see
+        predict_top_k_recomm_index()). More probes give a higher recall at a
+        higher latency.
+        """
+        assert num_clusters is None or num_clusters > 0, \
+            "Bad parameter. num_clusters = [{}]".format(num_clusters)
+        assert num_probes > 0, \
+            "Bad parameter. num_probes = [{}]".format(num_probes)
+        self.use_index = use_index
+        self.num_clusters = num_clusters
+        self.num_probes = num_probes
+        self.model_changed()
+
+    def ratings_loaded(self):
+        with self.profiler.phase("build_model"):
+            self.build_model(self.rank)
+        self.index_centroids = None
+        if self.use_index:
+            with self.profiler.phase("build_index"):
+                self.build_index(self.num_clusters)
+
+    def ratings_added(self, users, items, lamda=0.05):
+        '''
+        Update the model after add_ratings() instead of rebuilding it. New
+        users and items get random rows in U and V, the same as in
+        build_model(). Then refine_steps ALS half-step pairs are run on the
+        touched rows only: the touched users are solved with V fixed, then
+        the touched items with U fixed.
+
+        >>> np.random.seed(0)
+        >>> recsys = RecSysAdv()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        ... # doctest: +ELLIPSIS
+        Building model, err = ...
+        >>> before = recsys.V.copy()
+        >>> recsys.add_ratings([("U1", "I3", 5), ("U9", "I21", 4)])
+        >>> recsys.U.shape, recsys.V.shape
+        ((9, 2), (21, 2))
+        >>> user_idx, item_idx = recsys.get_user_idx("U1"), \\
+        ...     recsys.get_item_idx("I3")
+        >>> "%.2f" %recsys.predict_rating(user_idx, item_idx)
+        '4.00'
+        >>> untouched = np.ones(20, dtype=bool)
+        >>> untouched[item_idx] = False
+        >>> np.array_equal(before[untouched], recsys.V[:20][untouched])
+        True
+        '''
+
+        num_users, num_items = self.util_mat.shape
+        rank = self.U.shape[1]
+        self.U = np.vstack((self.U, np.random.rand(
+            num_users - self.U.shape[0], rank)))
+        self.V = np.vstack((self.V, np.random.rand(
+            num_items - self.V.shape[0], rank)))
+
+        user_mat = self.util_mat[users]
+        item_mat = self.util_mat_csc[:, items].T.tocsr() \
+            if self.util_mat_csc is not None \
+            else self.util_mat[:, items].T.tocsr()
+        U_touched, V_touched = self.U[users], self.V[items]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for step in range(self.refine_steps):
+                self.solve_rows(user_mat, self.V, U_touched, lamda, pool)
+                self.U[users] = U_touched
+                self.solve_rows(item_mat, self.U, V_touched, lamda, pool)
+                self.V[items] = V_touched
+
+        # the touched (and new) items may belong to other clusters now
+        if self.index_centroids is not None:
+            self.assign_index()
+
+    def fold_in_user(self, user_id, ratings, lamda=0.05):
+        '''
+        Add a user who is not in the model (or update one who is) without
+        retraining, see fold_in_users(). ratings is an iterable of
+        (item_id, rating). Return the user_idx.
+        '''
+        return self.fold_in_users({user_id: ratings}, lamda)[0]
+
+    def fold_in_users(self, user_ratings, lamda=0.05):
+        '''
+        Add users to the model without retraining. user_ratings maps each
+        user_id to an iterable of (item_id, rating). The ratings are merged
+        into util_mat (new users are appended to the ID mappings), and the
+        row of U of each user is solved against the fixed V by the
+        regularized least squares of one ALS half-step, all users in one
+        batch. Ratings of items that are not in the model are ignored.
+        Return the user_idx of the users, in the order of user_ratings.
+
+        >>> np.random.seed(0)
+        >>> recsys = RecSysAdv()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        ... # doctest: +ELLIPSIS
+        Building model, err = ...
+        >>> recsys.fold_in_users({"U9": [("I1", 5), ("I3", 1)],
+        ...                       "U10": [("I2", 4), ("I99", 3)]})
+        array([8, 9])
+        >>> recsys.U.shape, recsys.util_mat.shape
+        ((10, 2), (10, 20))
+        >>> F = recsys.V[[recsys.get_item_idx(item_id)
+        ...               for item_id in ("I1", "I3")]]
+        >>> np.allclose(recsys.U[8], np.linalg.solve(
+        ...     F.T @ F + 0.05 * 2 * np.eye(2), F.T @ [5, 1]))
+        True
+        >>> user_idx = recsys.fold_in_user("U11", [("I4", 3), ("I5", 4)])
+        >>> recsys.fold_in_user("U12", [("I99", 3)])
+        11
+        >>> recsys.predict_rating(11, 0), recsys.get_avg_rating(11)
+        (0.0, 0.0)
+        >>> [recsys.get_item_id(item_idx) for item_idx, rating
+        ...  in recsys.predict_top_k_recomm(user_idx, 20)
+        ...  if recsys.get_item_id(item_idx) in ("I4", "I5")]
+        []
+        '''
+
+        rows = [(user_id, item_id, rating)
+                for user_id, ratings in user_ratings.items()
+                for item_id, rating in ratings
+                if item_id in self.item_id_map and
+                self.item_id_map[item_id] < self.V.shape[0]]
+        self.merge_ratings(rows)
+        users = self.factorize_ids(
+                np.array([str(user_id) for user_id in user_ratings]),
+                self.user_id_map, self.user_ids, False).astype(int)
+
+        # users without any known rating get a zero row in util_mat and U
+        num_users = len(self.user_ids)
+        if self.util_mat.shape[0] < num_users:
+            self.util_mat.resize((num_users, self.util_mat.shape[1]))
+            if self.util_mat_csc is not None:
+                self.util_mat_csc.resize((num_users, self.util_mat.shape[1]))
+            self.rated_mats = None
+            self.user_rating_counts = np.concatenate((
+                self.user_rating_counts,
+                np.zeros(num_users - len(self.user_rating_counts), dtype=int)))
+            self.user_rating_means = np.concatenate((
+                self.user_rating_means,
+                np.zeros(num_users - len(self.user_rating_means))))
+        self.U = np.vstack((self.U, np.zeros(
+            (num_users - self.U.shape[0], self.U.shape[1]))))
+
+        U_users = self.U[users]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            self.solve_rows(self.util_mat[users], self.V, U_users, lamda,
+                            pool)
+        self.U[users] = U_users
+        if self.topk_cache is not None:
+            self.topk_cache.invalidate_users(users)
+        return users
+
+    def save_model(self, path):
+        '''
+        Save the trained model into the directory path: U, V, the rank and
+        the solver, together with the ratings, the ID mappings (see
+        save_compiled()) and the stamp of the rating file it was trained on.
+
+        >>> import shutil, tempfile
+        >>> np.random.seed(0)
+        >>> recsys = RecSysAdv()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        ... # doctest: +ELLIPSIS
+        Building model, err = ...
+        >>> path = tempfile.mkdtemp()
+        >>> recsys.save_model(path)
+        >>> loaded = RecSysAdv()
+        >>> loaded.load_model(path)
+        >>> loaded.rank, loaded.get_user_idx("U8")
+        (2, 7)
+        >>> loaded.predict_top_k_recomm(0, 3) == \\
+        ...     recsys.predict_top_k_recomm(0, 3)
+        True
+        >>> shutil.rmtree(path)
+        '''
+        self.save_compiled(path, {
+            "model": "ARS", "rank": self.U.shape[1], "solver": self.solver,
+            "ratings_source": self.ratings_source})
+        np.save(os.path.join(path, "U.npy"), self.U)
+        np.save(os.path.join(path, "V.npy"), self.V)
+        for name in ("index_centroids", "index_indptr", "index_items"):
+            filename = os.path.join(path, name + ".npy")
+            if self.index_centroids is not None:
+                np.save(filename, getattr(self, name))
+            elif os.path.exists(filename):
+                # drop the index of a model saved here before
+                os.remove(filename)
+
+    def load_model(self, path, mmap_mode="r"):
+        '''
+        Load a model saved by save_model() from the directory path, instead
+        of training one. The arrays are memory-mapped. If the index is
+        enabled (see set_index()) but was not saved, it is built.
+        '''
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        assert meta.get("model") == "ARS", \
+            "Bad model file. path = [{}]".format(path)
+
+        self.reset_ids()
+        self.load_compiled(path, mmap_mode=mmap_mode)
+        self.U = np.load(os.path.join(path, "U.npy"), mmap_mode=mmap_mode)
+        self.V = np.load(os.path.join(path, "V.npy"), mmap_mode=mmap_mode)
+        self.rank = meta["rank"]
+        self.solver = meta.get("solver", self.solver)
+        self.ratings_source = meta.get("ratings_source")
+        self.index_centroids = None
+        if os.path.exists(os.path.join(path, "index_centroids.npy")):
+            self.index_centroids, self.index_indptr, self.index_items = [
+                np.load(os.path.join(path, name + ".npy"),
+                        mmap_mode=mmap_mode)
+                for name in ("index_centroids", "index_indptr", "index_items")]
+        elif self.use_index:
+            self.build_index(self.num_clusters)
+        self.model_changed()
 
     def build_model(self, rank=50):
         '''
@@ -27,11 +291,9 @@ class RecSysAdv(Repo):
         such that the the difference between U * V_t and self.util_mat is
         minimized for the non-zero terms.
         U, V are initialized with random values, and then adjusted using
-        stochastic gradient descent.
+        the solver chosen by set_solver().
         '''
 
-        lamda = 0.01  # regularization parameter
-        alpha = 1. / rank if rank > 100 else 0.01  # learning rate
         min_shape = min(self.util_mat.shape)
         rank = rank if rank < min_shape else min_shape
 
@@ -45,6 +307,25 @@ class RecSysAdv(Repo):
         U = np.random.rand(n, rank)
         V = np.random.rand(m, rank)
 
+        if self.solver == "als":
+            self.train_als(U, V)
+        elif self.solver == "minibatch":
+            self.train_minibatch(U, V)
+        else:
+            self.train_sgd(U, V)
+
+        self.U = U
+        self.V = V
+
+    def train_sgd(self, U, V):
+        '''
+        Adjust U and V in place by stochastic gradient descent.
+        '''
+
+        rank = U.shape[1]
+        lamda = 0.01  # regularization parameter
+        alpha = 1. / rank if rank > 100 else 0.01  # learning rate
+
         # transform csr_matrix to coordinate matrix
         cx = self.util_mat.tocoo()
 
@@ -74,46 +355,587 @@ class RecSysAdv(Repo):
             if avg_err < 0.5:
                 alpha = 2. / rank if rank > 100 else 0.02
 
-        self.U = U
-        self.V = V
+    def train_minibatch(self, U, V):
+        '''
+        Adjust U and V in place by mini-batch stochastic gradient descent.
+        The ratings are shuffled, and a slice of them is held out for
+        validation. Every step takes batch_size ratings, and the gradients of
+        the ratings that share a user (or an item) are averaged by
+        scatter-add. After the last epoch, U and V are reset to the epoch
+        with the lowest validation RMSE. A validation RMSE that is not finite
+        raises FloatingPointError.
+
+        >>> np.random.seed(0)
+        >>> recsys = RecSysAdv()
+        >>> recsys.set_solver("minibatch", max_iterations=100, batch_size=16,
+        ...                   validation=0.2, patience=3)
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        ... # doctest: +ELLIPSIS
+        Building model, err = ..., validation rmse = ...
+        >>> recsys.U.shape, recsys.V.shape
+        ((8, 2), (20, 2))
+
+        The training also converges on skewed ratings:
+
+        >>> from scipy.sparse import csr_matrix
+        >>> rng = np.random.RandomState(0)
+        >>> keys = np.unique(rng.zipf(1.5, 20000) % 500 * 200
+        ...                  + rng.zipf(1.5, 20000) % 200)
+        >>> recsys.util_mat = csr_matrix(
+        ...     (rng.randint(1, 6, len(keys)).astype(float),
+        ...      np.divmod(keys, 200)), shape=(500, 200))
+        >>> def rmse(U, V):
+        ...     cx = recsys.util_mat.tocoo()
+        ...     err = cx.data - np.sum(U[cx.row] * V[cx.col], axis=1)
+        ...     return np.sqrt(np.mean(err ** 2))
+        >>> recsys.set_solver("minibatch", max_iterations=5, batch_size=512)
+        >>> U, V = rng.rand(500, 50), rng.rand(200, 50)
+        >>> initial = rmse(U, V)
+        >>> recsys.train_minibatch(U, V)  # doctest: +ELLIPSIS
+        Building model, err = ..., validation rmse = ...
+        >>> rmse(U, V) < initial / 5
+        True
+        '''
+
+        rank = U.shape[1]
+        lamda = 0.01  # regularization parameter
+        alpha = 1. / rank if rank > 100 else 0.01  # learning rate
+
+        # shuffle the ratings and hold out the validation slice
+        cx = self.util_mat.tocoo()
+        order = np.random.permutation(cx.nnz)
+        num_valid = int(cx.nnz * self.validation)
+        valid = order[:num_valid]
+        train = order[num_valid:]
+        valid_rows, valid_cols = cx.row[valid], cx.col[valid]
+        valid_data = cx.data[valid]
+        rows, cols, data = cx.row[train], cx.col[train], cx.data[train]
+
+        best_rmse = np.inf
+        best_U, best_V = U.copy(), V.copy()
+        bad_epochs = 0
+        for iterates in range(self.max_iterations):
+            order = np.random.permutation(len(data))
+            avg_err = 0
+            for begin in range(0, len(order), self.batch_size):
+                batch = order[begin:begin + self.batch_size]
+                i, j = rows[batch], cols[batch]
+                U_i = U[i]
+                V_j = V[j]
+                err = data[batch] - np.einsum('ij,ij->i', U_i, V_j)
+                avg_err += np.sum(np.abs(err))
+                # a user (or an item) with c ratings in the batch takes the
+                # mean of their c gradients, not the sum, so that a heavy
+                # row does not step c times as far
+                _, inverse, counts = np.unique(
+                        i, return_inverse=True, return_counts=True)
+                step = (alpha / counts[inverse])[:, None]
+                np.add.at(U, i, step * (err[:, None] * V_j - lamda * U_i))
+                _, inverse, counts = np.unique(
+                        j, return_inverse=True, return_counts=True)
+                step = (alpha / counts[inverse])[:, None]
+                np.add.at(V, j, step * (err[:, None] * U_i - lamda * V_j))
+            avg_err /= max(len(data), 1)
+
+            # early stopping on the validation RMSE (or on the training error
+            # if nothing is held out)
+            if num_valid > 0:
+                err = valid_data - np.einsum(
+                        'ij,ij->i', U[valid_rows], V[valid_cols])
+                rmse = np.sqrt(np.mean(err ** 2))
+            else:
+                rmse = avg_err
+            text = "Building model, err = {:.4f}, validation rmse = {:.4f}"\
+                .format(avg_err, rmse)
+            print(text, end='\r', flush=True)
+            if not np.isfinite(rmse):
+                print()
+                raise FloatingPointError(
+                    "minibatch training diverged in epoch {}".format(
+                        iterates + 1))
+            if rmse < best_rmse:
+                best_rmse = rmse
+                best_U[:], best_V[:] = U, V
+                bad_epochs = 0
+            else:
+                bad_epochs += 1
+                if bad_epochs >= self.patience:
+                    break
+        print()
+
+        U[:], V[:] = best_U, best_V
+
+    def train_als(self, U, V, lamda=0.05, tol=1e-4):
+        '''
+        Adjust U and V in place by alternating least squares.
+        U is solved with V fixed, then V is solved with U fixed, until the
+        training RMSE improves by less than tol or max_iterations is reached.
+        The regularization of each row is scaled by its number of ratings.
+
+        >>> np.random.seed(0)
+        >>> recsys = RecSysAdv()
+        >>> recsys.set_solver("als", workers=2, max_iterations=5)
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        ... # doctest: +ELLIPSIS
+        ALS iteration 1, rmse = ..., time = ... Sec
+        ...
+        ALS iteration 5, rmse = ..., time = ... Sec
+        >>> err = recsys.util_mat.data - recsys.predict_ratings(
+        ...     *recsys.util_mat.nonzero())
+        >>> np.sqrt(np.mean(err ** 2)) < 0.5
+        True
+        '''
+
+        mat = self.util_mat.tocsr()
+        mat_t = mat.T.tocsr()
+        cx = mat.tocoo()
+
+        last_rmse = np.inf
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for iterates in range(self.max_iterations):
+                start_time = time.time()
+                self.solve_rows(mat, V, U, lamda, pool)
+                self.solve_rows(mat_t, U, V, lamda, pool)
+
+                err = cx.data - np.einsum('ij,ij->i', U[cx.row], V[cx.col])
+                rmse = np.sqrt(np.mean(err ** 2)) if len(err) else 0
+                print("ALS iteration {}, rmse = {:.4f}, time = {:.2f} Sec"
+                      .format(iterates + 1, rmse, time.time() - start_time),
+                      flush=True)
+                if last_rmse - rmse < tol:
+                    break
+                last_rmse = rmse
+
+    def solve_rows(self, mat, fixed, out, lamda, pool, chunk_size=1024,
+                   max_elements=2**20):
+        '''
+        One half-step of ALS. For every row x of mat (a CSR matrix of
+        ratings), solve
+            (F_x^T F_x + lamda * n_x * I) out[x] = F_x^T r_x
+        where F_x are the rows of fixed indexed by the n_x ratings r_x.
+        Rows without any rating are kept unchanged. The rows are split into
+        chunks of chunk_size, which are solved in parallel in pool.
+
+        In a chunk, the rows are grouped by their number of ratings, rounded
+        up to a power of 2, and the F_x of a group are padded with zeros into
+        one (rows x length x rank) array of at most max_elements elements.
+        The normal equations of a whole group are then built by batched
+        matrix products, which run outside the GIL.
+
+        >>> from scipy.sparse import csr_matrix
+        >>> mat = csr_matrix(np.array([[1., 0, 2, 0], [0, 0, 0, 0],
+        ...                            [3, 4, 5, 1]]))
+        >>> fixed = np.arange(8.).reshape(4, 2) / 8
+        >>> out = np.ones((3, 2))
+        >>> with ThreadPoolExecutor(1) as pool:
+        ...     RecSysAdv().solve_rows(mat, fixed, out, 0.05, pool, 2, 4)
+        >>> F = fixed[[0, 1, 2, 3]]
+        >>> np.allclose(out[2], np.linalg.solve(
+        ...     F.T @ F + 0.05 * 4 * np.eye(2), F.T @ [3, 4, 5, 1]))
+        True
+        >>> out[1]
+        array([1., 1.])
+        '''
+
+        rank = fixed.shape[1]
+        num_rows = min(mat.shape[0], out.shape[0])
+        eye = np.eye(rank)
+
+        def solve_group(rows, counts):
+            length = int(counts.max())
+            offsets = np.arange(length)
+            present = offsets < counts[:, None]
+            pos = np.minimum(mat.indptr[rows][:, None] + offsets,
+                             max(mat.nnz - 1, 0))
+            F = fixed[np.where(present, mat.indices[pos], 0)]
+            F *= present[:, :, None]
+            ratings = np.where(present, mat.data[pos], 0)
+            Ft = F.transpose(0, 2, 1)
+            A = Ft @ F + (lamda * counts)[:, None, None] * eye
+            b = Ft @ ratings[:, :, None]
+            out[rows] = np.linalg.solve(A, b)[:, :, 0]
+
+        def solve_chunk(begin, end):
+            counts = np.diff(mat.indptr[begin:end + 1])
+            rows = np.flatnonzero(counts) + begin
+            counts = counts[counts > 0]
+            if len(rows) == 0:
+                return
+            order = np.argsort(counts, kind='stable')
+            rows, counts = rows[order], counts[order]
+            buckets = np.ceil(np.log2(counts)).astype(int)
+            bounds = np.flatnonzero(np.diff(buckets)) + 1
+            for group in np.split(np.arange(len(rows)), bounds):
+                step = max(max_elements // (int(counts[group[-1]]) * rank),
+                           1)
+                for sub in range(0, len(group), step):
+                    sub = group[sub:sub + step]
+                    solve_group(rows[sub], counts[sub])
+
+        futures = [pool.submit(solve_chunk, begin,
+                               min(begin + chunk_size, num_rows))
+                   for begin in range(0, num_rows, chunk_size)]
+        for future in futures:
+            future.result()
 
     def predict_rating(self, user_idx, item_idx):
         '''
         Return the predicted rating of the user to the item.
         The prediction is made by calculating U * V_t.
         '''
+        self.profiler.count("predict_rating")
         rating = np.dot(self.U[user_idx], self.V[item_idx].T)
         return max(min(rating, 5), 0)
 
-    def predict_top_k_recomm(self, user_idx, k):
+    def predict_ratings(self, user_idxs, item_idxs):
+        '''
+        Return the predicted ratings of a batch of (user, item) pairs, given
+        as two parallel index arrays, in a numpy array.
+        The predictions are the row-wise dot products of U and V.
+
+        >>> np.random.seed(0)
+        >>> recsys = RecSysAdv()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        ... # doctest: +ELLIPSIS
+        Building model, err = ...
+        >>> users, items = [0, 1, 7], [3, 5, 19]
+        >>> predictions = recsys.predict_ratings(users, items)
+        >>> np.allclose(predictions, [recsys.predict_rating(u, i)
+        ...                           for (u, i) in zip(users, items)])
+        True
+        '''
+        user_idxs = np.asarray(user_idxs, dtype=int)
+        item_idxs = np.asarray(item_idxs, dtype=int)
+        ratings = np.einsum(
+                'ij,ij->i', self.U[user_idxs], self.V[item_idxs])
+        return np.clip(ratings, 0, 5)
+
+    def predict_top_k_recomm(self, user_idx, k, max_candidates=None):
         """
         Return top k pairs of (item_idx, predicted_rating) according to the
         order of the predicted_rating.
+        All the items the user has not rated are scored, unless max_candidates
+        is given (see predict_top_k_recomm_batch()).
+
+        >>> np.random.seed(0)
+        >>> recsys = RecSysAdv()
+        >>> recsys.set_topk_cache(max_entries=100)
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        ... # doctest: +ELLIPSIS
+        Building model, err = ...
+        >>> top_5 = recsys.predict_top_k_recomm(0, 5)
+        >>> recsys.predict_top_k_recomm(0, 3) == top_5[:3]
+        True
+        >>> _ = recsys.fold_in_user("U1", [("I3", 5)])
+        >>> _ = recsys.predict_top_k_recomm(0, 3)
+        >>> recsys.topk_cache.hits, recsys.topk_cache.misses
+        (1, 2)
         """
+        return self.predict_top_k_recomm_batch(
+                [user_idx], k, max_candidates=max_candidates)[0]
+
+    def predict_top_k_recomm_batch(
+            self, user_idxs, k, max_bytes=2**27, max_candidates=None,
+            use_cache=True):
+        """
+        Return, for each user in user_idxs, the top k pairs of
+        (item_idx, predicted_rating) according to the order of the
+        predicted_rating, the same as predict_top_k_recomm().
+
+        The users are scored in blocks by one matrix product U[block] * V_t
+        each. The block size is chosen such that the score matrix of a block
+        takes about max_bytes. The items the users have already rated are
+        masked out through the row pointers of util_mat, and the top k items
+        are selected by np.argpartition.
+
+        If max_candidates is given, only the (at most max_candidates) items
+        returned by candidate_items() can be recommended. Otherwise, if the
+        index is enabled by set_index() and built, the approximate
+        predict_top_k_recomm_index() is used instead.
+        The users found in the top-k cache (see set_topk_cache()) are not
+        computed again, unless use_cache is False.
+
+        >>> np.random.seed(0)
+        >>> recsys = RecSysAdv()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        ... # doctest: +ELLIPSIS
+        Building model, err = ...
+        >>> users = range(len(recsys.user_ids))
+        >>> all_users = recsys.predict_top_k_recomm_batch(users, 3, 256)
+        >>> all_users == [recsys.predict_top_k_recomm(u, 3) for u in users]
+        True
+        >>> any(recsys.util_mat[u, i] != 0
+        ...     for u in users for (i, rating) in all_users[u])
+        False
+        >>> [len(recomm) for recomm in recsys.predict_top_k_recomm_batch(
+        ...     users, 3, max_candidates=2)]
+        [2, 2, 2, 2, 2, 2, 2, 2]
+        """
+
+        user_idxs = np.asarray(user_idxs, dtype=int)
+        if k <= 0:
+            return [[] for _ in user_idxs]
+        if use_cache and self.topk_cache is not None:
+            return self.cached_top_k_recomm(
+                    user_idxs, k, max_candidates,
+                    lambda users: self.predict_top_k_recomm_batch(
+                        users, k, max_bytes, max_candidates, False))
+        if self.use_index and self.index_centroids is not None and \
+                max_candidates is None:
+            return self.predict_top_k_recomm_index(user_idxs, k)
+        num_items = self.V.shape[0]
+        block_size = max(1, max_bytes // (8 * num_items))
+        mat = self.util_mat.tocsr()
+        recommendations = []
+
+        with self.profiler.phase("predict_top_k_recomm"):
+            for begin in range(0, len(user_idxs), block_size):
+                users = user_idxs[begin:begin + block_size]
+                scores = np.clip(self.U[users] @ self.V.T, 0, 5)
+
+                # only items with a positive predicted rating are recommended
+                scores[scores <= 0] = -np.inf
+
+                # mask out the items the users have already rated
+                counts = mat.indptr[users + 1] - mat.indptr[users]
+                rows = np.repeat(np.arange(len(users)), counts)
+                offsets = np.arange(len(rows)) - np.repeat(
+                        np.cumsum(counts) - counts, counts)
+                cols = mat.indices[
+                        np.repeat(mat.indptr[users], counts) + offsets]
+                scores[rows, cols] = -np.inf
+
+                # keep only the scores of the candidate items
+                if max_candidates is not None:
+                    candidates = self.candidate_items(
+                            users, max_candidates).tocoo()
+                    candidate_scores = np.full(scores.shape, -np.inf)
+                    candidate_scores[candidates.row, candidates.col] = \
+                        scores[candidates.row, candidates.col]
+                    scores = candidate_scores
+                    counts = np.bincount(candidates.row,
+                                         minlength=len(users))
+                else:
+                    counts = num_items - counts
+                if self.profiler.enabled:
+                    for count in counts:
+                        self.profiler.observe("candidates_per_user",
+                                              int(count))
+
+                # select the top k items of each user, then sort them by the
+                # predicted rating (ties by the item index)
+                top_k = min(k, num_items)
+                if top_k < num_items:
+                    top = np.argpartition(
+                            -scores, top_k - 1, axis=1)[:, :top_k]
+                else:
+                    top = np.tile(np.arange(num_items), (len(users), 1))
+                top_scores = np.take_along_axis(scores, top, axis=1)
+                order = np.lexsort((top, -top_scores), axis=1)
+                top = np.take_along_axis(top, order, axis=1)
+                top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+                for items, ratings in zip(top, top_scores):
+                    valid = np.isfinite(ratings)
+                    recommendations.append(
+                            list(zip(items[valid], ratings[valid])))
+        self.profiler.count("top_k_users", len(user_idxs))
+
+        return recommendations
+
+    def build_index(self, num_clusters=None, iterations=10):
+        '''
+        Build the approximate top-k index over the rows of V: cluster the
+        items by k-means into num_clusters clusters (about the square root of
+        the number of items if None), and keep the items of each cluster
+        together, in CSR form.
+
+        >>> np.random.seed(0)
+        >>> recsys = RecSysAdv()
+        >>> recsys.set_index(num_clusters=4, num_probes=4)
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        ... # doctest: +ELLIPSIS
+        Building model, err = ...
+        >>> recsys.index_centroids.shape, recsys.index_indptr[-1]
+        ((4, 2), 20)
+        >>> sorted(recsys.index_items) == list(range(20))
+        True
+        '''
+
+        num_items = self.V.shape[0]
+        if num_clusters is None:
+            num_clusters = max(1, int(np.sqrt(num_items)))
+        num_clusters = max(1, min(num_clusters, num_items))
+
+        V = np.asarray(self.V)
+        centroids = V[np.random.choice(
+            num_items, num_clusters, replace=False)].astype(float)
+        for iterates in range(iterations):
+            assignments = self.nearest_centroids(V, centroids)
+            counts = np.bincount(assignments, minlength=num_clusters)
+            sums = np.zeros(centroids.shape)
+            np.add.at(sums, assignments, V)
+            # empty clusters keep their centroids
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+
+        self.index_centroids = centroids
+        self.assign_index()
+
+    def assign_index(self):
+        '''
+        Put every item of V into the cluster of its nearest centroid.
+        '''
+        num_clusters = self.index_centroids.shape[0]
+        assignments = self.nearest_centroids(self.V, self.index_centroids)
+        self.index_items = np.argsort(assignments, kind='stable')
+        self.index_indptr = np.concatenate(([0], np.cumsum(
+            np.bincount(assignments, minlength=num_clusters))))
+        self.model_changed()
+
+    @staticmethod
+    def nearest_centroids(X, centroids, block_size=65536):
+        '''
+        Return the index of the nearest centroid (by Euclidean distance) of
+        each row of X, computed block_size rows at a time.
+
+        >>> RecSysAdv.nearest_centroids(np.array([[0, 0], [5, 5], [4, 6]]),
+        ...                             np.array([[5., 5.], [0., 1.]]))
+        array([1, 0, 0])
+        '''
+        squared_norms = np.einsum('ij,ij->i', centroids, centroids)
+        assignments = np.empty(X.shape[0], dtype=int)
+        for begin in range(0, X.shape[0], block_size):
+            block = np.asarray(X[begin:begin + block_size])
+            distances = squared_norms - 2 * block @ centroids.T
+            assignments[begin:begin + block_size] = distances.argmin(axis=1)
+        return assignments
+
+    def predict_top_k_recomm_index(self, user_idxs, k, num_probes=None):
+        '''
+        Return the approximate top k recommendations of each user in
+        user_idxs, in the format of predict_top_k_recomm_batch(). Only the
+        items of the num_probes clusters (self.num_probes if None) whose
+        centroids have the highest inner products with the user's row of U
+        are scored. With all the clusters probed, the result is exact.
+
+        >>> np.random.seed(0)
+        >>> recsys = RecSysAdv()
+        >>> recsys.set_index(num_clusters=4, num_probes=1)
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        ... # doctest: +ELLIPSIS
+        Building model, err = ...
+        >>> users = range(len(recsys.user_ids))
+        >>> exact = [recsys.predict_top_k_recomm_index([u], 3, 4)[0]
+        ...          for u in users]
+        >>> recsys.set_index(False)
+        >>> exact == recsys.predict_top_k_recomm_batch(users, 3)
+        True
+        >>> recsys.index_recall(users, 3, num_probes=4)
+        1.0
+        >>> 0 < recsys.index_recall(users, 3, num_probes=1) < 1
+        True
+        '''
+
+        user_idxs = np.asarray(user_idxs, dtype=int)
+        num_probes = self.num_probes if num_probes is None else num_probes
+        num_clusters = self.index_centroids.shape[0]
+        num_probes = min(num_probes, num_clusters)
+        mat = self.util_mat.tocsr()
+
+        # the clusters to probe for each user
+        centroid_scores = self.U[user_idxs] @ self.index_centroids.T
+        if num_probes < num_clusters:
+            probes = np.argpartition(
+                    -centroid_scores, num_probes - 1, axis=1)[:, :num_probes]
+        else:
+            probes = np.tile(np.arange(num_clusters), (len(user_idxs), 1))
+
+        recommendations = []
+        with self.profiler.phase("predict_top_k_recomm_index"):
+            for user_idx, clusters in zip(user_idxs, probes):
+                items = np.concatenate([
+                    self.index_items[
+                        self.index_indptr[c]:self.index_indptr[c + 1]]
+                    for c in clusters])
+                scores = np.clip(self.V[items] @ self.U[user_idx], 0, 5)
+
+                # only items with a positive predicted rating, which the user
+                # has not rated, are recommended
+                begin, end = mat.indptr[user_idx], mat.indptr[user_idx + 1]
+                keep = (scores > 0) & ~np.isin(items, mat.indices[begin:end])
+                self.profiler.observe("candidates_per_user", len(items))
+                items, scores = items[keep], scores[keep]
+
+                order = np.lexsort((items, -scores))[:k]
+                recommendations.append(list(zip(items[order], scores[order])))
+        self.profiler.count("top_k_users", len(user_idxs))
+
+        return recommendations
+
+    def index_recall(self, user_idxs, k, num_probes=None):
+        '''
+        Return the recall of the approximate top k recommendations of the
+        users in user_idxs against the exact ones: the fraction of the exact
+        top k items that are also found through the index.
+        '''
+        use_index, self.use_index = self.use_index, False
+        exact = self.predict_top_k_recomm_batch(user_idxs, k, use_cache=False)
+        self.use_index = use_index
+        approximate = self.predict_top_k_recomm_index(
+                user_idxs, k, num_probes)
+
+        found = total = 0
+        for exact_items, approximate_items in zip(exact, approximate):
+            exact_items = set(item_idx for item_idx, rating in exact_items)
+            found += len(exact_items & set(
+                item_idx for item_idx, rating in approximate_items))
+            total += len(exact_items)
+        return found / total if total > 0 else 1.0
+
+    def similar_items(self, item_idx, n=10):
+        """
+        Return at most n pairs of (item_idx, similarity) of the items most
+        similar to the given item, in descending order of the similarity.
+        The similarity is the cosine of the items' rows in V.
+        """
+        return self.similar_items_batch([item_idx], n)[0]
+
+    def similar_items_batch(self, item_idxs, n=10):
+        """
+        Return similar_items() of each item in item_idxs, scored by one
+        matrix product of the normalized rows of V.
+
+        >>> np.random.seed(0)
+        >>> recsys = RecSysAdv()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        ... # doctest: +ELLIPSIS
+        Building model, err = ...
+        >>> similar = recsys.similar_items_batch([0, 3], 3)
+        >>> [len(items) for items in similar]
+        [3, 3]
+        >>> similar[1] == recsys.similar_items(3, 3)
+        True
+        >>> norms = np.linalg.norm(recsys.V, axis=1)
+        >>> item_idx, sim = similar[0][0]
+        >>> np.isclose(sim, recsys.V[0] @ recsys.V[item_idx]
+        ...            / norms[0] / norms[item_idx])
+        True
+        """
+
+        item_idxs = np.asarray(item_idxs, dtype=int)
+        num_items = self.V.shape[0]
+        norms = np.linalg.norm(self.V, axis=1)
+        V_normed = self.V / np.where(norms > 0, norms, 1)[:, None]
+        scores = V_normed[item_idxs] @ V_normed.T
+        scores[np.arange(len(item_idxs)), item_idxs] = -np.inf
 
-        # list all items which the active user has already rated
-        rated_items = self.util_mat[user_idx].nonzero()[1]
-
-        # candidate items are items that can be recommanded to the target user.
-        # It is generated from the following manner: First, find out all the
-        # users that has rated the items the target user has also rated. Then,
-        # union all the items these user has rated. Finally, exclude the items
-        # the target user has already rated.
-        candidate_items = []
-        user_list = []
-        for item_idx in rated_items:
-            user_list = np.union1d(
-                    user_list, self.util_mat[:, item_idx].nonzero()[0])
-        for user in user_list:
-            candidate_items = np.union1d(
-                    candidate_items, self.util_mat[user].nonzero()[1])
-        candidate_items = np.setdiff1d(candidate_items, rated_items)
-
-        predictions = []
-        for item_idx in candidate_items:
-            rating = self.predict_rating(int(user_idx), int(item_idx))
-            if rating > 0:
-                predictions.append((item_idx, rating))
-        predictions.sort(key=lambda tup: tup[1], reverse=True)
-
-        return predictions[0: k] if len(predictions) > k else predictions
+        top_n = min(n, num_items - 1)
+        if top_n <= 0:
+            return [[] for _ in item_idxs]
+        top = np.argpartition(-scores, top_n - 1, axis=1)[:, :top_n]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.lexsort((top, -top_scores), axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        return [list(zip(items, sims)) for items, sims in zip(top, top_scores)]
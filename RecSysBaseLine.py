@@ -1,5 +1,8 @@
+import json
+import os
+import threading
 import numpy as np
-from scipy.sparse import lil_matrix
+from scipy.sparse import csr_matrix
 from Base import Repo
 
 
@@ -9,22 +12,437 @@ class RecSysBaseLine(Repo):
     collaborative filtering.
     """
 
+    # without the neighbor index, predict_ratings() predicts a batch with
+    # fewer than one pair per pair_cost ratings pair by pair, as the setup of
+    # the blocked similarity products costs O(ratings)
+    pair_cost = 1000
+
     def __init__(self):
-        # the similarity matrix between items, this is used as a cache
+        # the similarities between all items, see build_similarity_mat()
         self.similarity_mat = None
+        # the similarities computed lazily in predict_rating()
+        self.similarity_cache = SimilarityCache()
+        # if True, all similarities are computed in load_ratings() instead of
+        # lazily in predict_rating()
+        self.precompute = False
+        self.block_size = 1000  # number of target items per block
+        self.similarity_computed = False
+        # the top-N neighbor index, stored in CSR form: the neighbors of item i
+        # are neighbor_indices[neighbor_indptr[i]:neighbor_indptr[i+1]] with
+        # the weights in neighbor_weights, in descending order of the weights
+        self.num_neighbors = 50
+        self.neighbor_indptr = None
+        self.neighbor_indices = None
+        self.neighbor_weights = None
+        # if True, the predictions are made from the neighbor index, see
+        # build_neighbor_index(); otherwise it only serves similar_items()
+        self.use_neighbor_index = False
         super().__init__()
 
-    def load_ratings(self, arg, *args, **kwargs):
-        super().load_ratings(arg, *args, **kwargs)
+    def set_precompute(self, precompute=True, block_size=1000,
+                       num_neighbors=50):
+        """
+        Enable (or disable) computing the item-item similarities at
+        load_ratings() time. block_size is the number of items handled per
+        sparse matrix product, which bounds the peak memory of the build.
+        Only the num_neighbors most similar items of every item are kept, in
+        the neighbor index. If num_neighbors is None, all the positive
+        neighbors are kept and the predictions are the same as the lazy path.
+        """
+        assert block_size > 0, \
+            "Bad parameter. block_size = [{}]".format(block_size)
+        assert num_neighbors is None or num_neighbors > 0, \
+            "Bad parameter. num_neighbors = [{}]".format(num_neighbors)
+        self.precompute = precompute
+        self.block_size = block_size
+        self.num_neighbors = num_neighbors
+
+    def set_similarity_cache(self, max_entries=2**22, max_bytes=None):
+        """
+        Bound the cache of the similarities computed lazily by
+        predict_rating() to max_entries pairs, or max_bytes estimated bytes
+        (None means no bound). See SimilarityCache.
+
+        >>> recsys = RecSysBaseLine()
+        >>> recsys.set_similarity_cache(max_entries=20)
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> bounded = [recsys.predict_rating(0, i) for i in range(20)]
+        >>> len(recsys.similarity_cache) <= 20
+        True
+        >>> unbounded = RecSysBaseLine()
+        >>> unbounded.load_ratings("testcase_ratings.csv")
+        >>> np.allclose(bounded,
+        ...             [unbounded.predict_rating(0, i) for i in range(20)])
+        True
+        """
+        self.similarity_cache = SimilarityCache(max_entries, max_bytes)
+
+    def ratings_loaded(self):
+        self.similarity_mat = None
+        self.similarity_cache.clear()
+        self.similarity_computed = False
+        self.neighbor_indptr = None
+        self.neighbor_indices = None
+        self.neighbor_weights = None
+        self.use_neighbor_index = False
+        if self.precompute:
+            self.build_neighbor_index(self.num_neighbors, self.block_size)
+
+    def ratings_added(self, users, items):
+        """
+        Invalidate the similarities changed by add_ratings(). The similarity
+        of two items depends on the users who rated both of them, and on
+        these users' means, so it changes only if both items are rated by a
+        touched user. Only these pairs are dropped from the similarity
+        cache, and only these items' neighbors are rebuilt in the neighbor
+        index. A full similarity_mat is dropped.
+
+        >>> recsys = RecSysBaseLine()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> _ = [recsys.predict_rating(0, i) for i in range(20)]
+        >>> len(recsys.similarity_cache)
+        149
+        >>> recsys.add_ratings([("U1", "I3", 5), ("U9", "I21", 4)])
+        >>> len(recsys.similarity_cache)
+        74
+        >>> rebuilt = RecSysBaseLine()
+        >>> rebuilt.load_ratings_matrix(
+        ...     recsys.util_mat, True, recsys.user_id_map,
+        ...     recsys.item_id_map, recsys.user_ids, recsys.item_ids)
+        >>> np.allclose([recsys.predict_rating(0, i) for i in range(21)],
+        ...             [rebuilt.predict_rating(0, i) for i in range(21)])
+        True
+
+        >>> recsys = RecSysBaseLine()
+        >>> recsys.set_precompute(num_neighbors=None)
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> recsys.add_ratings([("U1", "I3", 5), ("U9", "I21", 4)])
+        >>> rebuilt = RecSysBaseLine()
+        >>> rebuilt.set_precompute(num_neighbors=None)
+        >>> rebuilt.load_ratings_matrix(
+        ...     recsys.util_mat, True, recsys.user_id_map,
+        ...     recsys.item_id_map, recsys.user_ids, recsys.item_ids)
+        >>> all(np.array_equal(getattr(recsys, name), getattr(rebuilt, name))
+        ...     for name in ["neighbor_indptr", "neighbor_indices"])
+        True
+        >>> np.allclose(recsys.neighbor_weights, rebuilt.neighbor_weights)
+        True
+        """
+
+        num_items = self.util_mat.shape[1]
+        affected = np.zeros(num_items, dtype=bool)
+        affected[self.util_mat[users].indices] = True
+
+        self.similarity_cache.invalidate_items(affected)
+        self.similarity_mat = None
+        self.similarity_computed = False
+
+        if self.neighbor_indptr is not None:
+            self.build_neighbor_index(self.num_neighbors, self.block_size,
+                                      np.flatnonzero(affected),
+                                      self.use_neighbor_index)
+
+    def save_model(self, path):
+        """
+        Save the model into the directory path: the neighbor index (which is
+        built first if it does not exist), together with the ratings and the
+        ID mappings (see save_compiled()). Building the index here does not
+        change the predictions; whether they use the index is saved too.
+
+        >>> import shutil, tempfile
+        >>> recsys = RecSysBaseLine()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> path = tempfile.mkdtemp()
+        >>> recsys.save_model(path)
+        >>> loaded = RecSysBaseLine()
+        >>> loaded.load_model(path)
+        >>> user_idx = loaded.get_user_idx("U1")
+        >>> [(item, "%.2f" %sim)
+        ...  for (item, sim) in loaded.predict_top_k_recomm(user_idx, 2)]
+        [(15, '4.00'), (16, '4.00')]
+        >>> recsys.use_neighbor_index, loaded.use_neighbor_index
+        (False, False)
+        >>> shutil.rmtree(path)
+        """
+        if self.neighbor_indptr is None:
+            self.build_neighbor_index(self.num_neighbors, self.block_size,
+                                      predict=False)
+        self.save_compiled(
+                path, {"model": "BLRS", "num_neighbors": self.num_neighbors,
+                       "use_neighbor_index": self.use_neighbor_index,
+                       "ratings_source": self.ratings_source})
+        np.save(os.path.join(path, "neighbor_indptr.npy"),
+                self.neighbor_indptr)
+        np.save(os.path.join(path, "neighbor_indices.npy"),
+                self.neighbor_indices)
+        np.save(os.path.join(path, "neighbor_weights.npy"),
+                self.neighbor_weights)
+
+    def load_model(self, path, mmap_mode="r"):
+        """
+        Load a model saved by save_model() from the directory path, instead
+        of computing the similarities again. The arrays are memory-mapped.
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        assert meta.get("model") == "BLRS", \
+            "Bad model file. path = [{}]".format(path)
+
+        self.reset_ids()
+        self.load_compiled(path, mmap_mode=mmap_mode)
+        self.similarity_mat = None
+        self.similarity_cache.clear()
+        self.similarity_computed = False
+        self.num_neighbors = meta["num_neighbors"]
+        self.ratings_source = meta.get("ratings_source")
+        self.use_neighbor_index = meta.get("use_neighbor_index", True)
+        self.neighbor_indptr = np.load(
+                os.path.join(path, "neighbor_indptr.npy"), mmap_mode=mmap_mode)
+        self.neighbor_indices = np.load(
+                os.path.join(path, "neighbor_indices.npy"),
+                mmap_mode=mmap_mode)
+        self.neighbor_weights = np.load(
+                os.path.join(path, "neighbor_weights.npy"),
+                mmap_mode=mmap_mode)
+        self.model_changed()
+
+    def iter_similarity_blocks(self, block_size=1000, items=None):
+        """
+        Compute the adjusted cosine similarities between all items and the
+        target items (all items if items is None), block_size target items at
+        a time. For every block items[begin:end] yield
+        (begin, end, rows, cols, sim, count), where the last four arrays are
+        aligned: item rows[i] and item items[begin + cols[i]] are co-rated by
+        count[i] users and have the similarity sim[i].
+
+        Similarities follow the same definition as in predict_rating(): the
+        ratings are centered by the users' means and the norms are taken over
+        the co-rating users only. Pairs without any co-rating user are not
+        yielded. sim is nan where one of the norms is zero.
+        """
+
+        mat = self.util_mat.tocsr(copy=True)
+        mat.eliminate_zeros()
+        num_users, num_items = mat.shape
+
+        # center every rating by the mean of its user, once for all items
+        means = np.asarray(self.user_rating_means, dtype=float)
+        rows_of_nnz = np.repeat(np.arange(num_users), np.diff(mat.indptr))
+        centered = csr_matrix(
+                (mat.data - means[rows_of_nnz], mat.indices, mat.indptr),
+                shape=mat.shape)
+        squared = centered.multiply(centered).tocsr()
+        binary = csr_matrix(
+                (np.ones(mat.nnz), mat.indices, mat.indptr), shape=mat.shape)
+
+        centered_t = centered.T.tocsr()
+        binary_t = binary.T.tocsr()
+        squared_t = squared.T.tocsr()
+        centered_c = centered.tocsc()
+        binary_c = binary.tocsc()
+        squared_c = squared.tocsc()
+
+        items = np.arange(num_items) if items is None else np.asarray(items)
+        for begin in range(0, len(items), block_size):
+            end = min(begin + block_size, len(items))
+            targets = items[begin:end]
+
+            # the co-rating counts define which pairs exist in this block
+            count = (binary_t @ binary_c[:, targets]).tocoo()
+            rows, cols = count.row, count.col
+
+            # the products are looked up at the co-rated pairs, which is a
+            # binary search per pair only once their indices are sorted
+            sums = []
+            for left, right in [(centered_t, centered_c),
+                                (squared_t, binary_c),
+                                (binary_t, squared_c)]:
+                product = left @ right[:, targets]
+                product.sort_indices()
+                sums.append(np.asarray(product[rows, cols]).ravel())
+            xy, x, y = sums
+            with np.errstate(divide='ignore', invalid='ignore'):
+                sim = xy / np.sqrt(x) / np.sqrt(y)
+
+            yield begin, end, rows, cols, sim, count.data
+
+    def build_similarity_mat(self, block_size=1000):
+        """
+        Compute the similarities between all pairs of items by blocked sparse
+        matrix products, and store them in the top half part of the
+        similarity_mat. Pairs with at most one co-rating user are stored as -1,
+        the same as predict_rating() does.
+
+        >>> recsys = RecSysBaseLine()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> user_idx = recsys.get_user_idx("U1")
+        >>> lazy = [recsys.predict_rating(user_idx, i) for i in range(20)]
+        >>> recsys.build_similarity_mat(block_size=3)
+        >>> bulk = [recsys.predict_rating(user_idx, i) for i in range(20)]
+        >>> np.allclose(lazy, bulk)
+        True
+        >>> "%.2f" %recsys.get_similarity(recsys.get_item_idx("I1"),
+        ...                               recsys.get_item_idx("I4"))
+        '0.35'
+        """
+
         num_items = self.util_mat.shape[1]
-        self.similarity_mat = lil_matrix((num_items, num_items), dtype=float)
+        all_rows = []
+        all_cols = []
+        all_sims = []
+        for begin, end, rows, cols, sim, count in \
+                self.iter_similarity_blocks(block_size):
+            cols = cols + begin
+            # only keep the top half part of the matrix (with the diagonal)
+            upper = rows <= cols
+            rows, cols, sim, count = \
+                rows[upper], cols[upper], sim[upper], count[upper]
+
+            # reject the pairs with a single co-rating user, and the pairs
+            # whose similarity is undefined
+            sim = np.where((count > 1) & np.isfinite(sim), sim, -1)
+
+            all_rows.append(rows)
+            all_cols.append(cols)
+            all_sims.append(sim)
+
+        self.similarity_mat = csr_matrix(
+                (np.concatenate(all_sims) if all_sims else [],
+                 (np.concatenate(all_rows) if all_rows else [],
+                  np.concatenate(all_cols) if all_cols else [])),
+                dtype=float,
+                shape=(num_items, num_items))
+        self.similarity_computed = True
+
+    def build_neighbor_index(self, num_neighbors=50, block_size=1000,
+                             items=None, predict=True):
+        """
+        Build the neighbor index: for every item, keep the num_neighbors items
+        with the highest positive similarity to it (all of them if
+        num_neighbors is None). The item itself and the pairs with at most one
+        co-rating user are excluded. Ties are broken by the larger item index,
+        the same as predict_rating() does. The memory is O(items x N).
+        If items is given, only the neighbors of these items are rebuilt, and
+        the rest of the existing index is kept.
+        If predict is True, predict_rating(), predict_ratings() and the top-k
+        recommendations use the index from then on; otherwise it only serves
+        similar_items().
+
+        >>> recsys = RecSysBaseLine()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> recsys.build_neighbor_index(num_neighbors=3, block_size=4)
+        >>> recsys.neighbor_indptr[:6]
+        array([ 0,  3,  6,  9, 12, 15])
+        >>> recsys.neighbor_indices[:3]
+        array([5, 1, 7], dtype=int32)
+        """
+
+        with self.profiler.phase("build_neighbor_index"):
+            num_items = self.util_mat.shape[1]
+            targets = np.arange(num_items) if items is None \
+                else np.asarray(items)
+            counts = np.zeros(len(targets), dtype=np.int64)
+            all_indices = []
+            all_weights = []
+            for begin, end, rows, cols, sim, count in \
+                    self.iter_similarity_blocks(block_size, targets):
+                keep = (count > 1) & (sim > 0) \
+                    & (rows != targets[cols + begin])
+                rows, cols, sim = rows[keep], cols[keep], sim[keep]
+
+                # group by the target item, then sort by descending
+                # similarity and descending item index
+                order = np.lexsort((-rows, -sim, cols))
+                rows, cols, sim = rows[order], cols[order], sim[order]
+
+                # the rank of each neighbor within its target item
+                block_counts = np.bincount(cols, minlength=end - begin)
+                starts = np.cumsum(block_counts) - block_counts
+                ranks = np.arange(len(cols)) - starts[cols]
+                if num_neighbors is not None:
+                    keep = ranks < num_neighbors
+                    rows, sim = rows[keep], sim[keep]
+                    block_counts = np.minimum(block_counts, num_neighbors)
+
+                counts[begin:end] = block_counts
+                all_indices.append(rows.astype(np.int32))
+                all_weights.append(sim)
+
+            indices = np.concatenate(all_indices) if all_indices \
+                else np.zeros(0, dtype=np.int32)
+            weights = np.concatenate(all_weights) if all_weights \
+                else np.zeros(0)
+
+            if items is not None:
+                # splice the rebuilt rows into the old index, which may have
+                # fewer items: keep the old neighbors of the other items, and
+                # put all the neighbors in the order of their target item
+                old_counts = np.zeros(num_items, dtype=np.int64)
+                old_counts[:len(self.neighbor_indptr) - 1] = \
+                    np.diff(self.neighbor_indptr)
+                old_owners = np.repeat(np.arange(num_items), old_counts)
+                rebuilt = np.zeros(num_items, dtype=bool)
+                rebuilt[targets] = True
+                old_keep = ~rebuilt[old_owners]
+                owners = np.concatenate(
+                        (old_owners[old_keep], np.repeat(targets, counts)))
+                order = np.argsort(owners, kind='stable')
+                indices = np.concatenate(
+                        (self.neighbor_indices[old_keep], indices))[order]
+                weights = np.concatenate(
+                        (self.neighbor_weights[old_keep], weights))[order]
+                old_counts[targets] = counts
+                counts = old_counts
+
+            self.neighbor_indptr = np.concatenate(([0], np.cumsum(counts)))
+            self.neighbor_indices = indices
+            self.neighbor_weights = weights
+        self.use_neighbor_index = predict
+        self.model_changed()
+
+    def similar_items(self, item_idx, n=10):
+        """
+        Return at most n pairs of (item_idx, similarity) of the items most
+        similar to the given item, in descending order of the similarity.
+        The result is read from the neighbor index, which is built first if
+        it does not exist, without making the predictions use it.
+
+        >>> recsys = RecSysBaseLine()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> item_idx = recsys.get_item_idx("I4")
+        >>> [(recsys.get_item_id(i), "%.2f" %sim)
+        ...  for (i, sim) in recsys.similar_items(item_idx, 2)]
+        [('I11', '1.00'), ('I7', '0.94')]
+        >>> recsys.use_neighbor_index
+        False
+        """
+
+        if self.neighbor_indptr is None:
+            self.build_neighbor_index(self.num_neighbors, self.block_size,
+                                      predict=False)
+
+        begin = self.neighbor_indptr[item_idx]
+        end = min(begin + n, self.neighbor_indptr[item_idx + 1])
+        return list(zip(self.neighbor_indices[begin:end],
+                        self.neighbor_weights[begin:end]))
+
+    def similar_items_batch(self, item_idxs, n=10):
+        """
+        Return similar_items() of each item in item_idxs.
+        """
+        return [self.similar_items(item_idx, n) for item_idx in item_idxs]
 
     def get_similarity(self, item_idx1, item_idx2):
         """
-        Get the similarity between item1 and item2.
+        Get the similarity between item1 and item2, from the similarity_mat
+        if it is built, or else from the similarity cache (None if it has
+        not been computed).
         To keep the sparsity of the similarity_mat, we always store the value
         in only the top half part of the matrix.
         """
+        if not self.similarity_computed:
+            return self.similarity_cache.get(item_idx1, item_idx2)
+
         smaller_idx = item_idx1 if item_idx1 < item_idx2 else item_idx2
         larger_idx = item_idx2 if item_idx1 < item_idx2 else item_idx1
 
@@ -32,14 +450,9 @@ class RecSysBaseLine(Repo):
 
     def set_similarity(self, item_idx1, item_idx2, sim):
         """
-        Set the similarity between item1 and item2.
-        To keep the sparsity of the similarity_mat, we always store the value
-        in only the top half part of the matrix.
+        Set the similarity between item1 and item2 in the similarity cache.
         """
-        smaller_idx = item_idx1 if item_idx1 < item_idx2 else item_idx2
-        larger_idx = item_idx2 if item_idx1 < item_idx2 else item_idx1
-
-        self.similarity_mat[smaller_idx, larger_idx] = sim
+        self.similarity_cache.put_many(item_idx2, [item_idx1], [sim])
 
     def predict_rating(self, target_user_idx, target_item_idx, N=50):
         """
@@ -58,68 +471,109 @@ class RecSysBaseLine(Repo):
         '4.00'
         >>> "%.2f" %recsys.predict_rating(user_idx, item_idx)
         '4.00'
+        >>> recsys.build_neighbor_index(num_neighbors=None)
+        >>> "%.2f" %recsys.predict_rating(user_idx, item_idx)
+        '4.00'
         """
 
+        self.profiler.count("predict_rating")
+
         # list all items which the active user has already rated
-        rated_items = self.util_mat[target_user_idx].nonzero()[1]
+        rated_items, user_ratings = self.items_rated_by(
+                target_user_idx, return_ratings=True)
+
+        # if the neighbor index is used, the prediction is the dot product
+        # between the user's ratings and the target item's neighbor list
+        if self.use_neighbor_index:
+            begin = self.neighbor_indptr[target_item_idx]
+            end = self.neighbor_indptr[target_item_idx + 1]
+            neighbors = self.neighbor_indices[begin:end]
+            weights = self.neighbor_weights[begin:end]
+            pos = np.minimum(np.searchsorted(rated_items, neighbors),
+                             max(len(rated_items) - 1, 0))
+            ratings = np.where(rated_items[pos] == neighbors,
+                               user_ratings[pos], 0) \
+                if len(rated_items) else np.zeros(len(neighbors))
+
+            # the neighbors are sorted, only the first N rated ones are used
+            rated = np.flatnonzero(ratings)[:N]
+            denom = np.sum(weights[rated])
+            if denom == 0:
+                return self.get_avg_rating(target_user_idx)
+            return np.dot(weights[rated], ratings[rated]) / denom
+
         # list all users who has rated the target item
-        rated_users = self.util_mat[:, target_item_idx].nonzero()[0]
+        rated_users, target_ratings = self.users_who_rated(
+                target_item_idx, return_ratings=True)
 
         # effective items are the items that both target_user and at least one
         # other user has rated, where the other user has also rated the target
         # item. These are all the items we need to consider in the following
         # collaborative filtering.
-        effective_items = []
-        for user in rated_users:
-            effective_items = np.union1d(
-                    effective_items, self.util_mat[user].nonzero()[1])
-        effective_items = np.intersect1d(effective_items, rated_items)
+        co_rated_items = [self.items_rated_by(user) for user in rated_users]
+        effective_items = np.intersect1d(
+                np.concatenate(co_rated_items) if co_rated_items else [],
+                rated_items).astype(int)
+
+        # look up the similarities between the effective items and the
+        # target item which have already been computed
+        if self.similarity_computed:
+            cached = [self.get_similarity(item_idx, target_item_idx)
+                      for item_idx in effective_items]
+        else:
+            cached = self.similarity_cache.get_many(
+                    target_item_idx, effective_items)
 
         most_similar_items = {}
-        for item_idx in effective_items:
+        new_items, new_sims = [], []
+        cache_hits = 0
+        for item_idx, sim in zip(effective_items, cached):
             item_idx = int(item_idx)
-
-            # check if the similarity between the current item and the target
-            # item has already been computed
-            sim = self.get_similarity(item_idx, target_item_idx)
-            if sim != 0:
+            if sim is not None:
                 if sim > 0:
                     most_similar_items[item_idx] = sim
+                cache_hits += 1
                 continue
 
             # the set of all users who has rated both the current item and the
             # target item
-            u_xy = np.intersect1d(
-                self.util_mat[:, item_idx].nonzero()[0],
-                self.util_mat[:, target_item_idx].nonzero()[0])
+            item_users, item_ratings = self.users_who_rated(
+                    item_idx, return_ratings=True)
+            u_xy, idx_x, idx_y = np.intersect1d(
+                    item_users, rated_users,
+                    assume_unique=True, return_indices=True)
 
             # if the number of co-rating user is 1, the similarity score will
             # always be 1 regardless the ratings might be different. in this
             # case we don't consider the item as similar.
             if len(u_xy) <= 1:
-                self.set_similarity(item_idx, target_item_idx, -1)
+                new_items.append(item_idx)
+                new_sims.append(-1)
                 continue
 
             # compute the similarity between the current item and the target
             # item, based on all the users in u_xy
-            x = 0
-            y = 0
-            xy = 0
-            for u in u_xy:
-                r_ux = self.util_mat[u, item_idx]
-                r_uy = self.util_mat[u, target_item_idx]
-                r_u = self.get_avg_rating(u)
-
-                xy += (r_ux - r_u) * (r_uy - r_u)
-                x += np.square(r_ux - r_u)
-                y += np.square(r_uy - r_u)
+            r_u = np.asarray(self.user_rating_means)[u_xy]
+            r_ux = item_ratings[idx_x] - r_u
+            r_uy = target_ratings[idx_y] - r_u
+            xy = np.dot(r_ux, r_uy)
+            x = np.dot(r_ux, r_ux)
+            y = np.dot(r_uy, r_uy)
             sim = xy / np.sqrt(x) / np.sqrt(y)
-            self.set_similarity(item_idx, target_item_idx, sim)
+            new_items.append(item_idx)
+            new_sims.append(sim)
 
             # only consider the item with a positive similarity
             if sim > 0:
                 most_similar_items[item_idx] = sim
 
+        if new_items:
+            self.similarity_cache.put_many(
+                    target_item_idx, new_items, new_sims)
+        self.profiler.count("similarity_cache_hits", cache_hits)
+        self.profiler.count("similarity_cache_misses",
+                            len(effective_items) - cache_hits)
+
         # compute the predicted rating of the target item from the ratings of
         # the N most similar items
         sorted_items = sorted(
@@ -129,49 +583,366 @@ class RecSysBaseLine(Repo):
         for i, (item_idx, similarity) in enumerate(sorted_items):
             if i >= N:
                 break
-            num += similarity * self.util_mat[target_user_idx, item_idx]
+            rating = user_ratings[np.searchsorted(rated_items, item_idx)]
+            num += similarity * rating
             denom += abs(similarity)
         prediction = \
             num / denom if denom != 0 else self.get_avg_rating(target_user_idx)
 
         return prediction
 
-    def predict_top_k_recomm(self, user_idx, k):
+    def predict_ratings(self, user_idxs, item_idxs, N=50,
+                        max_elements=2**22):
+        """
+        Return the predicted ratings of a batch of (user, item) pairs, given
+        as two parallel index arrays, in a numpy array.
+
+        If the neighbor index is used, the neighbor lists of all target items
+        are gathered into one sparse matrix and multiplied element-wise with
+        the users' rating rows, so the whole batch is handled by a few sparse
+        operations. Otherwise the similarities of the distinct target items
+        are computed by iter_similarity_blocks(), block_size items at a time,
+        and the pairs of every block are predicted in the same way, with at
+        most about max_elements similarities gathered at once. A small batch
+        (see pair_cost) goes through predict_rating() and its similarity
+        cache instead.
+
+        >>> recsys = RecSysBaseLine()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> users, items = [0, 0, 3, 5, 5], [15, 16, 0, 2, 3]
+        >>> lazy = recsys.predict_ratings(users, items, N=2, max_elements=10)
+        >>> ["%.2f" %rating for rating in lazy]
+        ['4.00', '4.00', '1.42', '2.44', '5.00']
+        >>> np.allclose(lazy, [recsys.predict_rating(user_idx, item_idx, 2)
+        ...                    for user_idx, item_idx in zip(users, items)])
+        True
+        >>> recsys.build_neighbor_index(num_neighbors=None)
+        >>> np.allclose(lazy, recsys.predict_ratings(users, items, N=2))
+        True
+        """
+
+        user_idxs = np.asarray(user_idxs, dtype=int)
+        item_idxs = np.asarray(item_idxs, dtype=int)
+        num_items = self.util_mat.shape[1]
+        if self.use_neighbor_index:
+            neighbor_mat = csr_matrix(
+                    (self.neighbor_weights, self.neighbor_indices,
+                     self.neighbor_indptr),
+                    shape=(num_items, num_items))
+            return self.predict_from_neighbors(
+                    user_idxs, neighbor_mat[item_idxs], N)
+        if len(user_idxs) * self.pair_cost < self.util_mat.nnz:
+            return np.array([self.predict_rating(user_idx, item_idx, N)
+                             for user_idx, item_idx in
+                             zip(user_idxs, item_idxs)], dtype=float)
+
+        predictions = np.zeros(len(user_idxs))
+        targets, inverse = np.unique(item_idxs, return_inverse=True)
+        for begin, end, rows, cols, sim, count in \
+                self.iter_similarity_blocks(self.block_size, targets):
+            # the similar items of every target item in this block, the same
+            # ones as predict_rating() keeps
+            keep = (count > 1) & (sim > 0)
+            sim_mat = csr_matrix(
+                    (sim[keep], (cols[keep], rows[keep])),
+                    shape=(end - begin, num_items))
+
+            # split the pairs of the block so that at most about max_elements
+            # similarities are gathered at a time
+            pairs = np.flatnonzero((inverse >= begin) & (inverse < end))
+            sizes = np.diff(sim_mat.indptr)[inverse[pairs] - begin]
+            chunks = np.cumsum(sizes) // max_elements
+            bounds = np.flatnonzero(np.diff(chunks)) + 1
+            for chunk in np.split(pairs, bounds):
+                predictions[chunk] = self.predict_from_neighbors(
+                        user_idxs[chunk], sim_mat[inverse[chunk] - begin], N)
+        return predictions
+
+    def predict_from_neighbors(self, user_idxs, neighbor_rows, N=50):
+        """
+        Return the predicted ratings of the users in user_idxs, where row i
+        of the sparse matrix neighbor_rows holds the positive similarities
+        between the target item of user_idxs[i] and the other items. Every
+        prediction is the weighted mean of the user's ratings of the N most
+        similar items they rated (ties broken by the larger item index), or
+        the user's mean rating if there are none.
+        """
+
+        # the weights of the neighbors that each user has rated, one row per
+        # (user, item) pair
+        rated = self.util_mat[user_idxs].astype(bool).astype(float)
+        weights = rated.multiply(neighbor_rows).tocoo()
+        rows, cols, weights = weights.row, weights.col, weights.data
+        ratings = np.asarray(self.util_mat[user_idxs[rows], cols]).ravel()
+
+        # only the first N rated neighbors of each pair are used, in the same
+        # order as the neighbor lists
+        order = np.lexsort((-cols, -weights, rows))
+        rows, weights, ratings = rows[order], weights[order], ratings[order]
+        counts = np.bincount(rows, minlength=len(user_idxs))
+        ranks = np.arange(len(rows)) - (np.cumsum(counts) - counts)[rows]
+        keep = ranks < N
+        rows, weights, ratings = rows[keep], weights[keep], ratings[keep]
+
+        num = np.bincount(rows, weights=weights * ratings,
+                          minlength=len(user_idxs))
+        denom = np.bincount(rows, weights=weights, minlength=len(user_idxs))
+        means = np.asarray(self.user_rating_means)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(denom != 0, num / denom, means[user_idxs])
+
+    def predict_top_k_recomm(self, user_idx, k, max_candidates=None):
         """
         Return top k pairs of (item_idx, predicted_rating) according to the
         order of the predicted_rating.
+        The candidate items come from candidate_items(), with at most
+        max_candidates of them scored.
 
         >>> recsys = RecSysBaseLine()
         >>> recsys.load_ratings("testcase_ratings.csv")
         >>> user_idx = recsys.get_user_idx("U1")
         >>> predictions = recsys.predict_top_k_recomm(user_idx, 2)
         >>> [(item, "%.2f" %sim) for (item, sim) in predictions]
-        [(15.0, '4.00'), (16.0, '4.00')]
+        [(15, '4.00'), (16, '4.00')]
         """
 
-        # list all items which the active user has already rated
-        rated_items = self.util_mat[user_idx].nonzero()[1]
-
-        # candidate items are items that can be recommanded to the target user.
-        # It is generated from the following manner: First, find out all the
-        # users that has rated the items the target user has also rated. Then,
-        # union all the items these user has rated. Finally, exclude the items
-        # the target user has already rated.
-        candidate_items = []
-        user_list = []
-        for item_idx in rated_items:
-            user_list = np.union1d(
-                    user_list, self.util_mat[:, item_idx].nonzero()[0])
-        for user in user_list:
-            candidate_items = np.union1d(
-                    candidate_items, self.util_mat[user].nonzero()[1])
-        candidate_items = np.setdiff1d(candidate_items, rated_items)
-
-        predictions = []
-        for item_idx in candidate_items:
-            rating = self.predict_rating(user_idx, item_idx)
-            if rating > 0:
-                predictions.append((item_idx, rating))
-        predictions.sort(key=lambda tup: tup[1], reverse=True)
-
-        return predictions[0: k] if len(predictions) > k else predictions
+        return self.predict_top_k_recomm_batch(
+                [user_idx], k, max_candidates=max_candidates)[0]
+
+    def predict_top_k_recomm_batch(
+            self, user_idxs, k, max_candidates=None, block_size=256,
+            use_cache=True):
+        """
+        Return, for each user in user_idxs, the top k pairs of
+        (item_idx, predicted_rating) according to the order of the
+        predicted_rating, the same as predict_top_k_recomm().
+        The users are handled in blocks of block_size: the candidate items of
+        a block come from one candidate_items() call and are scored by one
+        predict_ratings() call.
+        The users found in the top-k cache (see set_topk_cache()) are not
+        computed again, unless use_cache is False.
+
+        >>> recsys = RecSysBaseLine()
+        >>> recsys.load_ratings("testcase_ratings.csv")
+        >>> users = range(len(recsys.user_ids))
+        >>> all_users = recsys.predict_top_k_recomm_batch(users, 3, None, 3)
+        >>> all_users == [recsys.predict_top_k_recomm(u, 3) for u in users]
+        True
+        >>> [(item, "%.2f" %sim) for (item, sim) in all_users[0][:2]]
+        [(15, '4.00'), (16, '4.00')]
+        """
+
+        user_idxs = np.asarray(user_idxs, dtype=int)
+        if use_cache and self.topk_cache is not None:
+            return self.cached_top_k_recomm(
+                    user_idxs, k, max_candidates,
+                    lambda users: self.predict_top_k_recomm_batch(
+                        users, k, max_candidates, block_size, False))
+
+        recommendations = []
+        profiler = self.profiler
+        for begin in range(0, len(user_idxs), block_size):
+            users = user_idxs[begin:begin + block_size]
+            with profiler.phase("candidate_items"):
+                candidates = self.candidate_items(users, max_candidates)
+            counts = np.diff(candidates.indptr)
+            if profiler.enabled:
+                for count in counts:
+                    profiler.observe("candidates_per_user", int(count))
+            with profiler.phase("score_candidates"):
+                ratings = self.predict_ratings(
+                        np.repeat(users, counts), candidates.indices)
+
+            with profiler.phase("rank_candidates"):
+                for row in range(len(users)):
+                    begin_row, end_row = candidates.indptr[row:row + 2]
+                    items = candidates.indices[begin_row:end_row]
+                    row_ratings = ratings[begin_row:end_row]
+
+                    # only items with a positive predicted rating are
+                    # recommended, sorted by the rating (ties by the item
+                    # index)
+                    positive = row_ratings > 0
+                    items, row_ratings = items[positive], row_ratings[positive]
+                    order = np.argsort(-row_ratings, kind='stable')[:k]
+                    recommendations.append(
+                            list(zip(items[order], row_ratings[order])))
+        profiler.count("top_k_users", len(user_idxs))
+
+        return recommendations
+
+
+class SimilarityCache():
+    """
+    A bounded cache of item-item similarities for the lazy path of
+    predict_rating(), safe to use from several threads. A pair is stored
+    once for both orders; absent pairs are returned as None, so any stored
+    value (including 0 and the -1 of rejected pairs) is a hit.
+
+    Every entry belongs to the target item it was computed for. The number
+    of requests of every target item is counted, and when there are more
+    than max_entries entries (or more than max_bytes estimated bytes), the
+    entries of the least requested targets are evicted, down to
+    evict_ratio of the bound. The request counts are halved at every
+    eviction, so the old requests weigh less than the recent ones.
+    """
+
+    entry_bytes = 120  # estimated size of an entry
+    evict_ratio = 0.9
+
+    def __init__(self, max_entries=2**22, max_bytes=None):
+        assert max_entries is None or max_entries > 0, \
+            "Bad parameter. max_entries = [{}]".format(max_entries)
+        assert max_bytes is None or max_bytes >= self.entry_bytes, \
+            "Bad parameter. max_bytes = [{}]".format(max_bytes)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.capacity = min(
+                max_entries if max_entries is not None else np.inf,
+                max_bytes // self.entry_bytes if max_bytes is not None
+                else np.inf)
+        self.lock = threading.Lock()
+        self.entries = {}  # pair key -> similarity
+        self.target_keys = {}  # target item_idx -> keys of its entries
+        self.requests = {}  # target item_idx -> (decayed) request count
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __getstate__(self):
+        # the lock is not copied or pickled, every copy gets its own
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def pair_key(item_idx1, item_idx2):
+        if item_idx1 > item_idx2:
+            item_idx1, item_idx2 = item_idx2, item_idx1
+        return (int(item_idx1) << 32) | int(item_idx2)
+
+    @staticmethod
+    def pair_keys(target_item_idx, item_idxs):
+        item_idxs = np.asarray(item_idxs, dtype=np.int64)
+        return ((np.minimum(item_idxs, target_item_idx) << 32)
+                | np.maximum(item_idxs, target_item_idx)).tolist()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, item_idx1, item_idx2):
+        """
+        Return the similarity of the pair, or None if it is not cached.
+        """
+        with self.lock:
+            return self.entries.get(self.pair_key(item_idx1, item_idx2))
+
+    def get_many(self, target_item_idx, item_idxs):
+        """
+        Count a request of the target item, and return the similarities
+        between it and every item in item_idxs (None where not cached).
+
+        >>> cache = SimilarityCache(max_entries=10)
+        >>> cache.put_many(0, [1, 2, 3], [0., -1., .5])
+        >>> cache.get_many(0, [1, 2, 4])
+        [0.0, -1.0, None]
+        >>> cache.put_many(5, [6, 7], [.5, .6])
+        >>> cache.put_many(8, range(10, 16), [.1] * 6)
+        >>> len(cache), cache.get(1, 0), cache.get(5, 6)
+        (9, 0.0, None)
+        >>> cache.stats()["evictions"], cache.stats()["hits"]
+        (2, 2)
+        """
+        target_item_idx = int(target_item_idx)
+        keys = self.pair_keys(target_item_idx, item_idxs)
+        with self.lock:
+            self.requests[target_item_idx] = \
+                self.requests.get(target_item_idx, 0) + 1
+            sims = [self.entries.get(key) for key in keys]
+            misses = sims.count(None)
+            self.hits += len(sims) - misses
+            self.misses += misses
+        return sims
+
+    def put_many(self, target_item_idx, item_idxs, sims):
+        """
+        Cache the similarities between the target item and every item in
+        item_idxs, and evict entries if the cache is over its bound.
+        """
+        target_item_idx = int(target_item_idx)
+        keys = self.pair_keys(target_item_idx, item_idxs)
+        with self.lock:
+            owned = self.target_keys.setdefault(target_item_idx, [])
+            for key, sim in zip(keys, sims):
+                if key not in self.entries:
+                    self.entries[key] = sim
+                    owned.append(key)
+            if len(self.entries) > self.capacity:
+                self.evict(target_item_idx)
+
+    def evict(self, keep_target):
+        """
+        Evict the entries of the least requested targets, except
+        keep_target unless it is the only one. The lock must be held.
+        """
+        targets = sorted(self.target_keys,
+                         key=lambda t: (t == keep_target,
+                                        self.requests.get(t, 0)))
+        limit = int(self.capacity * self.evict_ratio)
+        for target in targets:
+            if len(self.entries) <= limit:
+                break
+            for key in self.target_keys.pop(target):
+                if self.entries.pop(key, None) is not None:
+                    self.evictions += 1
+
+        # decay the request counts, and forget the targets that are neither
+        # cached nor requested recently
+        for target in list(self.requests):
+            self.requests[target] /= 2
+            if self.requests[target] < 1 and target not in self.target_keys:
+                del self.requests[target]
+
+    def invalidate_items(self, affected):
+        """
+        Drop the pairs of which both items are marked in the boolean array
+        affected (e.g. the items rated by the users whose ratings changed).
+        """
+        with self.lock:
+            if not self.entries:
+                return
+            keys = np.fromiter(self.entries, dtype=np.int64,
+                               count=len(self.entries))
+            smaller, larger = keys >> 32, keys & 0xffffffff
+            drop = (smaller < len(affected)) & (larger < len(affected))
+            drop[drop] = affected[smaller[drop]] & affected[larger[drop]]
+            for key in keys[drop].tolist():
+                del self.entries[key]
+            self.invalidations += int(np.count_nonzero(drop))
+            for target, owned in self.target_keys.items():
+                self.target_keys[target] = \
+                    [key for key in owned if key in self.entries]
+
+    def clear(self):
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.target_keys.clear()
+            self.requests.clear()
+
+    def stats(self):
+        """
+        Return the size and the counters of the cache in a dict.
+        """
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries),
+                "bytes": len(self.entries) * self.entry_bytes,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations}
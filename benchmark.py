@@ -0,0 +1,331 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from Base import Repo, Profiler
+from RecSysBaseLine import RecSysBaseLine
+from RecSysAdv import RecSysAdv
+from EvaSys import EvaSys
+
+
+def parse_size(text):
+    """
+    Parse a number of ratings such as "10000", "10k" or "1m".
+
+    >>> parse_size("10000"), parse_size("10k"), parse_size("1.5M")
+    (10000, 10000, 1500000)
+    """
+    text = text.lower()
+    scale = {"k": 10**3, "m": 10**6}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * scale)
+
+
+def generate_ratings(filename, num_ratings, seed, alpha):
+    """
+    Write num_ratings distinct synthetic ratings to filename, in the format
+    of the rating files. The activity of the users and the popularity of the
+    items follow power laws with exponent alpha: the i-th user (item) is
+    drawn with a probability proportional to 1 / (i + 1)^alpha. A rating is
+    3 plus a user bias, an item bias and noise, rounded and clipped to 1-5.
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile("r", suffix=".csv") as f:
+    ...     generate_ratings(f.name, 2000, 0, 1.)
+    ...     repo = Repo()
+    ...     repo.load_ratings(f.name)
+    >>> repo.util_mat.nnz
+    2000
+    >>> set(repo.util_mat.data) <= {1., 2., 3., 4., 5.}
+    True
+    """
+    rng = np.random.default_rng(seed)
+    num_users = max(num_ratings // 25, 100)
+    num_items = max(num_ratings // 100, 100)
+    user_p = 1. / np.arange(1, num_users + 1) ** alpha
+    item_p = 1. / np.arange(1, num_items + 1) ** alpha
+    user_p /= user_p.sum()
+    item_p /= item_p.sum()
+
+    # draw pairs until there are enough distinct ones; the popular pairs
+    # repeat, so later draws add fewer new pairs
+    keys = np.zeros(0, dtype=np.int64)
+    while len(keys) < num_ratings:
+        size = 2 * (num_ratings - len(keys)) + 1000
+        users = rng.choice(num_users, size, p=user_p)
+        items = rng.choice(num_items, size, p=item_p)
+        keys = np.unique(np.concatenate(
+            (keys, users.astype(np.int64) * num_items + items)))
+    keys = rng.permutation(keys)[:num_ratings]
+    users, items = np.divmod(keys, num_items)
+
+    user_bias = rng.normal(0, 0.5, num_users)
+    item_bias = rng.normal(0, 0.5, num_items)
+    ratings = np.clip(np.rint(3 + user_bias[users] + item_bias[items]
+                              + rng.normal(0, 0.8, num_ratings)), 1, 5)
+    times = rng.integers(10**9, 2 * 10**9, num_ratings)
+
+    with open(filename, 'w') as f:
+        for begin in range(0, num_ratings, 10**6):
+            end = begin + 10**6
+            f.writelines(
+                "U{},I{},{:.0f},{}\n".format(*row) for row in zip(
+                    users[begin:end], items[begin:end], ratings[begin:end],
+                    times[begin:end]))
+
+
+def new_model(model, args):
+    if model == "BLRS":
+        rec_sys = RecSysBaseLine()
+        rec_sys.set_precompute(not args.lazy)
+    else:
+        rec_sys = RecSysAdv()
+        rec_sys.set_rank(args.rank)
+        rec_sys.set_solver(args.solver)
+    return rec_sys
+
+
+def run_phase(profiler, name, function):
+    """
+    Run function() as the phase name of profiler. Return its result, the
+    seconds it took and its peak memory (None if memory is not tracked).
+    """
+    with profiler.phase(name):
+        result = function()
+    stats = profiler.phases[name]
+    return result, stats["total_sec"], stats.get("peak_bytes")
+
+
+def throughput_result(count, seconds, peak_bytes):
+    return {"count": count, "seconds": seconds,
+            "throughput": count / seconds, "peak_bytes": peak_bytes}
+
+
+def latency_result(latencies):
+    """
+    Summarize the latencies (in seconds) of single calls.
+    """
+    latencies = np.asarray(latencies)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+    return {"count": len(latencies), "seconds": float(latencies.sum()),
+            "throughput": len(latencies) / float(latencies.sum()),
+            "p50_ms": p50, "p90_ms": p90, "p99_ms": p99}
+
+
+def time_calls(function, queries):
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        function(*query)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def run_size(num_ratings, args, results):
+    filename = os.path.join(args.data_dir, "synthetic_{}_{}.csv".format(
+        num_ratings, args.seed))
+    if not os.path.exists(filename):
+        print("### generating", filename, flush=True)
+        generate_ratings(filename, num_ratings, args.seed, args.alpha)
+    size = "{}".format(num_ratings)
+
+    def new_profiler():
+        return Profiler(enabled=True, track_memory=args.memory)
+
+    def record(key, result):
+        results[key] = result
+        print("    {:<36} {}".format(key, ", ".join(
+            "{}={:.4g}".format(name, value)
+            for name, value in result.items() if value is not None)),
+            flush=True)
+
+    if "load" in args.benchmarks:
+        repo = Repo()
+        _, seconds, peak = run_phase(
+                new_profiler(), "load",
+                lambda: repo.load_ratings(filename))
+        record(size + "/load_ratings",
+               throughput_result(num_ratings, seconds, peak))
+        del repo
+
+    rng = np.random.default_rng(args.seed)
+    for model in args.models:
+        rec_sys = new_model(model, args)
+        profiler = new_profiler()
+        rec_sys.set_profiler(profiler)
+        with contextlib.redirect_stdout(io.StringIO()):
+            rec_sys.load_ratings(filename)
+        if "build" in args.benchmarks:
+            stats = profiler.phases["ratings_loaded"]
+            record("{}/{}/build_model".format(size, model),
+                   throughput_result(num_ratings, stats["total_sec"],
+                                     stats.get("peak_bytes")))
+
+        # the latencies are measured without tracemalloc, which slows down
+        # every allocation
+        rec_sys.set_profiler(Profiler())
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        num_users, num_items = rec_sys.util_mat.shape
+        if "predict" in args.benchmarks:
+            queries = zip(rng.integers(num_users, size=args.queries),
+                          rng.integers(num_items, size=args.queries))
+            record("{}/{}/predict_rating".format(size, model),
+                   latency_result(time_calls(rec_sys.predict_rating,
+                                             queries)))
+        if "top_k" in args.benchmarks:
+            queries = [(user_idx, args.top_k) for user_idx in
+                       rng.integers(num_users, size=args.queries)]
+            record("{}/{}/predict_top_k_recomm".format(size, model),
+                   latency_result(time_calls(rec_sys.predict_top_k_recomm,
+                                             queries)))
+        del rec_sys
+
+        if "evaluate" in args.benchmarks:
+            evasys = EvaSys()
+            rec_sys = new_model(model, args)
+            np.random.seed(args.seed)
+            with contextlib.redirect_stdout(io.StringIO()):
+                evasys.load_total_ratings(args.num_fold, filename)
+                _, seconds, peak = run_phase(
+                        new_profiler(), "evaluate",
+                        lambda: evasys.evaluate(rec_sys, [args.top_k]))
+            record("{}/{}/evaluate".format(size, model),
+                   throughput_result(num_ratings, seconds, peak))
+            del evasys, rec_sys
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the changes of the results against the baseline results. Return
+    the number of regressions: the times, latencies or peak memories that
+    grew by more than the threshold fraction.
+    """
+    regressions = 0
+    print("\n### comparison with the baseline (threshold {:.0%})".format(
+        threshold))
+    for key in sorted(set(results) & set(baseline)):
+        for metric in ["seconds", "p50_ms", "p99_ms", "peak_bytes"]:
+            old = baseline[key].get(metric)
+            new = results[key].get(metric)
+            if not old or new is None:
+                continue
+            change = new / old - 1
+            mark = ""
+            if change > threshold:
+                mark = "  REGRESSION"
+                regressions += 1
+            print("    {:<36} {:<10} {:>12.4g} {:>12.4g} {:>+8.1%}{}".format(
+                key, metric, old, new, change, mark))
+    for key in sorted(set(baseline) - set(results)):
+        print("    {:<36} not measured".format(key))
+    return regressions
+
+
+parser = argparse.ArgumentParser(
+        description='Benchmark loading, training, prediction, top-k \
+                    recommendation and evaluation on synthetic ratings, and \
+                    compare the results with a baseline.')
+parser.add_argument('-n', dest='sizes', metavar='num_ratings', type=str,
+                    nargs='+', default=['10k'],
+                    help='The numbers of synthetic ratings to benchmark, \
+                            e.g. 10k 1m 10m.')
+parser.add_argument('-m', dest='models', metavar='model', type=str,
+                    nargs='+', default=['BLRS', 'ARS'],
+                    choices=['BLRS', 'ARS'],
+                    help='The recommender systems to benchmark \
+                            ("BLRS"|"ARS").')
+parser.add_argument('-b', dest='benchmarks', metavar='benchmark', type=str,
+                    nargs='+',
+                    default=['load', 'build', 'predict', 'top_k', 'evaluate'],
+                    choices=['load', 'build', 'predict', 'top_k', 'evaluate'],
+                    help='The benchmarks to run \
+                            ("load"|"build"|"predict"|"top_k"|"evaluate").')
+parser.add_argument('-r', dest='rank', metavar='rank', type=int, default=50,
+                    help='The rank for U, V in matrix factorization. Only \
+                            applied in ARS.')
+parser.add_argument('-s', dest='solver', metavar='solver', type=str,
+                    default='als', choices=['sgd', 'als', 'minibatch'],
+                    help='The solver for matrix factorization \
+                            ("sgd"|"als"|"minibatch"). Only applied in ARS.')
+parser.add_argument('-q', dest='queries', metavar='queries', type=int,
+                    default=200,
+                    help='The number of timed predict_rating and \
+                            predict_top_k_recomm calls.')
+parser.add_argument('-k', dest='top_k', metavar='K', type=int, default=10,
+                    help='The number of recommended items, also the K of \
+                            the evaluation.')
+parser.add_argument('-f', dest='num_fold', metavar='num_fold', type=int,
+                    default=3,
+                    help='The number of folds of the evaluation benchmark.')
+parser.add_argument('--lazy', dest='lazy', action='store_true',
+                    help='Compute the BLRS similarities lazily instead of \
+                            building the neighbor index at load time.')
+parser.add_argument('--seed', dest='seed', metavar='seed', type=int,
+                    default=0,
+                    help='The seed of the synthetic ratings and queries.')
+parser.add_argument('--alpha', dest='alpha', metavar='alpha', type=float,
+                    default=1.,
+                    help='The power-law exponent of the user activity and \
+                            the item popularity.')
+parser.add_argument('--data-dir', dest='data_dir', metavar='data_dir',
+                    type=str, default='.',
+                    help='The directory to keep the generated rating files \
+                            in. Existing files are reused.')
+parser.add_argument('--no-memory', dest='memory', action='store_false',
+                    help='Do not record the peak memory, which slows down \
+                            the timed phases.')
+parser.add_argument('-o', dest='output', metavar='file', type=str,
+                    help='Write the results to this JSON file.')
+parser.add_argument('--baseline', dest='baseline', metavar='file', type=str,
+                    help='Compare the results with a JSON file written by \
+                            -o before, and exit with status 1 on a \
+                            regression.')
+parser.add_argument('--threshold', dest='threshold', metavar='fraction',
+                    type=float, default=0.1,
+                    help='The relative growth of a time or a peak memory \
+                            over the baseline that counts as a regression.')
+
+
+def main(args):
+    """
+    Run the benchmarks chosen by the command line arguments args, write and
+    compare the results, and exit with status 1 on a regression.
+    """
+    os.makedirs(args.data_dir, exist_ok=True)
+
+    results = {}
+    for size in args.sizes:
+        num_ratings = parse_size(size)
+        print("\n###### {} ratings".format(num_ratings), flush=True)
+        run_size(num_ratings, args, results)
+
+    report = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, default=float)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -2,6 +2,7 @@ import argparse
 from RecSysBaseLine import RecSysBaseLine
 from RecSysAdv import RecSysAdv
 from EvaSys import EvaSys
+from Base import Profiler
 
 parser = argparse.ArgumentParser(
         description='Evaluate the recommender system with the ratings given.')
@@ -23,6 +24,10 @@ parser.add_argument('-k', dest='ks', metavar='K', type=int, nargs='+',
 parser.add_argument('-r', dest='rank', metavar='rank', type=int, default=50,
                     help='The rank for U, V in matrix factorization. Only \
                             applied in ARS.')
+parser.add_argument('-s', dest='solver', metavar='solver', type=str,
+                    default='sgd', choices=['sgd', 'als', 'minibatch'],
+                    help='The solver for matrix factorization \
+                            ("sgd"|"als"|"minibatch"). Only applied in ARS.')
 parser.add_argument('-n', dest='num_fold', metavar='num_fold', type=int,
                     default=5,
                     help='The number of folds in n-fold evaluation manner. \
@@ -31,6 +36,45 @@ parser.add_argument('-n', dest='num_fold', metavar='num_fold', type=int,
 parser.add_argument('-u', dest='num_user', metavar='num_user', type=int,
                     help='The number of users to be evaluated. If not \
                             specified, all users wil be evaluated.')
+parser.add_argument('-j', dest='workers', metavar='workers', type=int,
+                    default=1,
+                    help='The number of processes to evaluate the folds in \
+                            parallel.')
+parser.add_argument('--sampled', dest='num_negatives', metavar='num_negatives',
+                    type=int,
+                    help='Also rank every positive test rating against this \
+                            many items sampled from those its user has not \
+                            rated, and report the sampled metrics alongside \
+                            the exact ones.')
+parser.add_argument('--no-exact', dest='exact', action='store_false',
+                    help='With --sampled, skip the exact ranking of the \
+                            whole catalog.')
+parser.add_argument('--user-metrics', dest='user_metrics',
+                    metavar='file', type=str,
+                    help='Write the P@K, R@K, MRR@K and NDCG@K of every \
+                            evaluated user (one line per user and fold) to \
+                            this CSV file.')
+parser.add_argument('--compact', dest='compact', action='store_true',
+                    help='Keep the ID mappings in compact sorted arrays and \
+                            the ratings as float32, to save memory.')
+parser.add_argument('--cache-dir', dest='cache_dir', metavar='cache_dir',
+                    type=str,
+                    help='The directory to keep compiled copies of the \
+                            rating files in. Later runs load them \
+                            memory-mapped instead of parsing the files.')
+parser.add_argument('--export-files', dest='export_files',
+                    action='store_true',
+                    help='Also write the training and test data of every \
+                            fold to files. The evaluation itself splits the \
+                            folds in memory.')
+parser.add_argument('--profile', dest='profile', metavar='file', type=str,
+                    help='Time the phases and count the calls and the \
+                            candidate set sizes, and write the report to \
+                            this JSON file.')
+parser.add_argument('--profile-memory', dest='profile_memory',
+                    action='store_true',
+                    help='With --profile, also record the peak memory of \
+                            every phase (slower).')
 
 args = parser.parse_args()
 
@@ -39,8 +83,21 @@ if args.model == "BLRS":
 else:
     RS = RecSysAdv()
     RS.set_rank(args.rank)
+    RS.set_solver(args.solver)
 
+RS.set_cache_dir(args.cache_dir)
+RS.set_compact(args.compact)
 ES = EvaSys()
+ES.set_cache_dir(args.cache_dir)
+ES.set_compact(args.compact)
+if args.num_negatives is not None:
+    ES.set_sampled(args.num_negatives, args.exact)
+elif not args.exact:
+    parser.error("--no-exact requires --sampled")
+if args.profile is not None:
+    profiler = Profiler(enabled=True, track_memory=args.profile_memory)
+    RS.set_profiler(profiler)
+    ES.set_profiler(profiler)
 if len(args.files) == 1:
     ES.load_total_ratings(args.num_fold, args.files[0])
 else:
@@ -51,6 +108,14 @@ print("###### Evaluating     ", args.model)
 print("###### Rating File(s) ", args.files)
 print("###### K(s)           ", args.ks)
 if args.num_user is None:
-    ES.evaluate(RS, args.ks)
+    result = ES.evaluate(RS, args.ks, export_files=args.export_files,
+                         workers=args.workers)
 else:
-    ES.evaluate(RS, args.ks, False, args.num_user)
+    result = ES.evaluate(RS, args.ks, False, args.num_user, args.export_files,
+                         args.workers)
+if args.user_metrics is not None:
+    if not result.exact:
+        result = result.sampled
+    result.dump_users(args.user_metrics, ES.user_ids)
+if args.profile is not None:
+    profiler.dump(args.profile)
@@ -1,52 +1,110 @@
 import argparse
+import numpy as np
 from RecSysBaseLine import RecSysBaseLine
 from RecSysAdv import RecSysAdv
+from Base import Profiler, add_model_arguments, load_or_train_from_args
 
 parser = argparse.ArgumentParser(
         description='Make recommendation by different recommender systems. \
                     You can recommend top-k items to a certain user, or \
                     predict the rating of a certain item to a certain user.')
-parser.add_argument('-m', dest='model', metavar='model', type=str,
-                    required=True, choices=['BLRS', 'ARS'],
-                    help='The recommender system to use ("BLRS"|"ARS")')
-parser.add_argument('-f', dest='file', metavar='file', type=str,
-                    required=True,
-                    help='The path of the rating file.')
-parser.add_argument('-r', dest='rank', metavar='rank', type=int, default=50,
-                    help='The rank for U, V in matrix factorization. Only \
-                            applied in ARS.')
+add_model_arguments(parser)
 parser.add_argument('-u', dest='user_id', metavar='user_id', type=str,
-                    required=True,
-                    help='The user ID you want to recomend for.')
+                    help='The user ID you want to recomend for. Not \
+                            required with --all-users or --users-file.')
 parser.add_argument('-k', dest='top_k', metavar='top_k', type=int,
                     help='The number of items you want to recommend. Only \
                             required in top-k item recommendation.')
 parser.add_argument('-i', dest='item_id', metavar='item_id', type=str,
                     help='The item ID you want to predict the rating for. \
                             Only required in rating prediction.')
+parser.add_argument('--all-users', dest='all_users', action='store_true',
+                    help='Recommend top-k items to every user, and write \
+                            them to the file given by -o.')
+parser.add_argument('--users-file', dest='users_file', metavar='file',
+                    type=str,
+                    help='Recommend top-k items to the users listed in this \
+                            file (one user ID per line), and write them to \
+                            the file given by -o.')
+parser.add_argument('-o', dest='output', metavar='file', type=str,
+                    help='The output file of --all-users and --users-file, \
+                            with one line per recommendation in the format \
+                            <User_ID>,<Rank>,<Item_ID>,<Score>.')
+parser.add_argument('-j', dest='workers', metavar='workers', type=int,
+                    default=1,
+                    help='The number of processes to recommend in, with \
+                            --all-users or --users-file.')
+parser.add_argument('--block-size', dest='block_size', metavar='block_size',
+                    type=int, default=1000,
+                    help='The number of users recommended per block, with \
+                            --all-users or --users-file.')
+parser.add_argument('--resume', dest='resume', action='store_true',
+                    help='Continue an interrupted --all-users or \
+                            --users-file run from its last finished block.')
+parser.add_argument('--index-probes', dest='index_probes',
+                    metavar='num_probes', type=int,
+                    help='Recommend top-k items through the approximate \
+                            index over the item factors, scoring the items \
+                            of this many clusters. Only applied in ARS.')
+parser.add_argument('--profile', dest='profile', metavar='file', type=str,
+                    help='Time the phases and count the calls and the \
+                            candidate set sizes, and write the report to \
+                            this JSON file.')
+parser.add_argument('--profile-memory', dest='profile_memory',
+                    action='store_true',
+                    help='With --profile, also record the peak memory of \
+                            every phase (slower).')
 
 args = parser.parse_args()
+bulk = args.all_users or args.users_file is not None
+if bulk and (args.top_k is None or args.output is None):
+    parser.error("--all-users and --users-file require -k and -o")
+if not bulk and args.user_id is None:
+    parser.error("a user ID (-u), --all-users or --users-file is required")
 
 print("\n### recommendation model:", args.model)
 if args.model == "BLRS":
     RS = RecSysBaseLine()
 else:
     RS = RecSysAdv()
-    RS.set_rank(args.rank)
+    RS.set_rank(args.rank if args.rank is not None else 50)
+    RS.set_solver(args.solver if args.solver is not None else 'sgd')
+    if args.index_probes is not None:
+        RS.set_index(num_probes=args.index_probes)
+if args.profile is not None:
+    RS.set_profiler(
+            Profiler(enabled=True, track_memory=args.profile_memory))
+load_or_train_from_args(RS, parser, args)
 
-RS.load_ratings(args.file)
-user_idx = RS.get_user_idx(args.user_id)
+if bulk:
+    user_idxs = None
+    if args.users_file is not None:
+        with open(args.users_file) as f:
+            user_ids = [line.strip() for line in f if line.strip()]
+        user_idxs = RS.get_user_idxs(user_ids)
+        if np.any(user_idxs < 0):
+            print("### skipping {} unknown users".format(
+                np.count_nonzero(user_idxs < 0)))
+        user_idxs = user_idxs[user_idxs >= 0]
+    print("### Exporting top {} items to {}".format(args.top_k, args.output))
+    RS.export_top_k(args.output, args.top_k, user_idxs, args.workers,
+                    args.block_size, args.resume)
+else:
+    user_idx = RS.get_user_idx(args.user_id)
+
+    if args.top_k is not None:
+        predictions = RS.predict_top_k_recomm(user_idx, args.top_k)
+        print("### Predict Top {} items for user {}:".format(
+            args.top_k, args.user_id))
+        for i, (item_idx, score) in enumerate(predictions):
+            item_id = RS.get_item_id(int(item_idx))
+            print("    [{}] {} {:.3f}".format(i+1, item_id, score))
 
-if args.top_k is not None:
-    predictions = RS.predict_top_k_recomm(user_idx, args.top_k)
-    print("### Predict Top {} items for user {}:".format(
-        args.top_k, args.user_id))
-    for i, (item_idx, score) in enumerate(predictions):
-        item_id = RS.get_item_id(int(item_idx))
-        print("    [{}] {} {:.3f}".format(i+1, item_id, score))
+    if args.item_id is not None:
+        item_idx = RS.get_item_idx(args.item_id)
+        rating = RS.predict_rating(user_idx, item_idx)
+        print("### Predicted rating of item {} for user {}: {:.3f}\n".format(
+            args.item_id, args.user_id, rating))
 
-if args.item_id is not None:
-    item_idx = RS.get_item_idx(args.item_id)
-    rating = RS.predict_rating(user_idx, item_idx)
-    print("### Predicted rating of item {} for user {}: {:.3f}\n".format(
-        args.item_id, args.user_id, rating))
+if args.profile is not None:
+    RS.profiler.dump(args.profile)
@@ -0,0 +1,71 @@
+import argparse
+import asyncio
+from RecSysBaseLine import RecSysBaseLine
+from RecSysAdv import RecSysAdv
+from RecServer import RecServer
+from Base import add_model_arguments, load_or_train_from_args
+
+parser = argparse.ArgumentParser(
+        description='Serve recommendations over HTTP/JSON from a recommender \
+                    system kept in memory. The endpoints are /predict, \
+                    /top_k, /similar_items and /stats.')
+add_model_arguments(parser)
+parser.add_argument('--host', dest='host', metavar='host', type=str,
+                    default='127.0.0.1',
+                    help='The address to listen on.')
+parser.add_argument('--port', dest='port', metavar='port', type=int,
+                    default=8000,
+                    help='The TCP port to listen on.')
+parser.add_argument('--socket', dest='socket_path', metavar='socket_path',
+                    type=str,
+                    help='Listen on this Unix socket instead of TCP.')
+parser.add_argument('--max-batch', dest='max_batch', metavar='max_batch',
+                    type=int, default=256,
+                    help='The largest number of concurrent requests served \
+                            by one batch.')
+parser.add_argument('--max-wait', dest='max_wait', metavar='max_wait',
+                    type=float, default=2,
+                    help='The longest time in milliseconds a request waits \
+                            for its batch to fill.')
+parser.add_argument('--topk-cache', dest='topk_cache', metavar='entries',
+                    type=int,
+                    help='Cache the top-k results of this many users, with \
+                            LRU eviction. The counters are shown in /stats.')
+parser.add_argument('--index-probes', dest='index_probes',
+                    metavar='num_probes', type=int,
+                    help='Recommend top-k items through the approximate \
+                            index over the item factors, scoring the items \
+                            of this many clusters. Only applied in ARS.')
+parser.add_argument('--similarity-cache', dest='similarity_cache',
+                    metavar='entries', type=int,
+                    help='Keep at most this many item-item similarities \
+                            computed lazily, evicting those of the least \
+                            requested items. Only applied in BLRS.')
+
+args = parser.parse_args()
+
+print("\n### recommendation model:", args.model)
+if args.model == "BLRS":
+    RS = RecSysBaseLine()
+    if args.similarity_cache is not None:
+        RS.set_similarity_cache(args.similarity_cache)
+else:
+    RS = RecSysAdv()
+    RS.set_rank(args.rank if args.rank is not None else 50)
+    RS.set_solver(args.solver if args.solver is not None else 'sgd')
+    if args.index_probes is not None:
+        RS.set_index(num_probes=args.index_probes)
+load_or_train_from_args(RS, parser, args)
+
+if args.topk_cache is not None:
+    RS.set_topk_cache(args.topk_cache)
+server = RecServer(RS)
+server.set_batching(args.max_batch, args.max_wait / 1000.)
+if args.socket_path is not None:
+    print("### serving on", args.socket_path)
+else:
+    print("### serving on http://{}:{}".format(args.host, args.port))
+try:
+    asyncio.run(server.serve(args.host, args.port, args.socket_path))
+except KeyboardInterrupt:
+    pass